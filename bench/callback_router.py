@@ -0,0 +1,87 @@
+"""Стоимость маршрутизации callback-запроса от числа обработчиков.
+
+Через настоящий Dispatcher.feed_update сравниваются:
+  chain - цепочка F.data.startswith(...) фильтров, id разбирается в
+          обработчике через int(data.replace(...)), как было раньше
+  table - один обработчик CallbackRouter.dispatch, маршрут по префиксу
+          CallbackData и однократный unpack
+Нажимается кнопка последнего зарегистрированного обработчика (худший
+случай для цепочки). Обработчики ничего не отправляют, сеть не нужна.
+"""
+import asyncio
+import logging
+import time
+import types as pytypes
+
+import common
+import newdig
+from aiogram import Dispatcher, F, Router
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import CallbackQuery, Chat, Message, Update, User
+
+UPDATES = 5000
+
+
+def callback_update(data):
+    user = User(id=1, is_bot=False, first_name="bench")
+    message = Message(message_id=1, date=0, chat=Chat(id=1, type="private"), text="x")
+    return Update(
+        update_id=1,
+        callback_query=CallbackQuery(id="1", from_user=user, chat_instance="c", message=message, data=data)
+    )
+
+
+def chain_dispatcher(handlers):
+    router = Router()
+    for i in range(handlers):
+        prefix = f"act{i}_"
+
+        async def handler(callback: CallbackQuery, prefix=prefix):
+            int(callback.data.replace(prefix, ""))
+
+        router.callback_query(F.data.startswith(prefix))(handler)
+    dispatcher = Dispatcher()
+    dispatcher.include_router(router)
+    return dispatcher, f"act{handlers - 1}_42"
+
+
+def table_dispatcher(handlers):
+    table = newdig.CallbackRouter()
+    factory = None
+    for i in range(handlers):
+        factory = pytypes.new_class(
+            f"Act{i}", (CallbackData,), {"prefix": f"act{i}"},
+            lambda namespace: namespace.update({"__annotations__": {"order_id": int}})
+        )
+
+        async def handler(callback, callback_data):
+            callback_data.order_id
+
+        table.route(factory)(handler)
+    dispatcher = Dispatcher()
+    dispatcher.callback_query.register(table.dispatch)
+    return dispatcher, factory(order_id=42).pack()
+
+
+async def per_update_us(dispatcher, data):
+    update = callback_update(data)
+    for _ in range(200):
+        await dispatcher.feed_update(newdig.bot, update)
+    start = time.perf_counter()
+    for _ in range(UPDATES):
+        await dispatcher.feed_update(newdig.bot, update)
+    return (time.perf_counter() - start) / UPDATES * 1e6
+
+
+async def main():
+    # aiogram пишет строку лога на каждый апдейт - это мерило бы логирование
+    logging.disable(logging.INFO)
+    print(f"{'обработчиков':>12} {'chain':>10} {'table':>10}")
+    for handlers in (5, 10, 25, 50, 100):
+        chain = await per_update_us(*chain_dispatcher(handlers))
+        table = await per_update_us(*table_dispatcher(handlers))
+        print(f"{handlers:>12} {chain:>8.1f}us {table:>8.1f}us")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,29 @@
+"""Общая подготовка бенчмарков.
+
+Импортируется до newdig: задает окружение и переходит во временный
+каталог, чтобы digistore.db и тестовые базы не попали в рабочую копию.
+Запуск из корня репозитория: python bench/<скрипт>.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+WORKDIR = tempfile.mkdtemp(prefix="newdig-bench-")
+os.chdir(WORKDIR)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def per_call_us(func, number, warmup=1000):
+    """Среднее время вызова func в микросекундах"""
+    for _ in range(warmup):
+        func()
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - start) / number * 1e6
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
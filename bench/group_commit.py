@@ -0,0 +1,68 @@
+"""Записей в секунду: commit на каждую запись против WAL и группового коммита.
+
+Конкурентные обработчики пишут через AsyncDatabase вперемешку add_user и
+update_order_status, как при распродаже. Режимы:
+  baseline - журнал отката (DELETE), synchronous=FULL, commit на запись
+  wal      - WAL, synchronous=DB_SYNCHRONOUS, commit на запись
+  group    - WAL + групповой коммит с окном --window мс
+
+Каталог базы задается --dir: на tmpfs fsync бесплатен и разница меньше,
+чем на реальном диске.
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import common
+import newdig
+
+
+async def run(mode, writes, concurrency, window, directory):
+    path = os.path.join(directory, f"group_commit_{mode}.db")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    database = newdig.Database(path)
+    if mode == "baseline":
+        database.conn.execute("PRAGMA journal_mode=DELETE")
+        database.conn.execute("PRAGMA synchronous=FULL")
+    orders = [
+        database.add_order(user_id, "stars", "@bench", None, newdig.Decimal("150"), "card", stars=100)
+        for user_id in range(concurrency)
+    ]
+    adb = newdig.AsyncDatabase(database, group_commit_ms=window if mode == "group" else 0, user_cache_size=0)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def write(i):
+        async with semaphore:
+            if i % 2:
+                await adb.update_order_status(orders[i % len(orders)], "waiting_payment")
+            else:
+                await adb.add_user(10_000 + i, "bench", "Bench")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(write(i) for i in range(writes)))
+    elapsed = time.perf_counter() - start
+    await adb.close()
+    return writes / elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writes", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--window", type=float, default=2, help="окно группового коммита, мс")
+    parser.add_argument("--dir", default=common.WORKDIR, help="каталог для баз")
+    args = parser.parse_args()
+
+    print(f"{args.writes} записей, {args.concurrency} конкурентных обработчиков, каталог {args.dir}")
+    for mode in ("baseline", "wal", "group"):
+        rate = await run(mode, args.writes, args.concurrency, args.window, args.dir)
+        print(f"{mode:>8}: {rate:8.0f} записей/с")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
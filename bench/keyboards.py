@@ -0,0 +1,52 @@
+"""Сборка клавиатур на горячих обработчиках: каждый раз заново против кэша.
+
+Для каждой клавиатуры - время вызова без кэша (__wrapped__) и с кэшем,
+время вместе с сериализацией, как при отправке в Bot API, и память
+на один новый объект InlineKeyboardMarkup.
+"""
+import itertools
+import tracemalloc
+
+import common
+import newdig
+
+NUMBER = 20000
+
+
+def allocated_per_call(func, number=1000):
+    """Байт на вызов, которые остаются живыми, пока жив результат (апдейт)"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    results = [func() for _ in range(number)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del results
+    return (after - before) / number
+
+
+def main():
+    order_ids = itertools.count(1)
+    cases = [
+        ("main_menu_kb", newdig.main_menu_kb, ()),
+        ("premium_periods_kb", newdig.premium_periods_kb, ()),
+        ("payment_method_kb", newdig.payment_method_kb, (42, "buy_stars")),
+        ("confirm_payment_kb", newdig.confirm_payment_kb, (42,)),
+    ]
+
+    print(f"{'клавиатура':<20} {'без кэша':>10} {'с кэшем':>10} {'+JSON без':>11} {'+JSON с':>10} {'память':>9}")
+    for name, factory, args in cases:
+        uncached = factory.__wrapped__
+        build = common.per_call_us(lambda: uncached(*args), NUMBER)
+        cached = common.per_call_us(lambda: factory(*args), NUMBER)
+        build_json = common.per_call_us(lambda: uncached(*args).model_dump_json(exclude_none=True), NUMBER // 4)
+        cached_json = common.per_call_us(lambda: factory(*args).model_dump_json(exclude_none=True), NUMBER // 4)
+        memory = allocated_per_call(lambda: uncached(*args))
+        print(f"{name:<20} {build:>8.2f}us {cached:>8.2f}us {build_json:>9.2f}us {cached_json:>8.2f}us {memory:>7.0f} B")
+
+    # Заказы разные, поэтому для параметризованных клавиатур важен промах кэша
+    miss = common.per_call_us(lambda: newdig.confirm_payment_kb(next(order_ids)), NUMBER)
+    print(f"confirm_payment_kb, каждый раз новый order_id: {miss:.2f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Накладные расходы HandlerMetricsMiddleware на один апдейт.
+
+  direct   - вызов middleware вокруг пустого обработчика напрямую
+             (поиск имени обработчика + perf_counter + observe)
+  dispatch - Dispatcher.feed_update с сообщением и обычным обработчиком,
+             без middleware и с ним; разница - цена метрик в реальном пути
+Обработчики ничего не отправляют, сеть не нужна.
+"""
+import asyncio
+import logging
+import time
+
+import common
+import newdig
+from aiogram import Dispatcher, Router
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.types import Chat, Message, Update, User
+
+UPDATES = 5000
+ROUNDS = 5
+
+
+async def noop_handler(message: Message):
+    pass
+
+
+def message_update():
+    user = User(id=1, is_bot=False, first_name="bench")
+    message = Message(message_id=1, date=0, chat=Chat(id=1, type="private"), from_user=user, text="x")
+    return Update(update_id=1, message=message)
+
+
+def dispatcher(with_metrics):
+    router = Router()
+    router.message()(noop_handler)
+    dispatcher = Dispatcher()
+    if with_metrics:
+        dispatcher.message.middleware(newdig.HandlerMetricsMiddleware())
+    dispatcher.include_router(router)
+    return dispatcher
+
+
+async def direct_us():
+    middleware = newdig.HandlerMetricsMiddleware()
+    data = {"handler": HandlerObject(noop_handler)}
+    event = message_update().message
+
+    async def handler(event, data):
+        return None
+
+    async def bare():
+        await handler(event, data)
+
+    async def wrapped():
+        await middleware(handler, event, data)
+
+    results = []
+    for call in (bare, wrapped):
+        for _ in range(1000):
+            await call()
+        start = time.perf_counter()
+        for _ in range(UPDATES):
+            await call()
+        results.append((time.perf_counter() - start) / UPDATES * 1e6)
+    return results[1] - results[0]
+
+
+async def per_update_us(dispatcher):
+    update = message_update()
+    for _ in range(500):
+        await dispatcher.feed_update(newdig.bot, update)
+    start = time.perf_counter()
+    for _ in range(UPDATES):
+        await dispatcher.feed_update(newdig.bot, update)
+    return (time.perf_counter() - start) / UPDATES * 1e6
+
+
+async def main():
+    # aiogram пишет строку лога на каждый апдейт - это мерило бы логирование
+    logging.disable(logging.INFO)
+    print(f"direct:   +{await direct_us():.2f}us на вызов middleware")
+    # Прогоны чередуются, берется лучший: разница меньше шума одного прогона
+    plain, metered = dispatcher(False), dispatcher(True)
+    without = with_metrics = float("inf")
+    for _ in range(ROUNDS):
+        without = min(without, await per_update_us(plain))
+        with_metrics = min(with_metrics, await per_update_us(metered))
+    print(f"dispatch: {without:.1f}us без метрик, {with_metrics:.1f}us с метриками "
+          f"(+{with_metrics - without:.2f}us)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+"""Заказ для уведомления о фото оплаты: кортеж и JSON против OrderRecord.
+
+Прежний путь: get_order возвращал 8-кортеж, а сумма к выдаче читалась из
+details через json.loads на каждое сообщение (три админа и покупатель).
+Новый путь: get_order возвращает OrderRecord, суммы уже Decimal.
+Оба варианта читают один и тот же заказ обмена из теплой базы и собирают
+одинаковые тексты.
+"""
+import json
+
+import common
+import newdig
+
+NUMBER = 50000
+ADMINS = (1, 2, 3)
+
+
+def legacy_order(database, order_id):
+    """get_order до OrderRecord"""
+    cursor = database.conn.cursor()
+    cursor.execute("""
+        SELECT user_id, order_type, recipient, details, amount_kop, payment_method, status, invoice_id
+        FROM orders WHERE id = ?
+    """, (order_id,))
+    row = cursor.fetchone()
+    return row and row[:4] + (newdig.from_kop(row[4]),) + row[5:]
+
+
+def legacy_amount_usd(details, amount_rub):
+    details_dict = json.loads(details) if details else {}
+    return newdig.to_money(details_dict.get("amount_usd", amount_rub / newdig.USD_RATE))
+
+
+def legacy_path(database, order_id):
+    user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id = \
+        legacy_order(database, order_id)
+    messages = []
+    for admin_id in ADMINS:
+        amount_usd = legacy_amount_usd(details, amount_rub)
+        messages.append((admin_id, admin_text(order_id, order_type, amount_rub, amount_usd)))
+    amount_usd = legacy_amount_usd(details, amount_rub)
+    messages.append((user_id, user_text(amount_rub, amount_usd)))
+    return messages
+
+
+def record_path(database, order_id):
+    order = database.get_order(order_id)
+    text = admin_text(order_id, order.order_type, order.amount_rub, order.amount_usd)
+    messages = [(admin_id, text) for admin_id in ADMINS]
+    messages.append((order.user_id, user_text(order.amount_rub, order.amount_usd)))
+    return messages
+
+
+def admin_text(order_id, order_type, amount_rub, amount_usd):
+    return (
+        f"🆕 Ожидает проверки картой\n"
+        f"🆔 Заказ: #{order_id}\n"
+        f"💰 Сумма: {amount_rub:.2f} RUB\n"
+        f"📦 Тип: {order_type}\n"
+        f"💸 К выдаче: {amount_usd:.2f} USD\n"
+        f"\nДля проверки: /check_{order_id}"
+    )
+
+
+def user_text(amount_rub, amount_usd):
+    return (
+        f"✅ Фото оплаты получено!\n"
+        f"💸 Вы получаете: {amount_usd:.2f} USD\n"
+        f"💰 Оплачено: {amount_rub:.2f} RUB\n\n"
+        "Заказ передан админу на проверку."
+    )
+
+
+def main():
+    database = newdig.Database("notification_path.db")
+    amount_rub = newdig.Decimal("850")
+    amount_usd = newdig.Decimal("10.00")
+    order_id = database.add_order(
+        1, "exchange", "", None, amount_rub, "card", usd_rate=newdig.Decimal("85"), amount_usd=amount_usd
+    )
+    # Старые заказы хранили сумму к выдаче только в details
+    database.conn.execute(
+        "UPDATE orders SET details = ? WHERE id = ?", (json.dumps({"amount_usd": float(amount_usd)}), order_id)
+    )
+    database.commit()
+    assert legacy_path(database, order_id) == record_path(database, order_id)
+
+    legacy = common.per_call_us(lambda: legacy_path(database, order_id), NUMBER)
+    record = common.per_call_us(lambda: record_path(database, order_id), NUMBER)
+    print(f"{NUMBER} итераций, заказ обмена, {len(ADMINS)} админа и покупатель:")
+    print(f"  кортеж + JSON на сообщение: {legacy:6.1f} us")
+    print(f"  OrderRecord:                {record:6.1f} us  ({legacy / record:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""Воспроизведение покупок через настоящий Dispatcher без сети.
+
+Бот ходит в локальные заглушки Bot API (BOT_API_URL) и Crypto Pay API
+(CRYPTOBOT_API_URL). --users покупателей одновременно проходят сценарий
+от /start до оплаты, по кругу:
+  stars    - получатель, количество, оплата картой, фото чека
+  premium  - период, получатель, оплата картой, фото чека
+  exchange - сумма, оплата картой, фото чека
+  crypto   - звезды, счет CryptoBot, оплата (как из вебхука), проверка
+id заказа берется из callback_data кнопок, которые бот отправил в заглушку.
+Уведомления админам и покупателям рассылают outbox_sender и notifier.
+
+Отчет: апдейтов в секунду, p50/p99 времени feed_update по всем апдейтам
+и по шагам сценария, ожидание потоков БД и группового коммита
+(bot_db_queue_wait_seconds) и размер групп коммита - это и есть
+конкуренция за базу. Ожидание включает задержку event loop до
+продолжения корутины, поэтому на перегруженном цикле оно растет вместе с p99.
+
+Групповой коммит включается так же, как у бота:
+  GROUP_COMMIT_MS=2 python bench/replay.py --users 1000
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import socket
+import time
+from collections import defaultdict
+
+# Окружение читается при импорте newdig, порт заглушки нужен заранее
+with socket.socket() as probe:
+    probe.bind(("127.0.0.1", 0))
+    PORT = probe.getsockname()[1]
+os.environ["BOT_API_URL"] = f"http://127.0.0.1:{PORT}"
+os.environ["CRYPTOBOT_API_URL"] = f"http://127.0.0.1:{PORT}/crypto"
+os.environ.setdefault("CRYPTOBOT_TOKEN", "bench-token")
+os.environ.setdefault("ADMIN_IDS", "1")
+os.environ.setdefault("METRICS_PORT", "0")
+
+import common
+import newdig
+from aiohttp import web
+from aiogram.types import CallbackQuery, Chat, Message, PhotoSize, Update, User
+
+FLOWS = ("stars", "premium", "exchange", "crypto")
+
+
+class FakeTelegram:
+    """Bot API и Crypto Pay API: отвечают успехом и запоминают кнопки"""
+
+    def __init__(self):
+        self.calls = defaultdict(int)
+        # chat_id -> callback_data кнопок последнего сообщения
+        self.buttons = {}
+        self.invoice_ids = itertools.count(1)
+
+    async def bot_api(self, request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        form = await request.post()
+        markup = form.get("reply_markup")
+        if markup:
+            self.buttons[int(form["chat_id"])] = [
+                button["callback_data"]
+                for row in json.loads(markup).get("inline_keyboard", ())
+                for button in row if "callback_data" in button
+            ]
+        if method in ("sendMessage", "sendPhoto", "editMessageText"):
+            chat_id = int(form.get("chat_id", 0))
+            return web.json_response({"ok": True, "result": {
+                "message_id": 1, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": "ok"
+            }})
+        return web.json_response({"ok": True, "result": True})
+
+    async def crypto_api(self, request):
+        method = request.match_info["method"]
+        self.calls[f"crypto.{method}"] += 1
+        if method == "createInvoice":
+            payload = await request.json()
+            invoice_id = next(self.invoice_ids)
+            return web.json_response({"ok": True, "result": {
+                "invoice_id": invoice_id, "pay_url": f"https://pay/{invoice_id}",
+                "amount": payload["amount"], "asset": payload["asset"]
+            }})
+        return web.json_response({"ok": True, "result": {"items": []}})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.bot_api)
+        app.router.add_post("/crypto/{method}", self.crypto_api)
+        return app
+
+    def order_button(self, chat_id, factory):
+        """Распаковать кнопку factory из последнего сообщения чата"""
+        prefix = factory.__prefix__ + ":"
+        for data in self.buttons.get(chat_id, ()):
+            if data.startswith(prefix):
+                return factory.unpack(data)
+        raise RuntimeError(f"чат {chat_id}: нет кнопки {prefix}, есть {self.buttons.get(chat_id)}")
+
+
+class Replay:
+    def __init__(self, fake):
+        self.fake = fake
+        self.ids = itertools.count(1)
+        # шаг сценария -> [секунды, ...]
+        self.latency = defaultdict(list)
+
+    def user(self, user_id):
+        return User(id=user_id, is_bot=False, first_name="bench", username=f"bench{user_id}")
+
+    def message(self, user_id, text=None, photo=False):
+        return Update(update_id=next(self.ids), message=Message(
+            message_id=next(self.ids), date=0, chat=Chat(id=user_id, type="private"),
+            from_user=self.user(user_id), text=text,
+            photo=[PhotoSize(file_id=f"photo{user_id}", file_unique_id=f"u{user_id}", width=1, height=1)]
+            if photo else None
+        ))
+
+    def callback(self, user_id, data):
+        if not isinstance(data, str):
+            data = data.pack()
+        return Update(update_id=next(self.ids), callback_query=CallbackQuery(
+            id=str(next(self.ids)), from_user=self.user(user_id), chat_instance="bench", data=data,
+            message=Message(message_id=1, date=0, chat=Chat(id=user_id, type="private"), text="menu")
+        ))
+
+    async def feed(self, step, update):
+        start = time.perf_counter()
+        await newdig.dp.feed_update(newdig.bot, update)
+        self.latency[step].append(time.perf_counter() - start)
+
+    async def pay_by_card(self, user_id):
+        card = self.fake.order_button(user_id, newdig.CardPayCallback)
+        await self.feed("card_pay", self.callback(user_id, card))
+        await self.feed("confirm_paid", self.callback(user_id, newdig.ConfirmPaidCallback(order_id=card.order_id)))
+        await self.feed("photo", self.message(user_id, photo=True))
+
+    async def purchase(self, user_id, flow):
+        await self.feed("start", self.message(user_id, "/start"))
+        if flow == "premium":
+            await self.feed("menu", self.callback(user_id, "buy_premium"))
+            await self.feed("menu", self.callback(user_id, newdig.PremiumCallback(period="3m")))
+            await self.feed("order", self.message(user_id, f"buyer{user_id}"))
+        elif flow == "exchange":
+            await self.feed("menu", self.callback(user_id, "exchange"))
+            await self.feed("order", self.message(user_id, "1000"))
+        else:
+            await self.feed("menu", self.callback(user_id, "buy_stars"))
+            await self.feed("recipient", self.message(user_id, f"buyer{user_id}"))
+            await self.feed("order", self.message(user_id, "100"))
+
+        if flow != "crypto":
+            await self.pay_by_card(user_id)
+            return
+        crypto = self.fake.order_button(user_id, newdig.CryptoPayCallback)
+        await self.feed("crypto_pay", self.callback(user_id, crypto))
+        await newdig.apply_invoice_updates(newdig.db, [(crypto.order_id, "completed")])
+        await self.feed("check_crypto", self.callback(user_id, newdig.CheckCryptoCallback(order_id=crypto.order_id)))
+
+
+def quantiles(values):
+    values = sorted(values)
+    return common.percentile(values, 0.5) * 1000, common.percentile(values, 0.99) * 1000
+
+
+def histogram_totals(histogram):
+    """{метки: (sum, count)} из выдачи Histogram.samples()"""
+    totals = defaultdict(lambda: [0.0, 0])
+    for name, labels, value in histogram.samples():
+        if name.endswith("_sum"):
+            totals[labels][0] = value
+        elif name.endswith("_count"):
+            totals[labels][1] = value
+    return totals
+
+
+def report(replay, fake, elapsed):
+    every = [value for values in replay.latency.values() for value in values]
+    p50, p99 = quantiles(every)
+    print(f"{len(every)} апдейтов за {elapsed:.2f}s: {len(every) / elapsed:.0f} upd/s, "
+          f"p50 {p50:.1f}ms, p99 {p99:.1f}ms")
+    for step, values in replay.latency.items():
+        p50, p99 = quantiles(values)
+        print(f"  {step:<13} {len(values):>6}  p50 {p50:7.1f}ms  p99 {p99:7.1f}ms")
+
+    print("ожидание БД (конкуренция):")
+    for labels, (total, count) in histogram_totals(newdig.DB_WAIT).items():
+        print(f"  {labels:<24} {count:>7} ожиданий, в среднем {total / max(count, 1) * 1000:.2f}ms, "
+              f"всего {total:.2f}s")
+    for labels, (total, count) in histogram_totals(newdig.DB_BATCH_SIZE).items():
+        print(f"  групповой коммит: {count} транзакций, в среднем {total / max(count, 1):.1f} записей")
+    print("вызовы заглушек:", ", ".join(f"{method}={count}" for method, count in sorted(fake.calls.items())))
+
+
+async def main(users):
+    # aiogram пишет строку лога на каждый апдейт - это мерило бы логирование
+    logging.disable(logging.INFO)
+    fake = FakeTelegram()
+    runner = web.AppRunner(fake.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+    newdig.notifier.start()
+    newdig.outbox_sender.start()
+
+    replay = Replay(fake)
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            replay.purchase(10_000 + i, FLOWS[i % len(FLOWS)]) for i in range(users)
+        ))
+        elapsed = time.perf_counter() - start
+    finally:
+        await newdig.outbox_sender.stop()
+        await newdig.notifier.stop(timeout=1)
+        await newdig.cryptobot.close()
+        await newdig.bot.session.close()
+        await newdig.db.close()
+        await runner.cleanup()
+    report(replay, fake, elapsed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=500, help="покупателей одновременно")
+    args = parser.parse_args()
+    asyncio.run(main(args.users))
@@ -3,50 +3,303 @@ import logging
 import sqlite3
 import os
 import json
-import requests
+import functools
+import threading
+import time
+import uuid
+import hashlib
+import hmac
+import random
+import signal
+import bisect
+import aiohttp
+from aiohttp import web
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command, CommandStart
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP, ROUND_UP
+from typing import Literal, get_args
+from aiogram import Bot, Dispatcher, BaseMiddleware, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.filters import Command, CommandObject, CommandStart
+from aiogram.filters.callback_data import CallbackData
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 
 # ========== КОНФИГУРАЦИЯ ==========
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 ADMIN_IDS = list(map(int, os.environ.get("ADMIN_IDS", "").split(","))) if os.environ.get("ADMIN_IDS") else []
 CRYPTOBOT_TOKEN = os.environ.get("CRYPTOBOT_TOKEN", "")
+# Свой Bot API сервер (local bot-api или заглушка для нагрузочных прогонов)
+BOT_API_URL = os.environ.get("BOT_API_URL", "")
 
 # Настройки
 CARD_NUMBER = "2200700527205453"
-STAR_RATE = 1.5  # 1 звезда = 1.5 RUB
-USD_RATE = 85.0  # ✅ ИСПРАВЛЕНО: 1 USD = 85 RUB (было 84.0)
+STAR_RATE = Decimal("1.5")  # 1 звезда = 1.5 RUB
+USD_RATE = Decimal("85.0")  # ✅ ИСПРАВЛЕНО: 1 USD = 85 RUB (было 84.0)
+# Границы суммы обмена. Верхняя держит копейки в пределах INTEGER SQLite
+EXCHANGE_MIN_RUB = Decimal("100")
+EXCHANGE_MAX_RUB = Decimal("1000000")
 
 PREMIUM_PRICES = {
-    "3m": {"rub": 1124.11, "name": "3 месяца"},
-    "6m": {"rub": 1498.81, "name": "6 месяцев"}, 
-    "1y": {"rub": 2716.59, "name": "1 год"}
+    "3m": {"rub": Decimal("1124.11"), "name": "3 месяца"},
+    "6m": {"rub": Decimal("1498.81"), "name": "6 месяцев"}, 
+    "1y": {"rub": Decimal("2716.59"), "name": "1 год"}
 }
 
 REPUTATION_CHANNEL = "https://t.me/+3pbAABRgo1ljOTJi"
 NEWS_CHANNEL = "https://t.me/NewsDigistars"
 SUPPORT_USER = "swordSar"
 
+# ========== ДЕНЬГИ ==========
+# Суммы в коде - Decimal с точностью до копейки (цента), в базе - целые копейки
+CENT = Decimal("0.01")
+
+def to_money(value, rounding=ROUND_HALF_UP):
+    """Decimal, округленный до копеек. Float переводится через str, чтобы
+    не тащить двоичную погрешность (1124.11 -> 1124.11, а не 1124.1099...)"""
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    return value.quantize(CENT, rounding=rounding)
+
+def to_kop(amount):
+    """Сумма -> целые копейки для записи в базу"""
+    return None if amount is None else int(to_money(amount) * 100)
+
+def from_kop(kop):
+    """Целые копейки из базы -> Decimal"""
+    return None if kop is None else Decimal(kop).scaleb(-2)
+
+# ========== МЕТРИКИ ==========
+# Prometheus-метрики на отдельном локальном порту (0 - выключить)
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9101"))
+METRICS_PATH = os.environ.get("METRICS_PATH", "/metrics")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(names, values, extra=""):
+    """{a="1",b="2"} в формате Prometheus"""
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """Счетчик с метками. Обновляется только из event loop, без блокировок"""
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+    
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+    
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, format_labels(self.labelnames, labels), value
+
+class Histogram:
+    """Гистограмма с метками: счетчик на корзину и сумма.
+
+    observe - поиск корзины bisect'ом и два сложения, накопительные
+    значения le считаются только при выдаче /metrics.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}
+    
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            # [счетчики корзин..., +Inf, сумма]
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+    
+    def samples(self):
+        for labels, series in self._series.items():
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                total += count
+                yield self.name + "_bucket", format_labels(self.labelnames, labels, f'le="{bound}"'), total
+            yield self.name + "_sum", format_labels(self.labelnames, labels), series[-1]
+            yield self.name + "_count", format_labels(self.labelnames, labels), total
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+    
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+    
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+    
+    def render(self):
+        """Текстовый формат Prometheus 0.0.4"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+HANDLER_LATENCY = metrics.histogram(
+    "bot_handler_duration_seconds", "Время обработки апдейта (_count - число апдейтов)", ("handler",)
+)
+HANDLER_ERRORS = metrics.counter(
+    "bot_handler_errors_total", "Исключения в обработчиках", ("handler",)
+)
+DB_LATENCY = metrics.histogram(
+    "bot_db_call_duration_seconds", "Время вызова AsyncDatabase, включая ожидание потока", ("method",)
+)
+DB_WAIT = metrics.histogram(
+    "bot_db_queue_wait_seconds", "Ожидание свободного потока БД или группового коммита (конкуренция)", ("pool",)
+)
+DB_BATCH_SIZE = metrics.histogram(
+    "bot_db_commit_batch_size", "Записей в одной транзакции группового коммита",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200)
+)
+CACHE_REQUESTS = metrics.counter(
+    "bot_db_cache_requests_total", "Обращения к кэшу AsyncDatabase", ("cache", "result")
+)
+HTTP_LATENCY = metrics.histogram(
+    "bot_cryptobot_request_duration_seconds", "Время попытки запроса к Crypto Pay API", ("method", "status")
+)
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время и ошибки по имени обработчика (inner middleware message/callback_query)"""
+
+    async def __call__(self, handler, event, data):
+        target = resolve_handler(event, data)
+        name = target.__name__ if target else "unknown_callback"
+        
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - start, name)
+
+async def metrics_handler(request):
+    return web.Response(
+        body=metrics.render().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
 # ========== CRYPTOBOT ==========
+CRYPTOBOT_API_URL = os.environ.get("CRYPTOBOT_API_URL", "https://pay.crypt.bot/api")
+
+
+class CryptoBotError(Exception):
+    """Ошибка Crypto Pay API или сети"""
+
+
 class CryptoBotAPI:
-    def __init__(self, token):
+    # Статусы, при которых запрос имеет смысл повторить
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    # Без повтора по таймауту - только отказ до обработки запроса
+    REJECTED_STATUSES = {429}
+
+    def __init__(self, token, base_url=CRYPTOBOT_API_URL, connect_timeout=5, read_timeout=15,
+                 retries=3, backoff=0.5, pool_size=20):
         self.token = token
-        self.base_url = "https://pay.crypt.bot/api"
+        self.base_url = base_url.rstrip("/")
+        self.timeout = aiohttp.ClientTimeout(total=None, connect=connect_timeout, sock_read=read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self._session = None
+
+    def _get_session(self):
+        """Одна долгоживущая сессия с keep-alive пулом соединений"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers={"Crypto-Pay-API-Token": self.token}
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def _request(self, method, params=None, retry_on_timeout=True):
+        """Вызвать метод API с повторами и экспоненциальной задержкой.
+
+        retry_on_timeout=False для неидемпотентных методов: если ответ не
+        дочитан или сервер ответил 5xx, счет мог быть уже создан, и повтор
+        создаст дубль. Повторяются только 429 и ошибки соединения до
+        отправки запроса.
+        """
+        url = f"{self.base_url}/{method}"
+        retry_statuses = self.RETRY_STATUSES if retry_on_timeout else self.REJECTED_STATUSES
+        delay = self.backoff
+        error = "Unknown error"
+        
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            status = "error"
+            try:
+                async with self._get_session().post(url, json=params or {}) as response:
+                    status = response.status
+                    if response.status not in self.RETRY_STATUSES:
+                        result = await response.json(content_type=None)
+                        if result.get("ok"):
+                            return result["result"]
+                        raise CryptoBotError(result.get("error", {}).get("name", "Unknown error"))
+                    error = f"HTTP {response.status}"
+                    if response.status not in retry_statuses:
+                        raise CryptoBotError(error)
+            except aiohttp.ClientConnectorError as e:
+                error = str(e)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = str(e) or e.__class__.__name__
+                if not retry_on_timeout:
+                    raise CryptoBotError(error) from e
+            finally:
+                HTTP_LATENCY.observe(time.perf_counter() - start, method, status)
+            
+            if attempt < self.retries:
+                await asyncio.sleep(delay + random.uniform(0, delay / 2))
+                delay *= 2
+        
+        raise CryptoBotError(error)
     
-    async def create_invoice(self, amount, description=""):
+    async def create_invoice(self, amount, description="", usd_rate=USD_RATE):
         """Создать счет для оплаты"""
         try:
-            url = f"{self.base_url}/createInvoice"
-            headers = {"Crypto-Pay-API-Token": self.token}
-            
-            # Конвертируем рубли в USDT по курсу 85 RUB = 1 USDT
-            amount_usdt = amount / 85.0
+            # Конвертируем рубли в USDT по курсу заказа (1 USDT = usd_rate RUB),
+            # центы округляются вверх, чтобы счет покрывал всю сумму
+            amount_usdt = to_money(to_money(amount) / Decimal(str(usd_rate)), ROUND_UP)
             
             data = {
                 "asset": "USDT",
-                "amount": str(round(amount_usdt, 2)),
+                "amount": str(amount_usdt),
                 "description": description[:1024],
                 "paid_btn_name": "openBot",  # ✅ ИСПРАВЛЕНО
                 "paid_btn_url": "https://t.me/DigiStoreBot",
@@ -54,44 +307,234 @@ class CryptoBotAPI:
                 "allow_anonymous": False
             }
             
-            response = requests.post(url, json=data, headers=headers, timeout=30)
-            result = response.json()
-            
-            if result.get("ok"):
-                invoice = result["result"]
-                return {
-                    "success": True,
-                    "invoice_id": invoice["invoice_id"],
-                    "pay_url": invoice["pay_url"],
-                    "amount": invoice["amount"],
-                    "asset": invoice["asset"]
-                }
-            else:
-                return {"success": False, "error": result.get("error", {}).get("name", "Unknown error")}
+            invoice = await self._request("createInvoice", data, retry_on_timeout=False)
+            return {
+                "success": True,
+                "invoice_id": invoice["invoice_id"],
+                "pay_url": invoice["pay_url"],
+                "amount": invoice["amount"],
+                "asset": invoice["asset"]
+            }
                 
         except Exception as e:
             return {"success": False, "error": str(e)}
+    
+    async def get_invoices(self, invoice_ids=None, status=None, count=None):
+        """Получить счета (по списку invoice_id одним запросом)"""
+        params = {}
+        if invoice_ids:
+            params["invoice_ids"] = ",".join(str(i) for i in invoice_ids)
+        if status:
+            params["status"] = status
+        if count:
+            params["count"] = count
+        
+        result = await self._request("getInvoices", params)
+        return result.get("items", [])
+    
+    async def get_me(self):
+        """Проверить токен и получить данные приложения"""
+        return await self._request("getMe")
+    
+    async def get_exchange_rates(self):
+        """Курсы обмена: [{"source", "target", "rate", "is_valid", ...}]"""
+        return await self._request("getExchangeRates")
 
 # Инициализируем CryptoBot если есть токен
 cryptobot = CryptoBotAPI(CRYPTOBOT_TOKEN) if CRYPTOBOT_TOKEN else None
 
-# ========== БАЗА ДАННЫХ ==========
-class Database:
-    def __init__(self, db_name="digistore.db"):
-        self.conn = sqlite3.connect(db_name, check_same_thread=False)
-        self.create_tables()
+# ========== ЦЕНЫ ==========
+# static - курс USD_RATE из конфигурации, cryptobot - рыночный USDT/RUB
+RATE_SOURCE = os.environ.get("RATE_SOURCE", "static")
+# Наценка к рыночному курсу в процентах
+USD_RATE_MARKUP = Decimal(os.environ.get("USD_RATE_MARKUP", "0"))
+# Снимок старше RATE_TTL секунд считается устаревшим
+RATE_TTL = float(os.environ.get("RATE_TTL", "300"))
+RATE_REFRESH_INTERVAL = float(os.environ.get("RATE_REFRESH_INTERVAL", "60"))
+
+class PriceSnapshot:
+    """Неизменяемый набор цен, по которым оформляется заказ"""
+    __slots__ = ("star_rate", "usd_rate", "premium_prices", "fetched_at")
+
+    def __init__(self, star_rate, usd_rate, premium_prices, fetched_at):
+        self.star_rate = star_rate
+        self.usd_rate = usd_rate
+        self.premium_prices = premium_prices
+        self.fetched_at = fetched_at
+
+class StaticRateSource:
+    """Фиксированный курс: по умолчанию и для тестов без сети"""
+
+    def __init__(self, usd_rate=USD_RATE):
+        self.usd_rate = usd_rate
     
-    def create_tables(self):
-        cursor = self.conn.cursor()
-        
-        cursor.execute('''CREATE TABLE IF NOT EXISTS users (
+    async def get_usd_rate(self):
+        return self.usd_rate
+
+class CryptoBotRateSource:
+    """Курс USDT/RUB из getExchangeRates"""
+
+    def __init__(self, api, asset="USDT", fiat="RUB"):
+        self.api = api
+        self.asset = asset
+        self.fiat = fiat
+    
+    async def get_usd_rate(self):
+        for rate in await self.api.get_exchange_rates():
+            if rate.get("source") == self.asset and rate.get("target") == self.fiat and rate.get("is_valid"):
+                return Decimal(str(rate["rate"]))
+        raise CryptoBotError(f"Нет курса {self.asset}/{self.fiat}")
+
+class PricingService:
+    """Кэш цен с фоновым обновлением.
+
+    snapshot() не ходит в сеть: отдает текущий снимок, а если он старше
+    ttl, запускает обновление в фоне (stale-while-revalidate). При ошибке
+    источника продолжает работать последний удачный снимок.
+    """
+
+    def __init__(self, source, ttl=RATE_TTL, refresh_interval=RATE_REFRESH_INTERVAL,
+                 markup=USD_RATE_MARKUP):
+        self.source = source
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.markup = markup
+        self._snapshot = PriceSnapshot(STAR_RATE, USD_RATE, PREMIUM_PRICES, 0.0)
+        # После ошибки источника не дергать его на каждом запросе
+        self._retry_at = 0.0
+        self._refreshing = None
+        self._task = None
+    
+    def snapshot(self):
+        now = time.monotonic()
+        if now - self._snapshot.fetched_at > self.ttl and now >= self._retry_at:
+            if self._refreshing is None or self._refreshing.done():
+                self._refreshing = asyncio.create_task(self.refresh())
+        return self._snapshot
+    
+    async def refresh(self):
+        try:
+            usd_rate = Decimal(str(await self.source.get_usd_rate()))
+            if usd_rate <= 0:
+                raise ValueError(f"некорректный курс {usd_rate}")
+            self._snapshot = PriceSnapshot(
+                STAR_RATE,
+                (usd_rate * (1 + self.markup / 100)).quantize(Decimal("0.0001"), rounding=ROUND_HALF_UP),
+                PREMIUM_PRICES,
+                time.monotonic()
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._retry_at = time.monotonic() + min(self.ttl, self.refresh_interval)
+            logger.warning(f"Ошибка обновления курса: {e}")
+        return self._snapshot
+    
+    async def start(self, timeout=5):
+        """Дождаться первого курса (не дольше timeout) и запустить обновление"""
+        try:
+            await asyncio.wait_for(self.refresh(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Курс не получен при запуске, используется USD_RATE")
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        for task in (self._task, self._refreshing):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = None
+        self._refreshing = None
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            await self.refresh()
+
+pricing = PricingService(
+    CryptoBotRateSource(cryptobot) if RATE_SOURCE == "cryptobot" and cryptobot else StaticRateSource()
+)
+
+# ========== БАЗА ДАННЫХ ==========
+DB_SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS", "FULL")
+DB_CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", str(128 * 1024 * 1024)))
+# Окно группового коммита в мс (0 - каждая запись коммитится сама)
+GROUP_COMMIT_MS = float(os.environ.get("GROUP_COMMIT_MS", "0"))
+# Неоплаченный черновик (pending) без изменений дольше DRAFT_TTL секунд истекает
+DRAFT_TTL = float(os.environ.get("DRAFT_TTL", str(24 * 3600)))
+DRAFT_SWEEP_INTERVAL = float(os.environ.get("DRAFT_SWEEP_INTERVAL", "300"))
+DRAFT_SWEEP_BATCH = int(os.environ.get("DRAFT_SWEEP_BATCH", "500"))
+# Кэш заказов и известных пользователей в процессе (размер 0 - выключен)
+ORDER_CACHE_SIZE = int(os.environ.get("ORDER_CACHE_SIZE", "10000"))
+ORDER_CACHE_TTL = float(os.environ.get("ORDER_CACHE_TTL", "60"))
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "100000"))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", str(24 * 3600)))
+
+STATS_FIELDS = ("total_users", "completed_orders", "total_revenue_kop", "pending_orders")
+
+# Полный пересчет статистики (миграция и проверка согласованности)
+STATS_RECOMPUTE_SQL = """
+    SELECT
+        (SELECT COUNT(*) FROM users),
+        (SELECT COUNT(*) FROM orders WHERE status = 'completed'),
+        (SELECT COALESCE(SUM(amount_kop), 0) FROM orders WHERE status = 'completed'),
+        (SELECT COUNT(*) FROM orders WHERE status = 'pending')
+"""
+
+# Триггеры счетчиков stats по заказам (выручка в копейках, миграция 7)
+STATS_ORDER_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS trg_stats_orders_insert AFTER INSERT ON orders
+    BEGIN
+        UPDATE stats SET
+            completed_orders = completed_orders + (NEW.status = 'completed'),
+            total_revenue_kop = total_revenue_kop + CASE WHEN NEW.status = 'completed' THEN COALESCE(NEW.amount_kop, 0) ELSE 0 END,
+            pending_orders = pending_orders + (NEW.status = 'pending')
+        WHERE id = 1;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_stats_orders_delete AFTER DELETE ON orders
+    BEGIN
+        UPDATE stats SET
+            completed_orders = completed_orders - (OLD.status = 'completed'),
+            total_revenue_kop = total_revenue_kop - CASE WHEN OLD.status = 'completed' THEN COALESCE(OLD.amount_kop, 0) ELSE 0 END,
+            pending_orders = pending_orders - (OLD.status = 'pending')
+        WHERE id = 1;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_stats_orders_update AFTER UPDATE OF status, amount_kop ON orders
+    BEGIN
+        UPDATE stats SET
+            completed_orders = completed_orders - (OLD.status = 'completed') + (NEW.status = 'completed'),
+            total_revenue_kop = total_revenue_kop
+                - CASE WHEN OLD.status = 'completed' THEN COALESCE(OLD.amount_kop, 0) ELSE 0 END
+                + CASE WHEN NEW.status = 'completed' THEN COALESCE(NEW.amount_kop, 0) ELSE 0 END,
+            pending_orders = pending_orders - (OLD.status = 'pending') + (NEW.status = 'pending')
+        WHERE id = 1;
+    END'''
+]
+
+# Параметры, по которым совпадают черновики: столбцы idx_orders_draft
+# (миграция 8), ON CONFLICT в add_order должен совпадать с ними. NULL в
+# уникальном индексе не равен NULL, поэтому необязательные поля через COALESCE
+DRAFT_KEY = (
+    "user_id, order_type, recipient, COALESCE(stars, 0), COALESCE(period, ''), "
+    "amount_kop, COALESCE(amount_usd_cents, 0)"
+)
+
+# Миграции схемы: (версия, [SQL или функция(conn), ...]), строго по возрастанию.
+# Уже примененные миграции не менять - только добавлять новые в конец.
+MIGRATIONS = [
+    (1, [
+        '''CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
             full_name TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )''')
-        
-        cursor.execute('''CREATE TABLE IF NOT EXISTS orders (
+        )''',
+        '''CREATE TABLE IF NOT EXISTS orders (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
             order_type TEXT,
@@ -102,9 +545,298 @@ class Database:
             status TEXT DEFAULT 'pending',
             invoice_id TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )''')
-        
-        self.conn.commit()
+        )'''
+    ]),
+    (2, [
+        # Админка и статистика: WHERE status = ? ORDER BY created_at
+        "CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders (status, created_at)",
+        # Заказы пользователя
+        "CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders (user_id, created_at)",
+        # Поиск заказа по счету CryptoBot (вебхук)
+        "CREATE INDEX IF NOT EXISTS idx_orders_invoice ON orders (invoice_id)"
+    ]),
+    (3, [
+        # Счетчики статистики обновляются триггерами в той же транзакции,
+        # что и запись, поэтому get_statistics - чтение одной строки
+        '''CREATE TABLE IF NOT EXISTS stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_users INTEGER NOT NULL DEFAULT 0,
+            completed_orders INTEGER NOT NULL DEFAULT 0,
+            total_revenue REAL NOT NULL DEFAULT 0,
+            pending_orders INTEGER NOT NULL DEFAULT 0
+        )''',
+        # Выручка в рублях по amount_rub (с миграции 7 - в копейках)
+        '''INSERT OR REPLACE INTO stats (id, total_users, completed_orders, total_revenue, pending_orders)
+        SELECT 1,
+            (SELECT COUNT(*) FROM users),
+            (SELECT COUNT(*) FROM orders WHERE status = 'completed'),
+            (SELECT COALESCE(SUM(amount_rub), 0) FROM orders WHERE status = 'completed'),
+            (SELECT COUNT(*) FROM orders WHERE status = 'pending')''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_stats_users_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE stats SET total_users = total_users + 1 WHERE id = 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_stats_users_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE stats SET total_users = total_users - 1 WHERE id = 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_stats_orders_insert AFTER INSERT ON orders
+        BEGIN
+            UPDATE stats SET
+                completed_orders = completed_orders + (NEW.status = 'completed'),
+                total_revenue = total_revenue + CASE WHEN NEW.status = 'completed' THEN COALESCE(NEW.amount_rub, 0) ELSE 0 END,
+                pending_orders = pending_orders + (NEW.status = 'pending')
+            WHERE id = 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_stats_orders_delete AFTER DELETE ON orders
+        BEGIN
+            UPDATE stats SET
+                completed_orders = completed_orders - (OLD.status = 'completed'),
+                total_revenue = total_revenue - CASE WHEN OLD.status = 'completed' THEN COALESCE(OLD.amount_rub, 0) ELSE 0 END,
+                pending_orders = pending_orders - (OLD.status = 'pending')
+            WHERE id = 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_stats_orders_update AFTER UPDATE OF status, amount_rub ON orders
+        BEGIN
+            UPDATE stats SET
+                completed_orders = completed_orders - (OLD.status = 'completed') + (NEW.status = 'completed'),
+                total_revenue = total_revenue
+                    - CASE WHEN OLD.status = 'completed' THEN COALESCE(OLD.amount_rub, 0) ELSE 0 END
+                    + CASE WHEN NEW.status = 'completed' THEN COALESCE(NEW.amount_rub, 0) ELSE 0 END,
+                pending_orders = pending_orders - (OLD.status = 'pending') + (NEW.status = 'pending')
+            WHERE id = 1;
+        END'''
+    ]),
+    (4, [
+        # Состояния диалогов (SQLiteStateStore)
+        '''CREATE TABLE IF NOT EXISTS user_states (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_user_states_expires ON user_states (expires_at)"
+    ]),
+    (5, [
+        # Transactional outbox: уведомления пишутся в одной транзакции со
+        # сменой статуса заказа и рассылаются OutboxSender. Отправленные
+        # строки удаляются, неотправляемые остаются со статусом dead.
+        '''CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            calls TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            claim_token TEXT,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)"
+    ]),
+    (6, [
+        # Курс RUB/USD, по которому оформлен заказ (NULL у старых заказов)
+        "ALTER TABLE orders ADD COLUMN usd_rate REAL"
+    ]),
+    (7, [
+        # Деньги в целых копейках: точные суммы и целочисленная выручка.
+        # amount_rub остается для старых версий, но больше не пишется
+        "ALTER TABLE orders ADD COLUMN amount_kop INTEGER",
+        "UPDATE orders SET amount_kop = CAST(ROUND(amount_rub * 100) AS INTEGER) WHERE amount_rub IS NOT NULL",
+        "DROP TRIGGER IF EXISTS trg_stats_orders_insert",
+        "DROP TRIGGER IF EXISTS trg_stats_orders_delete",
+        "DROP TRIGGER IF EXISTS trg_stats_orders_update",
+        "DROP TABLE IF EXISTS stats",
+        '''CREATE TABLE stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_users INTEGER NOT NULL DEFAULT 0,
+            completed_orders INTEGER NOT NULL DEFAULT 0,
+            total_revenue_kop INTEGER NOT NULL DEFAULT 0,
+            pending_orders INTEGER NOT NULL DEFAULT 0
+        )''',
+        "INSERT INTO stats (id, " + ", ".join(STATS_FIELDS) + ") "
+        "SELECT 1, * FROM (" + STATS_RECOMPUTE_SQL + ")",
+        *STATS_ORDER_TRIGGERS
+    ]),
+    (8, [
+        # Черновики: pending-заказ с теми же параметрами (DRAFT_KEY) один,
+        # повторный ввод обновляет его (Database.add_order), а ввод другой
+        # суммы или получателя создает новый - кнопки оплаты в старом
+        # сообщении оплачивают то, что в нем написано. Параметры ключа
+        # нужны индексу сразу, поэтому колонки добавляются здесь.
+        "ALTER TABLE orders ADD COLUMN updated_at TIMESTAMP",
+        "UPDATE orders SET updated_at = created_at",
+        "ALTER TABLE orders ADD COLUMN stars INTEGER",
+        "ALTER TABLE orders ADD COLUMN period TEXT",
+        "ALTER TABLE orders ADD COLUMN amount_usd_cents INTEGER",
+        '''UPDATE orders SET
+            stars = json_extract(details, '$.stars'),
+            period = json_extract(details, '$.period'),
+            amount_usd_cents = CAST(ROUND(json_extract(details, '$.amount_usd') * 100) AS INTEGER)
+        WHERE json_valid(details)''',
+        # Полные копии одного черновика (раньше каждый ввод вставлял новую
+        # строку) не пройдут уникальный индекс: остается последняя копия
+        f"""UPDATE orders SET status = 'expired'
+        WHERE status = 'pending' AND id NOT IN (
+            SELECT MAX(id) FROM orders WHERE status = 'pending' GROUP BY {DRAFT_KEY}
+        )""",
+        f"CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_draft ON orders ({DRAFT_KEY}) WHERE status = 'pending'"
+    ]),
+    (9, [
+        # Параметры заказа - отдельные типизированные колонки вместо JSON в
+        # details (details остается у старых заказов, stars, period и
+        # amount_usd_cents добавила миграция 8). Курс обмена - usd_rate.
+        "ALTER TABLE orders ADD COLUMN payment_photo TEXT",
+        '''UPDATE orders SET
+            payment_photo = json_extract(details, '$.payment_photo'),
+            usd_rate = COALESCE(usd_rate, json_extract(details, '$.exchange_rate'))
+        WHERE json_valid(details)'''
+    ]),
+    (10, [
+        # Неотправленное уведомление с тем же ключом заменяется новым
+        # (Database._add_outbox): покупатель получает только последний статус
+        "ALTER TABLE outbox ADD COLUMN dedupe_key TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_outbox_dedupe ON outbox (dedupe_key) WHERE dedupe_key IS NOT NULL"
+    ]),
+    (11, [
+        # Способ оплаты записывается при выборе (раньше всегда оставался
+        # 'card'). Счет CryptoBot есть только у заказов, оплачиваемых криптой.
+        "UPDATE orders SET payment_method = 'crypto' WHERE invoice_id IS NOT NULL"
+    ])
+]
+
+# Машина состояний заказа: целевой статус -> статусы, из которых в него можно
+# перейти. Переход - условный UPDATE ... WHERE status IN (...), поэтому
+# гонки между обработчиками и процессами решает сама база, без блокировок.
+ORDER_TRANSITIONS = {
+    # Выбрана оплата картой (повторное нажатие ничего не ломает)
+    "waiting_payment": ("pending", "waiting_payment"),
+    # Выставлен счет CryptoBot
+    "waiting_crypto": ("pending", "waiting_payment"),
+    # Прислано фото оплаты
+    "waiting_confirmation": ("pending", "waiting_payment"),
+    # Подтверждение админом (оплата CryptoBot - только из waiting_crypto)
+    "completed": ("pending", "waiting_payment", "waiting_crypto", "waiting_confirmation"),
+    "cancelled": ("pending", "waiting_payment", "waiting_crypto", "waiting_confirmation"),
+    # Брошенный черновик или истекший счет
+    "expired": ("pending", "waiting_crypto")
+}
+
+# Массовая смена статуса (bulk_update_status) строже поштучной: пачкой
+# выполняются только заказы с фото оплаты на проверке, а не черновики и
+# неоплаченные счета - их админ подтверждает по одному после проверки
+BULK_TRANSITIONS = {**ORDER_TRANSITIONS, "completed": ("waiting_confirmation",)}
+
+class OrderRecord:
+    """Заказ, разобранный из строки один раз: суммы - Decimal, без JSON.
+
+    Общий для всех обработчиков, менять поля нельзя.
+    """
+    __slots__ = (
+        "id", "user_id", "order_type", "recipient", "amount_rub", "payment_method", "status",
+        "invoice_id", "stars", "period", "amount_usd", "usd_rate", "payment_photo", "created_at"
+    )
+
+    COLUMNS = (
+        "id, user_id, order_type, recipient, amount_kop, payment_method, status, invoice_id, "
+        "stars, period, amount_usd_cents, usd_rate, payment_photo, created_at"
+    )
+
+    def __init__(self, row):
+        (self.id, self.user_id, self.order_type, self.recipient, amount_kop, self.payment_method,
+         self.status, self.invoice_id, self.stars, self.period, amount_usd_cents, usd_rate,
+         self.payment_photo, self.created_at) = row
+        self.amount_rub = from_kop(amount_kop)
+        self.amount_usd = from_kop(amount_usd_cents)
+        self.usd_rate = None if usd_rate is None else Decimal(str(usd_rate))
+        if self.amount_usd is None and self.order_type == "exchange" and self.amount_rub is not None:
+            self.amount_usd = to_money(self.amount_rub / (self.usd_rate or USD_RATE))
+
+class Database:
+    def __init__(self, db_name="digistore.db"):
+        self.db_name = db_name
+        self._local = threading.local()
+        self.migrate()
+    
+    @property
+    def conn(self):
+        """Соединение текущего потока: у каждого потока AsyncDatabase свое"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_name, timeout=30)
+            # WAL: читатели не блокируют писателя и наоборот
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+            conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+            conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            self._local.conn = conn
+        return conn
+    
+    def commit(self):
+        """Зафиксировать транзакцию, если запись не идет в составе группы"""
+        if not getattr(self._local, "batch", False):
+            self.conn.commit()
+    
+    def rollback(self):
+        """Откатить транзакцию. В группе откат делает run_batch через SAVEPOINT"""
+        if not getattr(self._local, "batch", False):
+            self.conn.rollback()
+    
+    def run_batch(self, calls):
+        """Выполнить несколько записей одной транзакцией (групповой коммит).
+
+        calls: [(method_name, args, kwargs), ...]. Каждый вызов изолирован
+        SAVEPOINT-ом, поэтому ошибка одного не откатывает остальные.
+        Возвращает [(ok, result_or_exception), ...] в том же порядке.
+        """
+        conn = self.conn
+        results = []
+        self._local.batch = True
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for name, args, kwargs in calls:
+                conn.execute("SAVEPOINT batch_op")
+                try:
+                    result = getattr(self, name)(*args, **kwargs)
+                    conn.execute("RELEASE batch_op")
+                    results.append((True, result))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO batch_op")
+                    conn.execute("RELEASE batch_op")
+                    results.append((False, e))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._local.batch = False
+        return results
+    
+    def migrate(self):
+        """Применить недостающие миграции из MIGRATIONS.
+
+        Версия схемы хранится в PRAGMA user_version. Каждая миграция идет
+        отдельной транзакцией, версия перечитывается под блокировкой, так что
+        два процесса не применят одну миграцию дважды.
+        """
+        conn = self.conn
+        for version, statements in MIGRATIONS:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                current = conn.execute("PRAGMA user_version").fetchone()[0]
+                if current >= version:
+                    conn.rollback()
+                    continue
+                for statement in statements:
+                    if callable(statement):
+                        statement(conn)
+                    else:
+                        conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
     
     def add_user(self, user_id, username, full_name):
         cursor = self.conn.cursor()
@@ -112,98 +844,1274 @@ class Database:
             "INSERT OR IGNORE INTO users (user_id, username, full_name) VALUES (?, ?, ?)",
             (user_id, username, full_name)
         )
-        self.conn.commit()
+        self.commit()
     
-    def add_order(self, user_id, order_type, recipient, details, amount_rub, payment_method, invoice_id=None):
+    def add_order(self, user_id, order_type, recipient, details, amount_rub, payment_method,
+                  invoice_id=None, usd_rate=None, stars=None, period=None, amount_usd=None):
+        """Создать черновик заказа (pending) или вернуть открытый с теми же
+        параметрами.
+
+        Черновики уникальны по DRAFT_KEY (idx_orders_draft): повторный ввод
+        тех же данных возвращает тот же id, другие данные - новый черновик,
+        а старый остается как был. amount_rub - Decimal, хранится в копейках.
+        """
         cursor = self.conn.cursor()
         cursor.execute(
-            """INSERT INTO orders 
-            (user_id, order_type, recipient, details, amount_rub, payment_method, invoice_id) 
-            VALUES (?, ?, ?, ?, ?, ?, ?)""",
-            (user_id, order_type, recipient, details, amount_rub, payment_method, invoice_id)
+            f"""INSERT INTO orders 
+            (user_id, order_type, recipient, details, amount_kop, payment_method, invoice_id, usd_rate,
+             stars, period, amount_usd_cents, updated_at) 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT ({DRAFT_KEY}) WHERE status = 'pending' DO UPDATE SET
+                updated_at = CURRENT_TIMESTAMP""",
+            (user_id, order_type, recipient, details, to_kop(amount_rub), payment_method, invoice_id,
+             None if usd_rate is None else str(usd_rate), stars, period, to_kop(amount_usd))
+        )
+        cursor.execute(
+            """SELECT id FROM orders
+            WHERE user_id = ? AND order_type = ? AND recipient = ? AND stars IS ? AND period IS ?
+                AND amount_kop = ? AND amount_usd_cents IS ? AND status = 'pending'""",
+            (user_id, order_type, recipient, stars, period, to_kop(amount_rub), to_kop(amount_usd))
         )
-        order_id = cursor.lastrowid
-        self.conn.commit()
+        order_id = cursor.fetchone()[0]
+        self.commit()
         return order_id
     
-    def update_order_status(self, order_id, status):
-        cursor = self.conn.cursor()
+    def _transition(self, cursor, order_id, status, sources, **fields):
+        """Условный переход: UPDATE сработает, только если заказ все еще в
+        одном из sources. fields - дополнительные колонки (не None).
+        Возвращает (перешел ли, статус заказа после попытки или None)"""
+        fields = {name: value for name, value in fields.items() if value is not None}
+        assignments = "".join(f", {name} = ?" for name in fields)
         cursor.execute(
-            "UPDATE orders SET status = ? WHERE id = ?",
-            (status, order_id)
+            f"""UPDATE orders SET status = ?, updated_at = CURRENT_TIMESTAMP{assignments}
+            WHERE id = ? AND status IN ({", ".join("?" * len(sources))})""",
+            (status, *fields.values(), order_id, *sources)
         )
-        self.conn.commit()
-        return cursor.rowcount > 0
+        if cursor.rowcount > 0:
+            return True, status
+        
+        cursor.execute("SELECT status FROM orders WHERE id = ?", (order_id,))
+        row = cursor.fetchone()
+        return False, row[0] if row else None
     
-    def update_invoice_id(self, order_id, invoice_id):
+    def update_order_status(self, order_id, status, outbox=None, invoice_id=None, usd_rate=None,
+                            payment_method=None):
+        """Перевести заказ в status по ORDER_TRANSITIONS.
+
+        outbox - уведомления, которые запишутся в той же транзакции, только
+        при успешном переходе. invoice_id и usd_rate сохраняются вместе со
+        статусом (счет CryptoBot), payment_method - выбранный способ оплаты.
+        Возвращает (перешел ли, текущий статус); текущий статус None - заказа нет.
+        """
         cursor = self.conn.cursor()
-        cursor.execute(
-            "UPDATE orders SET invoice_id = ? WHERE id = ?",
-            (invoice_id, order_id)
+        changed, current = self._transition(
+            cursor, order_id, status, ORDER_TRANSITIONS[status],
+            invoice_id=invoice_id, usd_rate=None if usd_rate is None else str(usd_rate),
+            payment_method=payment_method
+        )
+        if changed and outbox:
+            self._add_outbox(cursor, outbox)
+        self.commit()
+        return changed, current
+    
+    def submit_payment_photo(self, order_id, file_id, outbox=None):
+        """Сохранить photo_file_id, перевести заказ в waiting_confirmation
+        и записать уведомления - одной транзакцией. Результат как у
+        update_order_status"""
+        cursor = self.conn.cursor()
+        changed, current = self._transition(
+            cursor, order_id, "waiting_confirmation", ORDER_TRANSITIONS["waiting_confirmation"],
+            payment_photo=file_id
         )
-        self.conn.commit()
+        if changed and outbox:
+            self._add_outbox(cursor, outbox)
+        self.commit()
+        return changed, current
+    
+    def get_orders_page(self, status, limit=10, cursor=None, direction="next",
+                        order_type=None, payment_method=None):
+        """Страница заказов с пагинацией по ключу (created_at, id), новые сверху.
+
+        cursor - id заказа на границе текущей страницы: next листает к более
+        старым, prev - к более новым. Запрос ограничен LIMIT и идет по индексу
+        (status, created_at), без OFFSET.
+        Возвращает (rows, has_prev, has_next).
+        """
+        conditions = ["status = ?"]
+        params = [status]
+        
+        if order_type:
+            conditions.append("order_type = ?")
+            params.append(order_type)
+        if payment_method:
+            conditions.append("payment_method = ?")
+            params.append(payment_method)
+        
+        forward = direction == "next"
+        if cursor:
+            op = "<" if forward else ">"
+            conditions.append(f"(created_at, id) {op} (SELECT created_at, id FROM orders WHERE id = ?)")
+            params.append(cursor)
+        
+        order = "DESC" if forward else "ASC"
+        params.append(limit + 1)
+        
+        db_cursor = self.conn.cursor()
+        db_cursor.execute(f"""
+            SELECT id, user_id, order_type, recipient, amount_kop, payment_method, created_at
+            FROM orders
+            WHERE {" AND ".join(conditions)}
+            ORDER BY created_at {order}, id {order}
+            LIMIT ?
+        """, params)
+        rows = [row[:4] + (from_kop(row[4]),) + row[5:] for row in db_cursor.fetchall()]
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        
+        if forward:
+            return rows, bool(cursor), has_more
+        rows.reverse()
+        return rows, has_more, True
     
-    def add_payment_photo(self, order_id, file_id):
-        """Сохранить photo_file_id в details заказа"""
+    def get_order(self, order_id):
+        """OrderRecord или None"""
+        cursor = self.conn.cursor()
+        cursor.execute(f"SELECT {OrderRecord.COLUMNS} FROM orders WHERE id = ?", (order_id,))
+        row = cursor.fetchone()
+        return OrderRecord(row) if row else None
+    
+    def get_orders(self, order_ids):
+        """{order_id: OrderRecord} для существующих из order_ids - одним
+        запросом (список передается одним JSON-параметром)"""
         cursor = self.conn.cursor()
         cursor.execute(
-            "UPDATE orders SET details = json_set(details, '$.payment_photo', ?) WHERE id = ?",
-            (file_id, order_id)
+            f"SELECT {OrderRecord.COLUMNS} FROM orders WHERE id IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(order_ids)),)
         )
-        self.conn.commit()
-        return cursor.rowcount > 0
+        return {order.id: order for order in map(OrderRecord, cursor.fetchall())}
     
-    def get_pending_orders(self):
+    def get_crypto_waiting_orders(self):
+        """Заказы, ожидающие оплаты в CryptoBot: [(order_id, invoice_id), ...]"""
         cursor = self.conn.cursor()
         cursor.execute("""
-            SELECT id, user_id, order_type, recipient, amount_rub, payment_method, created_at 
-            FROM orders 
-            WHERE status = 'pending' 
-            ORDER BY created_at DESC
+            SELECT id, invoice_id FROM orders
+            WHERE status = 'waiting_crypto' AND invoice_id IS NOT NULL
         """)
         return cursor.fetchall()
     
-    def get_order(self, order_id):
+    def apply_invoice_statuses(self, updates, outbox=None, lost_outbox=None):
+        """Применить статусы счетов одной транзакцией.
+
+        updates: [(order_id, status), ...]. Меняются только заказы, которые
+        все еще в waiting_crypto. outbox: {order_id: уведомления} - пишутся
+        только для реально обновленных заказов. lost_outbox - уведомления
+        на случай, когда счет оплачен, а заказ уже ушел в другой статус
+        (например, админ отменил его до оплаты): деньги получены, заказ нет.
+        Возвращает [(order_id, перешел ли, текущий статус или None), ...].
+        """
+        results = []
+        outbox = outbox or {}
+        lost_outbox = lost_outbox or {}
         cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id 
-            FROM orders WHERE id = ?
-        """, (order_id,))
-        return cursor.fetchone()
+        try:
+            for order_id, status in updates:
+                changed, current = self._transition(cursor, order_id, status, ("waiting_crypto",))
+                results.append((order_id, changed, current))
+                if changed:
+                    messages = outbox.get(order_id)
+                elif status == "completed" and current not in (None, "completed"):
+                    messages = lost_outbox.get(order_id)
+                else:
+                    messages = None
+                if messages:
+                    self._add_outbox(cursor, messages)
+            self.commit()
+        except Exception:
+            self.rollback()
+            raise
+        return results
+    
+    def bulk_update_status(self, order_ids, status, outbox=None):
+        """Перевести несколько заказов в status одной транзакцией.
+
+        Каждый заказ проверяется по BULK_TRANSITIONS отдельно: запрещенный
+        переход пропускает только его. outbox: {order_id: уведомления} -
+        пишутся только для реально обновленных заказов.
+        Возвращает [(order_id, перешел ли, текущий статус или None), ...].
+        """
+        results = []
+        outbox = outbox or {}
+        cursor = self.conn.cursor()
+        try:
+            for order_id in order_ids:
+                changed, current = self._transition(cursor, order_id, status, BULK_TRANSITIONS[status])
+                results.append((order_id, changed, current))
+                if changed and outbox.get(order_id):
+                    self._add_outbox(cursor, outbox[order_id])
+            self.commit()
+        except Exception:
+            self.rollback()
+            raise
+        return results
+    
+    def get_order_id_by_invoice(self, invoice_id):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT id FROM orders WHERE invoice_id = ?", (str(invoice_id),))
+        row = cursor.fetchone()
+        return row[0] if row else None
+    
+    def _read_stats(self):
+        cursor = self.conn.cursor()
+        cursor.execute(f"SELECT {', '.join(STATS_FIELDS)} FROM stats WHERE id = 1")
+        return dict(zip(STATS_FIELDS, cursor.fetchone()))
     
     def get_statistics(self):
+        """Счетчики из таблицы stats, их поддерживают триггеры (миграции 3, 7).
+
+        review_orders (фото оплаты на проверке) - не счетчик, а COUNT по
+        idx_orders_status_created: таких заказов единицы, диапазон индекса короткий.
+        """
+        stats = self._read_stats()
         cursor = self.conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM orders WHERE status = 'waiting_confirmation'")
         
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
+        return {
+            "total_users": stats["total_users"],
+            "completed_orders": stats["completed_orders"],
+            "total_revenue": from_kop(stats["total_revenue_kop"]),
+            "pending_orders": stats["pending_orders"],
+            "review_orders": cursor.fetchone()[0]
+        }
+    
+    def check_statistics(self, repair=False):
+        """Пересчитать статистику с нуля и сравнить со счетчиками.
+
+        Возвращает {имя: (в stats, фактически)} только для расхождений.
+        С repair=True счетчики перезаписываются фактическими значениями.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(STATS_RECOMPUTE_SQL)
+        actual = dict(zip(STATS_FIELDS, cursor.fetchone()))
+        stored = self._read_stats()
         
-        cursor.execute("SELECT COUNT(*) FROM orders WHERE status = 'completed'")
-        completed_orders = cursor.fetchone()[0]
+        drift = {}
+        for name in STATS_FIELDS:
+            if stored[name] != actual[name]:
+                drift[name] = (stored[name], actual[name])
         
-        cursor.execute("SELECT SUM(amount_rub) FROM orders WHERE status = 'completed'")
-        total_revenue = cursor.fetchone()[0] or 0
+        if drift and repair:
+            cursor.execute(
+                "UPDATE stats SET total_users = ?, completed_orders = ?, total_revenue_kop = ?, pending_orders = ? WHERE id = 1",
+                tuple(actual[name] for name in STATS_FIELDS)
+            )
+            self.commit()
         
-        cursor.execute("SELECT COUNT(*) FROM orders WHERE status = 'pending'")
-        pending_orders = cursor.fetchone()[0]
+        return drift
+
+    def _add_outbox(self, cursor, messages):
+        """Записать уведомления [(chat_id, calls, dedupe_key), ...] в текущей
+        транзакции. Еще не отправленные строки с тем же dedupe_key удаляются,
+        так что несколько переходов одного заказа схлопываются в одно"""
+        cursor.executemany(
+            "DELETE FROM outbox WHERE dedupe_key = ? AND status = 'pending'",
+            [(dedupe_key,) for _, _, dedupe_key in messages if dedupe_key is not None]
+        )
+        cursor.executemany(
+            "INSERT INTO outbox (chat_id, calls, dedupe_key) VALUES (?, ?, ?)",
+            [(chat_id, json.dumps(calls), dedupe_key) for chat_id, calls, dedupe_key in messages]
+        )
+    
+    def claim_outbox(self, now, limit, lease, chat_limit=None, skip_chats=()):
+        """Забрать до limit готовых к отправке уведомлений.
+
+        Строки помечаются claim_token одним UPDATE и откладываются на lease
+        секунд, поэтому несколько процессов не возьмут одну строку, а строки
+        упавшего процесса снова станут доступны по истечении lease.
+        chat_limit - не больше строк одного чата, skip_chats - чаты, строки
+        которых еще отправляются (их не берем, чтобы не нарушить порядок).
+        """
+        token = uuid.uuid4().hex
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            UPDATE outbox SET claim_token = ?, attempts = attempts + 1, next_attempt_at = ?
+            WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY id) AS chat_position
+                    FROM outbox
+                    WHERE status = 'pending' AND next_attempt_at <= ?
+                        AND chat_id NOT IN (SELECT value FROM json_each(?))
+                )
+                WHERE chat_position <= ?
+                ORDER BY id LIMIT ?
+            )
+        """, (token, now + lease, now, json.dumps(list(skip_chats)), chat_limit or limit, limit))
+        self.commit()
         
-        return {
-            "total_users": total_users,
-            "completed_orders": completed_orders,
-            "total_revenue": total_revenue,
-            "pending_orders": pending_orders
-        }
+        cursor.execute(
+            "SELECT id, chat_id, calls, attempts FROM outbox WHERE claim_token = ? ORDER BY id",
+            (token,)
+        )
+        return cursor.fetchall()
+    
+    def finish_outbox(self, sent_ids, failed):
+        """Удалить отправленные. failed: [(id, error, next_attempt_at, dead), ...]"""
+        cursor = self.conn.cursor()
+        cursor.executemany("DELETE FROM outbox WHERE id = ?", [(outbox_id,) for outbox_id in sent_ids])
+        cursor.executemany(
+            """UPDATE outbox SET status = ?, last_error = ?, next_attempt_at = ?, claim_token = NULL
+            WHERE id = ?""",
+            [("dead" if dead else "pending", error, next_attempt_at, outbox_id)
+             for outbox_id, error, next_attempt_at, dead in failed]
+        )
+        self.commit()
+    
+    def get_state(self, user_id, now, expires_at):
+        """Состояние, если оно не истекло к now; срок продлевается до expires_at"""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "UPDATE user_states SET expires_at = ? WHERE user_id = ? AND expires_at > ? RETURNING data",
+            (expires_at, user_id, now)
+        )
+        row = cursor.fetchone()
+        self.commit()
+        return json.loads(row[0]) if row else None
+    
+    def set_state(self, user_id, data, expires_at):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "INSERT OR REPLACE INTO user_states (user_id, data, expires_at) VALUES (?, ?, ?)",
+            (user_id, json.dumps(data), expires_at)
+        )
+        self.commit()
+    
+    def delete_state(self, user_id):
+        cursor = self.conn.cursor()
+        cursor.execute("DELETE FROM user_states WHERE user_id = ?", (user_id,))
+        self.commit()
+    
+    def evict_states(self, now, max_size):
+        """Удалить истекшие состояния и самые старые сверх max_size"""
+        cursor = self.conn.cursor()
+        cursor.execute("DELETE FROM user_states WHERE expires_at <= ?", (now,))
+        removed = cursor.rowcount
+        
+        cursor.execute("SELECT COUNT(*) FROM user_states")
+        overflow = cursor.fetchone()[0] - max_size
+        if overflow > 0:
+            cursor.execute("""
+                DELETE FROM user_states WHERE user_id IN (
+                    SELECT user_id FROM user_states ORDER BY expires_at LIMIT ?
+                )
+            """, (overflow,))
+            removed += cursor.rowcount
+        
+        self.commit()
+        return removed
+    
+    def expire_drafts(self, ttl, limit):
+        """Перевести в expired не больше limit черновиков, не менявшихся ttl
+        секунд. Возвращает их число - если равно limit, остались еще.
+        Черновики ищутся по idx_orders_status_created (status = 'pending')"""
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            UPDATE orders SET status = 'expired', updated_at = CURRENT_TIMESTAMP
+            WHERE id IN (
+                SELECT id FROM orders
+                WHERE status = 'pending' AND updated_at < datetime('now', ?)
+                LIMIT ?
+            )
+        """, (f"-{int(ttl)} seconds", limit))
+        expired = cursor.rowcount
+        self.commit()
+        return expired
+
+class LRUCache:
+    """LRU с TTL и ограничением размера для кэша AsyncDatabase.
+
+    TTL отсчитывается от записи и не продлевается при чтении: он
+    ограничивает устаревание, если базу меняет другой процесс.
+    generation растет при каждой инвалидации - чтение, начатое до
+    записи, не должно положить в кэш уже устаревшее значение.
+    """
+
+    def __init__(self, name, max_size, ttl):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.generation = 0
+        self._data = OrderedDict()
+    
+    def get(self, key):
+        item = self._data.get(key)
+        if item is not None and item[0] <= time.monotonic():
+            del self._data[key]
+            item = None
+        
+        if item is None:
+            CACHE_REQUESTS.inc(self.name, "miss")
+            return None
+        
+        self._data.move_to_end(key)
+        CACHE_REQUESTS.inc(self.name, "hit")
+        return item[1]
+    
+    def set(self, key, value, generation=None):
+        if self.max_size <= 0 or generation is not None and generation != self.generation:
+            return
+        
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+    
+    def invalidate(self, keys=None):
+        """Удалить ключи (None - весь кэш)"""
+        self.generation += 1
+        if keys is None:
+            self._data.clear()
+            return
+        for key in keys:
+            self._data.pop(key, None)
+
+
+class AsyncDatabase:
+    """Асинхронная обертка над Database, не блокирующая event loop.
+
+    Методы и сигнатуры те же, что у Database, но вызываются через await.
+    Все записи выполняются в одном выделенном потоке-писателе, чтение -
+    в небольшом пуле потоков, у каждого свое соединение.
+
+    get_order и add_user обслуживаются из кэша в памяти; записи из
+    ORDER_WRITES сбрасывают затронутые заказы. get_order отдает общий
+    OrderRecord - менять его поля нельзя.
+    """
+
+    READ_METHODS = {
+        "get_order",
+        "get_orders",
+        "get_order_id_by_invoice",
+        "get_orders_page",
+        "get_crypto_waiting_orders",
+        "get_statistics"
+    }
+
+    # Записи, меняющие заказы: метод -> id затронутых заказов по аргументам
+    # и результату. None - какие именно, неизвестно, кэш сбрасывается целиком
+    ORDER_WRITES = {
+        "add_order": lambda args, kwargs, result: (result,),
+        "update_order_status": lambda args, kwargs, result: (args[0] if args else kwargs["order_id"],),
+        "submit_payment_photo": lambda args, kwargs, result: (args[0] if args else kwargs["order_id"],),
+        "apply_invoice_statuses": lambda args, kwargs, result: [
+            order_id for order_id, changed, _ in result if changed
+        ],
+        "bulk_update_status": lambda args, kwargs, result: [order_id for order_id, *_ in result],
+        "expire_drafts": lambda args, kwargs, result: None if result else ()
+    }
+
+    def __init__(self, database, readers=4, group_commit_ms=0, max_batch=200,
+                 order_cache_size=ORDER_CACHE_SIZE, order_cache_ttl=ORDER_CACHE_TTL,
+                 user_cache_size=USER_CACHE_SIZE, user_cache_ttl=USER_CACHE_TTL):
+        self.db = database
+        self.orders = LRUCache("orders", order_cache_size, order_cache_ttl)
+        self.users = LRUCache("users", user_cache_size, user_cache_ttl)
+        self.group_commit_window = group_commit_ms / 1000
+        self.max_batch = max_batch
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self._queue = None
+        self._commit_task = None
+    
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+        
+        if name in self.READ_METHODS:
+            async def call(*args, **kwargs):
+                return await self._execute(self._readers, "reader", functools.partial(method, *args, **kwargs))
+        elif self.group_commit_window > 0:
+            async def call(*args, **kwargs):
+                return await self._submit_write(name, args, kwargs)
+        else:
+            async def call(*args, **kwargs):
+                return await self._execute(self._writer, "writer", functools.partial(method, *args, **kwargs))
+        
+        timed = self._timed(call, name)
+        if name == "get_order" and self.orders.max_size > 0:
+            timed = self._cached_order(timed)
+        elif name == "add_user" and self.users.max_size > 0:
+            timed = self._cached_user(timed)
+        elif name in self.ORDER_WRITES:
+            timed = self._invalidating(timed, self.ORDER_WRITES[name])
+        # Кэшируем обертку, чтобы __getattr__ вызывался один раз на метод
+        setattr(self, name, timed)
+        return timed
+    
+    def _cached_order(self, call):
+        async def get_order(order_id):
+            order = self.orders.get(order_id)
+            if order is None:
+                generation = self.orders.generation
+                order = await call(order_id)
+                # Несуществующие заказы не кэшируем: id может появиться позже
+                if order is not None:
+                    self.orders.set(order_id, order, generation)
+            return order
+        
+        return get_order
+    
+    def _cached_user(self, call):
+        async def add_user(user_id, username, full_name):
+            # Пользователи не удаляются, а INSERT OR IGNORE не обновляет
+            # существующих - для известного пользователя запись не нужна
+            if self.users.get(user_id) is None:
+                await call(user_id, username, full_name)
+                self.users.set(user_id, True)
+        
+        return add_user
+    
+    def _invalidating(self, call, written):
+        async def invalidating(*args, **kwargs):
+            try:
+                result = await call(*args, **kwargs)
+            except BaseException:
+                # Запись могла успеть закоммититься (например, отмена во
+                # время COMMIT), а какие заказы она задела - неизвестно
+                self.orders.invalidate()
+                raise
+            self.orders.invalidate(written(args, kwargs, result))
+            return result
+        
+        invalidating.__name__ = call.__name__
+        return invalidating
+    
+    @staticmethod
+    def _timed(call, name):
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await call(*args, **kwargs)
+            finally:
+                DB_LATENCY.observe(time.perf_counter() - start, name)
+        
+        timed.__name__ = name
+        return timed
+    
+    @staticmethod
+    async def _execute(executor, pool, func):
+        """Выполнить func в пуле, замерив ожидание свободного потока"""
+        submitted = time.perf_counter()
+        started = None
+        
+        def run():
+            nonlocal started
+            started = time.perf_counter()
+            return func()
+        
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, run)
+        finally:
+            if started is not None:
+                DB_WAIT.observe(started - submitted, pool)
+    
+    async def _submit_write(self, name, args, kwargs):
+        """Поставить запись в очередь группового коммита и дождаться COMMIT"""
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._commit_task = asyncio.create_task(self._group_commit_loop())
+        
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((name, args, kwargs, future, time.perf_counter()))
+        return await future
+    
+    async def _group_commit_loop(self):
+        """Собирает записи, пришедшие в течение окна, в одну транзакцию.
+
+        Результат возвращается вызывающему только после COMMIT, так что
+        пользователь получает ответ, когда данные уже на диске.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.group_commit_window
+            
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout=timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            calls = [(name, args, kwargs) for name, args, kwargs, _, _ in batch]
+            started = time.perf_counter()
+            for *_, submitted in batch:
+                DB_WAIT.observe(started - submitted, "group_commit")
+            DB_BATCH_SIZE.observe(len(batch))
+            try:
+                results = await loop.run_in_executor(self._writer, self.db.run_batch, calls)
+            except Exception as e:
+                results = [(False, e)] * len(batch)
+            
+            for (_, _, _, future, _), (ok, value) in zip(batch, results):
+                if not future.done():
+                    if ok:
+                        future.set_result(value)
+                    else:
+                        future.set_exception(value)
+                self._queue.task_done()
+    
+    async def close(self):
+        if self._commit_task is not None:
+            await self._queue.join()
+            self._commit_task.cancel()
+            try:
+                await self._commit_task
+            except asyncio.CancelledError:
+                pass
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+
+async def expire_drafts_loop(database, ttl=DRAFT_TTL, interval=DRAFT_SWEEP_INTERVAL, batch=DRAFT_SWEEP_BATCH):
+    """Периодически истекать брошенные черновики.
+
+    Пачками по batch, каждая - отдельная короткая транзакция, чтобы не
+    держать писателя занятым и пропускать между ними обычные записи.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            while await database.expire_drafts(ttl, batch) == batch:
+                pass
+        except Exception as e:
+            logger.warning(f"Ошибка очистки черновиков: {e}")
+
+# ========== СОСТОЯНИЯ ПОЛЬЗОВАТЕЛЕЙ ==========
+# memory - LRU в процессе, sqlite - переживает рестарт и общий для процессов
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory")
+STATE_TTL = float(os.environ.get("STATE_TTL", "3600"))
+STATE_MAX_SIZE = int(os.environ.get("STATE_MAX_SIZE", "100000"))
+STATE_EVICT_INTERVAL = float(os.environ.get("STATE_EVICT_INTERVAL", "60"))
+
+class MemoryStateStore:
+    """Состояния в памяти: LRU с TTL и ограничением размера.
+
+    TTL скользящий (продлевается при каждом обращении), поэтому порядок
+    LRU совпадает с порядком истечения и вычистка идет с начала словаря.
+    """
+
+    def __init__(self, ttl=STATE_TTL, max_size=STATE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()
+    
+    async def get(self, user_id):
+        item = self._data.get(user_id)
+        if item is None:
+            return None
+        
+        expires_at, state = item
+        now = time.monotonic()
+        if expires_at <= now:
+            del self._data[user_id]
+            return None
+        
+        self._data[user_id] = (now + self.ttl, state)
+        self._data.move_to_end(user_id)
+        return dict(state)
+    
+    async def set(self, user_id, state):
+        self._data[user_id] = (time.monotonic() + self.ttl, dict(state))
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+    
+    async def delete(self, user_id):
+        self._data.pop(user_id, None)
+    
+    async def evict_expired(self):
+        now = time.monotonic()
+        removed = 0
+        while self._data:
+            user_id, (expires_at, _) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            del self._data[user_id]
+            removed += 1
+        return removed
+
+class SQLiteStateStore:
+    """Состояния в таблице user_states через AsyncDatabase.
+
+    TTL скользящий, как у MemoryStateStore: чтение продлевает срок,
+    поэтому get - запись и идет через поток-писатель.
+    """
+
+    def __init__(self, database, ttl=STATE_TTL, max_size=STATE_MAX_SIZE):
+        self.db = database
+        self.ttl = ttl
+        self.max_size = max_size
+    
+    async def get(self, user_id):
+        now = time.time()
+        return await self.db.get_state(user_id, now, now + self.ttl)
+    
+    async def set(self, user_id, state):
+        await self.db.set_state(user_id, state, time.time() + self.ttl)
+    
+    async def delete(self, user_id):
+        await self.db.delete_state(user_id)
+    
+    async def evict_expired(self):
+        return await self.db.evict_states(time.time(), self.max_size)
+
+async def evict_states_loop(store, interval=STATE_EVICT_INTERVAL):
+    """Периодически вычищать истекшие состояния"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await store.evict_expired()
+        except Exception as e:
+            logger.warning(f"Ошибка очистки состояний: {e}")
 
 # ========== ИНИЦИАЛИЗАЦИЯ ==========
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-bot = Bot(token=BOT_TOKEN)
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL)) if BOT_API_URL else None
+)
 dp = Dispatcher()
-db = Database()
+db = AsyncDatabase(
+    Database(),
+    readers=int(os.environ.get("DB_READERS", "4")),
+    group_commit_ms=GROUP_COMMIT_MS
+)
+
+user_states = SQLiteStateStore(db) if STATE_BACKEND == "sqlite" else MemoryStateStore()
+
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+
+# ========== УВЕДОМЛЕНИЯ ==========
+NOTIFY_WORKERS = int(os.environ.get("NOTIFY_WORKERS", "8"))
+# Лимиты Telegram: ~30 сообщений в секунду на бота и ~1 в секунду на чат
+NOTIFY_GLOBAL_RATE = float(os.environ.get("NOTIFY_GLOBAL_RATE", "25"))
+NOTIFY_CHAT_RATE = float(os.environ.get("NOTIFY_CHAT_RATE", "1"))
+NOTIFY_CHAT_BURST = int(os.environ.get("NOTIFY_CHAT_BURST", "3"))
+NOTIFY_MAX_RETRIES = int(os.environ.get("NOTIFY_MAX_RETRIES", "5"))
+
+async def wait_event(event, timeout):
+    """Ждать event не дольше timeout. True - событие наступило.
+
+    Не asyncio.wait_for: в Python 3.11 он проглатывает cancel(), пришедший,
+    когда событие уже наступило, и фоновая задача не останавливается.
+    """
+    waiter = asyncio.ensure_future(event.wait())
+    try:
+        done, _ = await asyncio.wait({waiter}, timeout=timeout)
+    finally:
+        waiter.cancel()
+    return bool(done)
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, запас не больше capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def try_acquire(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+    
+    async def acquire(self):
+        while not self.try_acquire():
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+    
+    def pause(self, seconds):
+        """Не выдавать токены seconds секунд (retry_after от Telegram)"""
+        self._refill()
+        self.tokens = min(self.tokens, 1) - seconds * self.rate
+    
+    @property
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+class NotificationDispatcher:
+    """Фоновая рассылка сообщений с ограничением скорости.
+
+    Задание - последовательность вызовов Bot для одного чата, они
+    выполняются по порядку. Разные чаты обрабатываются параллельно
+    (не больше workers), с общим и початовым token bucket. Чат в очереди
+    не больше одного раза: после каждого задания он встает в конец, так
+    что пачка сообщений одному покупателю не занимает всех воркеров.
+    На 429 чат ставится на паузу на retry_after и вызов повторяется.
+    """
+
+    def __init__(self, bot, workers=NOTIFY_WORKERS, global_rate=NOTIFY_GLOBAL_RATE,
+                 chat_rate=NOTIFY_CHAT_RATE, chat_burst=NOTIFY_CHAT_BURST, max_retries=NOTIFY_MAX_RETRIES):
+        self.bot = bot
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate)
+        self._chat_buckets = {}
+        # chat_id -> задания чата; в _queue - чаты, у которых они есть
+        self._chat_jobs = {}
+        self._queue = asyncio.Queue()
+        self._tasks = []
+    
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    async def stop(self, timeout=10):
+        """Дослать очередь (не дольше timeout) и остановить воркеров"""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не отправлено уведомлений: {sum(map(len, self._chat_jobs.values()))}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+    
+    def send(self, chat_id, *calls):
+        """Поставить в очередь вызовы ("send_message", {...}) для чата.
+
+        Возвращает future с результатом последнего вызова; ждать его не
+        обязательно.
+        """
+        future = asyncio.get_running_loop().create_future()
+        # Ошибка уже залогирована воркером, не нужно предупреждение asyncio
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        jobs = self._chat_jobs.get(chat_id)
+        if jobs is None:
+            jobs = self._chat_jobs[chat_id] = deque()
+            self._queue.put_nowait(chat_id)
+        jobs.append((calls, future))
+        return future
+    
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                # Выбрасываем чаты, которые давно не использовались
+                self._chat_buckets = {k: v for k, v in self._chat_buckets.items() if not v.idle}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+    
+    async def _worker(self):
+        while True:
+            chat_id = await self._queue.get()
+            jobs = self._chat_jobs[chat_id]
+            calls, future = jobs.popleft()
+            try:
+                result = None
+                for method, kwargs in calls:
+                    result = await self._call(chat_id, method, kwargs)
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                logger.warning(f"Ошибка отправки в чат {chat_id}: {e}")
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                if jobs:
+                    self._queue.put_nowait(chat_id)
+                else:
+                    del self._chat_jobs[chat_id]
+                self._queue.task_done()
+    
+    async def _call(self, chat_id, method, kwargs):
+        bucket = self._chat_bucket(chat_id)
+        delay = 1
+        
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await getattr(self.bot, method)(chat_id, **kwargs)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                bucket.pause(e.retry_after)
+                # Початовый лимит соблюдается бакетом, значит сработал общий
+                # лимит бота: тормозим всех, иначе остальные чаты тоже получат 429
+                self.global_bucket.pause(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError):
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(delay)
+                delay *= 2
+
+notifier = NotificationDispatcher(bot)
+
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_INTERVAL = float(os.environ.get("OUTBOX_INTERVAL", "5"))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_LEASE = float(os.environ.get("OUTBOX_LEASE", "120"))
+# Строк одного чата в отправке одновременно: на початовом лимите они уходят
+# около секунды каждая и не должны занимать места остальных чатов
+OUTBOX_CHAT_LIMIT = int(os.environ.get("OUTBOX_CHAT_LIMIT", "5"))
+
+# Уведомления покупателю о переходах, которые делает не он сам (админ,
+# оплата или истечение счета). На свои действия покупатель получает ответ
+# сразу, для таких статусов текста нет.
+BUYER_STATUS_MESSAGES = {
+    "completed": "✅ Ваш заказ #{order_id} выполнен!\nСпасибо за покупку.",
+    "cancelled": "❌ Ваш заказ #{order_id} отменен.\nЕсли это ошибка - напишите в поддержку.",
+    "expired": "⌛ Срок оплаты заказа #{order_id} истек. Оформите заказ заново."
+}
+# Оплата через CryptoBot сразу завершает заказ, а товар доставляется после
+BUYER_CRYPTO_MESSAGES = {
+    "completed": "✅ Оплата заказа #{order_id} получена!\nТовар будет доставлен в течение 15 минут."
+}
+
+def admin_outbox(*calls):
+    """Уведомления для outbox: одинаковые вызовы каждому админу"""
+    return [(admin_id, calls, None) for admin_id in ADMIN_IDS]
+
+def buyer_status_outbox(order, status):
+    """Уведомление покупателю о новом статусе заказа (пусто, если о таком
+    статусе не сообщаем). Ключ заказа схлопывает неотправленные переходы"""
+    messages = BUYER_CRYPTO_MESSAGES if order.payment_method == "crypto" else {}
+    template = messages.get(status) or BUYER_STATUS_MESSAGES.get(status)
+    if template is None:
+        return []
+    
+    text = template.format(order_id=order.id)
+    return [(order.user_id, (("send_message", {"text": text}),), f"order:{order.id}")]
+
+class OutboxSender:
+    """Доставка уведомлений из таблицы outbox.
+
+    Строки пишутся в одной транзакции со сменой статуса заказа, поэтому
+    уведомление не теряется, если процесс упал до отправки. Отправка идет
+    через NotificationDispatcher: в отправке не больше batch_size строк и
+    не больше chat_limit строк одного чата. Каждая строка завершается, как
+    только отправлена, и на ее место сразу берется следующая, поэтому
+    медленный чат не задерживает остальные. Ошибки повторяются с растущей
+    задержкой, после max_attempts попыток строка помечается dead.
+    """
+
+    def __init__(self, database, notifier, batch_size=OUTBOX_BATCH_SIZE, interval=OUTBOX_INTERVAL,
+                 max_attempts=OUTBOX_MAX_ATTEMPTS, lease=OUTBOX_LEASE, chat_limit=OUTBOX_CHAT_LIMIT):
+        self.db = database
+        self.notifier = notifier
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.chat_limit = chat_limit
+        # outbox_id -> chat_id строк в отправке
+        self._in_flight = {}
+        # Отправленные, но еще не записанные: (outbox_id, attempts, ошибка или None)
+        self._done = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Уже отправленные не должны уйти повторно после истечения lease
+        try:
+            await self._finish_done()
+        except Exception as e:
+            logger.warning(f"Ошибка записи итогов outbox: {e}")
+    
+    def wakeup(self):
+        """Появились новые строки - отправить, не дожидаясь интервала"""
+        self._wakeup.set()
+    
+    async def drain_once(self):
+        """Записать итоги отправленных строк и занять освободившиеся места
+        новыми. Не ждет отправки. Возвращает число взятых строк"""
+        await self._finish_done()
+        
+        free = self.batch_size - len(self._in_flight)
+        if free <= 0:
+            return 0
+        rows = await self.db.claim_outbox(
+            time.time(), free, self.lease,
+            chat_limit=self.chat_limit, skip_chats=set(self._in_flight.values())
+        )
+        for outbox_id, chat_id, calls, attempts in rows:
+            self._in_flight[outbox_id] = chat_id
+            future = self.notifier.send(chat_id, *[(method, kwargs) for method, kwargs in json.loads(calls)])
+            future.add_done_callback(functools.partial(self._sent, outbox_id, attempts))
+        return len(rows)
+    
+    def _sent(self, outbox_id, attempts, future):
+        del self._in_flight[outbox_id]
+        error = None
+        if future.cancelled():
+            error = "отменено"
+        elif future.exception() is not None:
+            error = str(future.exception())
+        self._done.append((outbox_id, attempts, error))
+        # Освободилось место - берем следующие строки
+        self._wakeup.set()
+    
+    async def _finish_done(self):
+        if not self._done:
+            return
+        done, self._done = self._done, []
+        
+        sent, failed = [], []
+        now = time.time()
+        for outbox_id, attempts, error in done:
+            if error is None:
+                sent.append(outbox_id)
+            else:
+                retry_at = now + min(5 * 2 ** attempts, 3600)
+                failed.append((outbox_id, error, retry_at, attempts >= self.max_attempts))
+        try:
+            await self.db.finish_outbox(sent, failed)
+        except BaseException:
+            # Запишем со следующей попыткой
+            self._done = done + self._done
+            raise
+    
+    async def _run(self):
+        while True:
+            try:
+                await self.drain_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Ошибка отправки outbox: {e}")
+            
+            await wait_event(self._wakeup, self.interval)
+            self._wakeup.clear()
 
-user_states = {}
+outbox_sender = OutboxSender(db, notifier)
+
+# ========== CALLBACK DATA ==========
+# Кнопки с параметрами упаковываются как "<префикс>:<поле>:...", id
+# разбирается и проверяется один раз в CallbackRouter
+class PremiumCallback(CallbackData, prefix="premium"):
+    period: Literal["3m", "6m", "1y"]
+
+class CardPayCallback(CallbackData, prefix="card_pay"):
+    order_id: int
+
+class CryptoPayCallback(CallbackData, prefix="crypto_pay"):
+    order_id: int
+
+class CheckCryptoCallback(CallbackData, prefix="check_crypto"):
+    order_id: int
+
+class ConfirmPaidCallback(CallbackData, prefix="confirm_paid"):
+    order_id: int
+
+class CancelPhotoCallback(CallbackData, prefix="cancel_photo"):
+    order_id: int
+
+AdminOrderStatus = Literal["pending", "waiting_confirmation", "completed"]
+AdminOrderType = Literal["all", "stars", "premium", "exchange"]
+AdminPaymentMethod = Literal["all", "card", "crypto"]
+
+class AdminOrdersCallback(CallbackData, prefix="adm_orders"):
+    """Страница списка заказов: фильтры и курсор (id заказа на границе)"""
+    status: AdminOrderStatus
+    order_type: AdminOrderType = "all"
+    method: AdminPaymentMethod = "all"
+    direction: Literal["n", "p"] = "n"
+    cursor: int = 0
+
+class AdminSelectCallback(CallbackData, prefix="adm_sel"):
+    """Отметки заказов на странице списка и массовые действия над ними"""
+    action: Literal["toggle", "all", "none", "complete", "cancel"]
+    order_id: int = 0
+
+class CallbackRouter:
+    """Маршрутизация callback-запросов по словарю за O(1).
+
+    Вместо цепочки F.data-фильтров, которые aiogram проверяет по очереди,
+    все callback-запросы приходят в dispatch. Он находит обработчик по
+    части callback_data до первого ':' и один раз разбирает данные через
+    CallbackData.unpack. Ключ маршрута - строка (кнопка без параметров)
+    или класс CallbackData (по его префиксу).
+    """
+
+    def __init__(self):
+        self._routes = {}
+    
+    def route(self, key):
+        def decorator(handler):
+            if isinstance(key, str):
+                prefix, factory = key, None
+            else:
+                prefix, factory = key.__prefix__, key
+            if prefix in self._routes:
+                raise ValueError(f"Маршрут {prefix} уже зарегистрирован")
+            self._routes[prefix] = (handler, factory)
+            return handler
+        return decorator
+    
+    def resolve(self, data):
+        """(обработчик, CallbackData или None) для callback_data"""
+        if not data:
+            return None
+        return self._routes.get(data.partition(":")[0])
+    
+    async def dispatch(self, callback: types.CallbackQuery):
+        route = self.resolve(callback.data)
+        if route is None:
+            await callback.answer("❌ Кнопка устарела, откройте меню заново")
+            return
+        
+        handler, factory = route
+        if factory is None:
+            return await handler(callback)
+        
+        try:
+            callback_data = factory.unpack(callback.data)
+        except (ValueError, TypeError):
+            await callback.answer("❌ Неверные данные")
+            return
+        
+        return await handler(callback, callback_data)
+
+callbacks = CallbackRouter()
+dp.callback_query.register(callbacks.dispatch)
+
+def resolve_handler(event, data):
+    """Функция-обработчик апдейта для inner middleware.
+
+    Для callback-запросов это обработчик маршрута CallbackRouter (None,
+    если маршрут не найден), а не общий callbacks.dispatch.
+    """
+    callback = data["handler"].callback
+    if callback == callbacks.dispatch:
+        route = callbacks.resolve(event.data)
+        return route[0] if route else None
+    return callback
+
+# ========== ОГРАНИЧЕНИЕ ЧАСТОТЫ ==========
+def parse_limits(spec, defaults):
+    """"input=0.5/3,admin=1/3" -> {класс: (в секунду, запас)} поверх defaults"""
+    limits = dict(defaults)
+    for item in filter(None, spec.split(",")):
+        name, _, limit = item.partition("=")
+        rate, _, burst = limit.partition("/")
+        limits[name.strip()] = (float(rate), int(burst or 1))
+    return limits
+
+# Лимиты на пользователя по классам обработчиков: класс -> (запросов в
+# секунду, запас). Переопределяются через THROTTLE_LIMITS
+THROTTLE_LIMITS = parse_limits(os.environ.get("THROTTLE_LIMITS", ""), {
+    "default": (2.0, 6),
+    # Ввод данных заказа и фото оплаты - пишут в базу
+    "input": (0.5, 4),
+    # Счета CryptoBot и смена статуса оплаты
+    "payment": (0.3, 3),
+    # Списки заказов и статистика в админке
+    "admin": (1.0, 4)
+})
+THROTTLE_EVICT_INTERVAL = float(os.environ.get("THROTTLE_EVICT_INTERVAL", "60"))
+
+THROTTLED = metrics.counter("bot_throttled_total", "Апдейты, отклоненные ограничением частоты", ("limit",))
+
+def throttle(limit):
+    """Отнести обработчик к классу лимитов (по умолчанию default)"""
+    def decorator(handler):
+        handler.throttle_limit = limit
+        return handler
+    return decorator
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Per-user token bucket на класс обработчика.
+
+    Лишний апдейт не доходит до обработчика и базы: callback получает
+    всплывающий ответ, а на сообщения предупреждение отправляется один раз
+    за серию. Полные (простаивающие) bucket'ы удаляет evict_idle - новый
+    bucket ничем не отличается от полного.
+    """
+
+    def __init__(self, limits=THROTTLE_LIMITS):
+        self.limits = limits
+        # (user_id, класс) -> [TokenBucket, предупрежден ли]
+        self._buckets = {}
+    
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        target = resolve_handler(event, data)
+        if user is None or target is None:
+            return await handler(event, data)
+        
+        limit = getattr(target, "throttle_limit", "default")
+        key = (user.id, limit)
+        entry = self._buckets.get(key)
+        if entry is None:
+            rate, burst = self.limits[limit]
+            entry = self._buckets[key] = [TokenBucket(rate, burst), False]
+        
+        if entry[0].try_acquire():
+            entry[1] = False
+            return await handler(event, data)
+        
+        THROTTLED.inc(limit)
+        if isinstance(event, types.CallbackQuery):
+            await event.answer("⏳ Слишком часто, подождите пару секунд")
+        elif not entry[1]:
+            entry[1] = True
+            await event.answer("⏳ Слишком много сообщений, подождите немного")
+    
+    def evict_idle(self):
+        idle = [key for key, (bucket, _) in self._buckets.items() if bucket.idle]
+        for key in idle:
+            del self._buckets[key]
+        return len(idle)
+
+async def evict_throttle_loop(middleware, interval=THROTTLE_EVICT_INTERVAL):
+    """Периодически удалять bucket'ы неактивных пользователей"""
+    while True:
+        await asyncio.sleep(interval)
+        middleware.evict_idle()
+
+throttler = ThrottlingMiddleware()
+dp.message.middleware(throttler)
+dp.callback_query.middleware(throttler)
 
 # ========== КЛАВИАТУРЫ ==========
+# Клавиатуры не меняются после создания, поэтому статические строятся один
+# раз, а зависящие от заказа берутся из ограниченного кэша. Изменять
+# возвращаемые объекты нельзя - они общие для всех апдейтов.
+MAIN_MENU_TEXT = (
+    "🪐 **Digi Store - Главное меню**\n\n"
+    "C помощью нашего магазина вы можете:\n"
+    "• ⭐️ Купить Telegram Stars\n"
+    "• 👑 Купить Telegram Premium\n"
+    "• 💱 Обменять рубли на доллары\n\n"
+    "Выберите действие:"
+)
+
+@functools.lru_cache(maxsize=None)
 def main_menu_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="⭐️ Купить звезды", callback_data="buy_stars")],
@@ -213,30 +2121,86 @@ def main_menu_kb():
         [InlineKeyboardButton(text="🆘 Тех поддержка", url=f"https://t.me/{SUPPORT_USER}")]
     ])
 
+@functools.lru_cache(maxsize=None)
 def back_to_main_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
     ])
 
+@functools.lru_cache(maxsize=None)
 def admin_menu_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
         [InlineKeyboardButton(text="⏳ Ожидают проверки", callback_data="admin_pending")],
+        [InlineKeyboardButton(text="📝 Черновики", callback_data="admin_drafts")],
         [InlineKeyboardButton(text="✅ Выполненные", callback_data="admin_completed")],
         [InlineKeyboardButton(text="🔙 В меню", callback_data="main_menu")]
     ])
 
-def confirm_payment_kb(order_id):
+@functools.lru_cache(maxsize=None)
+def admin_stats_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Я оплатил", callback_data=f"confirm_paid_{order_id}")],
-        [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_stats")],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
     ])
 
+@functools.lru_cache(maxsize=None)
+def premium_periods_kb():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="3 месяца", callback_data=PremiumCallback(period="3m").pack())],
+        [InlineKeyboardButton(text="6 месяцев", callback_data=PremiumCallback(period="6m").pack())],
+        [InlineKeyboardButton(text="1 год", callback_data=PremiumCallback(period="1y").pack())],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")]
+    ])
+
+@functools.lru_cache(maxsize=None)
+def info_kb():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📈 Репутация", url=REPUTATION_CHANNEL)],
+        [InlineKeyboardButton(text="📰 Новости", url=NEWS_CHANNEL)],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")]
+    ])
+
+@functools.lru_cache(maxsize=None)
 def back_kb(target):
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔙 Назад", callback_data=target)]
     ])
 
+@functools.lru_cache(maxsize=1024)
+def confirm_payment_kb(order_id):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Я оплатил", callback_data=ConfirmPaidCallback(order_id=order_id).pack())],
+        [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
+    ])
+
+@functools.lru_cache(maxsize=1024)
+def payment_method_kb(order_id, back):
+    """Выбор способа оплаты звезд и премиума"""
+    rows = []
+    
+    # Добавляем CryptoBot если есть токен
+    if cryptobot:
+        rows.append([InlineKeyboardButton(text="💎 CryptoBot", callback_data=CryptoPayCallback(order_id=order_id).pack())])
+    
+    rows.append([InlineKeyboardButton(text="💳 Перевод на карту", callback_data=CardPayCallback(order_id=order_id).pack())])
+    rows.append([InlineKeyboardButton(text="🔙 Назад", callback_data=back)])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+@functools.lru_cache(maxsize=1024)
+def exchange_payment_kb(order_id):
+    # ✅ ДЛЯ ОБМЕНА ВАЛЮТ ТОЛЬКО КАРТА!
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="💳 Оплатить картой", callback_data=CardPayCallback(order_id=order_id).pack())],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="exchange")]
+    ])
+
+@functools.lru_cache(maxsize=1024)
+def cancel_photo_kb(order_id):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔙 Отмена", callback_data=CancelPhotoCallback(order_id=order_id).pack())]
+    ])
+
 # ========== ОСНОВНЫЕ ОБРАБОТЧИКИ ==========
 @dp.message(CommandStart())
 async def cmd_start(message: types.Message):
@@ -245,66 +2209,39 @@ async def cmd_start(message: types.Message):
     username = message.from_user.username or ""
     full_name = message.from_user.full_name
     
-    db.add_user(user_id, username, full_name)
-    
-    caption = (
-        "🪐 **Digi Store - Главное меню**\n\n"
-        "C помощью нашего магазина вы можете:\n"
-        "• ⭐️ Купить Telegram Stars\n"
-        "• 👑 Купить Telegram Premium\n"
-        "• 💱 Обменять рубли на доллары\n\n"
-        "Выберите действие:"
-    )
+    await db.add_user(user_id, username, full_name)
     
     await message.answer(
-        text=caption,
+        text=MAIN_MENU_TEXT,
         reply_markup=main_menu_kb(),
         parse_mode="Markdown"
     )
 
 async def show_main_menu(message: types.Message):
     """Показать главное меню"""
-    caption = (
-        "🪐 **Digi Store - Главное меню**\n\n"
-        "C помощью нашего магазина вы можете:\n"
-        "• ⭐️ Купить Telegram Stars\n"
-        "• 👑 Купить Telegram Premium\n"
-        "• 💱 Обменять рубли на доллары\n\n"
-        "Выберите действие:"
-    )
-    
     await message.answer(
-        text=caption,
+        text=MAIN_MENU_TEXT,
         reply_markup=main_menu_kb(),
         parse_mode="Markdown"
     )
 
 # ========== ВСЕ ОБРАБОТЧИКИ КНОПОК ==========
-@dp.callback_query(F.data == "main_menu")
+@callbacks.route("main_menu")
 async def main_menu_handler(callback: types.CallbackQuery):
-    caption = (
-        "🪐 **Digi Store - Главное меню**\n\n"
-        "C помощью нашего магазина вы можете:\n"
-        "• ⭐️ Купить Telegram Stars\n"
-        "• 👑 Купить Telegram Premium\n"
-        "• 💱 Обменять рубли на доллары\n\n"
-        "Выберите действие:"
-    )
-    
     await callback.message.edit_text(
-        text=caption,
+        text=MAIN_MENU_TEXT,
         reply_markup=main_menu_kb(),
         parse_mode="Markdown"
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "buy_stars")
+@callbacks.route("buy_stars")
 async def buy_stars_handler(callback: types.CallbackQuery):
-    user_states[callback.from_user.id] = {"action": "waiting_stars_recipient"}
+    await user_states.set(callback.from_user.id, {"action": "waiting_stars_recipient"})
     
     caption = (
         "⭐️ **Покупка Telegram Stars**\n\n"
-        f"Курс: **1 звезда = {STAR_RATE} RUB**\n"
+        f"Курс: **1 звезда = {pricing.snapshot().star_rate} RUB**\n"
         "Диапазон: от 50 до 1,000,000 звезд\n\n"
         "✏️ Введите username получателя (можно с @):"
     )
@@ -316,19 +2253,12 @@ async def buy_stars_handler(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "buy_premium")
+@callbacks.route("buy_premium")
 async def buy_premium_handler(callback: types.CallbackQuery):
     price_text = ""
-    for key, value in PREMIUM_PRICES.items():
+    for key, value in pricing.snapshot().premium_prices.items():
         price_text += f"• {value['name']}: {value['rub']:.2f} RUB\n"
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="3 месяца", callback_data="premium_3m")],
-        [InlineKeyboardButton(text="6 месяцев", callback_data="premium_6m")],
-        [InlineKeyboardButton(text="1 год", callback_data="premium_1y")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")]
-    ])
-    
     caption = (
         "👑 **Покупка Telegram Premium**\n\n"
         "Выберите период:\n\n"
@@ -337,25 +2267,26 @@ async def buy_premium_handler(callback: types.CallbackQuery):
     
     await callback.message.edit_text(
         text=caption,
-        reply_markup=keyboard,
+        reply_markup=premium_periods_kb(),
         parse_mode="Markdown"
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("premium_"))
-async def premium_period_handler(callback: types.CallbackQuery):
-    period = callback.data.replace("premium_", "")
+@callbacks.route(PremiumCallback)
+async def premium_period_handler(callback: types.CallbackQuery, callback_data: PremiumCallback):
+    period = callback_data.period
+    premium_prices = pricing.snapshot().premium_prices
     
-    if period in PREMIUM_PRICES:
-        user_states[callback.from_user.id] = {
+    if period in premium_prices:
+        await user_states.set(callback.from_user.id, {
             "action": "waiting_premium_recipient",
             "period": period,
-            "amount_rub": PREMIUM_PRICES[period]["rub"]
-        }
+            "amount_rub": str(premium_prices[period]["rub"])
+        })
         
         caption = (
-            f"👑 **Telegram Premium - {PREMIUM_PRICES[period]['name']}**\n\n"
-            f"Цена: **{PREMIUM_PRICES[period]['rub']:.2f} RUB**\n\n"
+            f"👑 **Telegram Premium - {premium_prices[period]['name']}**\n\n"
+            f"Цена: **{premium_prices[period]['rub']:.2f} RUB**\n\n"
             "✏️ Введите username получателя (можно с @):"
         )
         
@@ -367,15 +2298,15 @@ async def premium_period_handler(callback: types.CallbackQuery):
     
     await callback.answer()
 
-@dp.callback_query(F.data == "exchange")
+@callbacks.route("exchange")
 async def exchange_handler(callback: types.CallbackQuery):
-    user_states[callback.from_user.id] = {"action": "waiting_exchange_amount"}
+    await user_states.set(callback.from_user.id, {"action": "waiting_exchange_amount"})
     
     caption = (
         "💱 **Обмен валют**\n\n"
-        f"Курс: **1 USD = {USD_RATE} RUB**\n\n"
+        f"Курс: **1 USD = {pricing.snapshot().usd_rate:.2f} RUB**\n\n"
         "Введите сумму в рублях для обмена:\n"
-        "(Минимум: 100 RUB)\n\n"
+        f"(от {EXCHANGE_MIN_RUB:,} до {EXCHANGE_MAX_RUB:,} RUB)\n\n"
         "💳 **Оплата только картой!**"
     )
     
@@ -383,129 +2314,97 @@ async def exchange_handler(callback: types.CallbackQuery):
         text=caption,
         reply_markup=back_kb("main_menu"),
         parse_mode="Markdown"
-    )
-    await callback.answer()
-
-@dp.callback_query(F.data == "info")
-async def info_handler(callback: types.CallbackQuery):
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📈 Репутация", url=REPUTATION_CHANNEL)],
-        [InlineKeyboardButton(text="📰 Новости", url=NEWS_CHANNEL)],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")]
-    ])
-    
+    )
+    await callback.answer()
+
+@callbacks.route("info")
+async def info_handler(callback: types.CallbackQuery):
     caption = "📊 **Информация**\n\nВыберите раздел:"
     
     await callback.message.edit_text(
         text=caption,
-        reply_markup=keyboard,
+        reply_markup=info_kb(),
         parse_mode="Markdown"
     )
     await callback.answer()
 
 # ========== ОБРАБОТКА ФОТО ОПЛАТЫ ==========
 @dp.message(F.photo)
+@throttle("input")
 async def handle_payment_photo(message: types.Message):
     """Обработка фото оплаты"""
     user_id = message.from_user.id
     
-    if user_id not in user_states:
+    state = await user_states.get(user_id)
+    
+    if state is None:
         await message.answer("Пожалуйста, используйте кнопки меню.")
         return
     
-    state = user_states[user_id]
-    
     if state.get("action") == "waiting_payment_photo":
         order_id = state.get("order_id")
-        order = db.get_order(order_id)
+        order = await db.get_order(order_id)
         
         if not order:
             await message.answer("❌ Заказ не найден")
             return
         
-        user_id_db, order_type, recipient, details, amount_rub, payment_method, status, invoice_id = order
+        order_type = order.order_type
+        amount_rub = order.amount_rub
         
         # Получаем file_id фото
         photo_file_id = message.photo[-1].file_id
         
-        # Сохраняем фото в базу
-        try:
-            details_dict = json.loads(details) if details else {}
-            details_dict["payment_photo"] = photo_file_id
-            db.add_payment_photo(order_id, photo_file_id)
-        except:
-            pass
+        # Уведомления админам с фото
+        photo_caption = "📸 **Фото оплаты получено**"
+        
+        if order_type == "exchange":
+            photo_caption += f"\n💱 Обмен валют"
+        
+        admin_message = f"🆕 Ожидает проверки картой\n"
+        admin_message += f"🆔 Заказ: #{order_id}\n"
+        admin_message += f"👤 Пользователь: {message.from_user.username or 'Нет юзернейма'}\n"
+        admin_message += f"🆔 ID: {message.from_user.id}\n"
+        admin_message += f"💰 Сумма: {amount_rub:.2f} RUB\n"
+        admin_message += f"📦 Тип: {order_type}\n"
+        
+        if order_type == "exchange":
+            admin_message += f"💸 К выдаче: {order.amount_usd:.2f} USD\n"
+        else:
+            admin_message += f"👤 Получатель: {order.recipient}\n"
+        
+        admin_message += f"\nДля проверки: /check_{order_id}"
         
-        # Обновляем статус
-        db.update_order_status(order_id, "waiting_confirmation")
+        # Фото, статус и уведомления (сначала фото, затем детали) - одной
+        # транзакцией, рассылает их outbox_sender в фоне
+        changed, status = await db.submit_payment_photo(
+            order_id,
+            photo_file_id,
+            outbox=admin_outbox(
+                ("send_photo", {"photo": photo_file_id, "caption": photo_caption}),
+                ("send_message", {"text": admin_message})
+            )
+        )
         
         # Удаляем состояние
-        del user_states[user_id]
+        await user_states.delete(user_id)
         
-        # Уведомляем админа с фото
-        for admin_id in ADMIN_IDS:
-            try:
-                # Сначала отправляем фото
-                photo_caption = "📸 **Фото оплаты получено**"
-                
-                if order_type == "exchange":
-                    try:
-                        details_dict = json.loads(details) if details else {}
-                        amount_usd = details_dict.get("amount_usd", amount_rub / USD_RATE)
-                        photo_caption += f"\n💱 Обмен валют"
-                    except:
-                        photo_caption += f"\n💱 Обмен валют"
-                
-                await bot.send_photo(
-                    admin_id,
-                    photo=photo_file_id,
-                    caption=photo_caption
-                )
-                
-                # Затем отправляем детали заказа
-                admin_message = f"🆕 Ожидает проверки картой\n"
-                admin_message += f"🆔 Заказ: #{order_id}\n"
-                admin_message += f"👤 Пользователь: {message.from_user.username or 'Нет юзернейма'}\n"
-                admin_message += f"🆔 ID: {message.from_user.id}\n"
-                admin_message += f"💰 Сумма: {amount_rub:.2f} RUB\n"
-                admin_message += f"📦 Тип: {order_type}\n"
-                
-                if order_type == "exchange":
-                    try:
-                        details_dict = json.loads(details) if details else {}
-                        amount_usd = details_dict.get("amount_usd", amount_rub / USD_RATE)
-                        admin_message += f"💸 К выдаче: {amount_usd:.2f} USD\n"
-                    except:
-                        pass
-                else:
-                    admin_message += f"👤 Получатель: {recipient}\n"
-                
-                admin_message += f"\nДля проверки: /check_{order_id}"
-                
-                await bot.send_message(admin_id, admin_message)
-                
-            except Exception as e:
-                print(f"Ошибка отправки админу: {e}")
+        if not changed:
+            await message.answer(f"❌ {order_status_text(order_id, status)}, фото не принято")
+            await show_main_menu(message)
+            return
+        outbox_sender.wakeup()
         
         # Сообщение пользователю
         if order_type == "exchange":
-            try:
-                details_dict = json.loads(details) if details else {}
-                amount_usd = details_dict.get("amount_usd", amount_rub / USD_RATE)
-                user_message = (
-                    f"✅ Фото оплаты получено!\n"
-                    f"💸 Вы получаете: {amount_usd:.2f} USD\n"
-                    f"💰 Оплачено: {amount_rub:.2f} RUB\n\n"
-                    "Заказ передан админу на проверку.\n"
-                    "После проверки USD будут отправлены вам.\n"
-                    "Проверка занимает до 15 минут."
-                )
-            except:
-                user_message = (
-                    "✅ Фото оплаты получено! Заказ передан админу на проверку.\n"
-                    "После проверки USD будут отправлены вам.\n"
-                    "Проверка занимает до 15 минут."
-                )
+            user_message = (
+                f"✅ Фото оплаты получено!\n"
+                f"💸 Вы получаете: {order.amount_usd:.2f} USD\n"
+                f"💰 Оплачено: {amount_rub:.2f} RUB\n\n"
+                "Заказ передан админу на проверку.\n"
+                "После проверки USD будут отправлены вам.\n"
+                "Проверка занимает до 15 минут."
+            )
         else:
             user_message = (
                 "✅ Фото оплаты получено! Заказ передан админу на проверку.\n"
@@ -518,24 +2417,25 @@ async def handle_payment_photo(message: types.Message):
         await show_main_menu(message)
 
 # ========== ОБРАБОТКА ТЕКСТОВЫХ СООБЩЕНИЙ ==========
-@dp.message(F.text)
+# Команды пропускаем дальше, иначе этот обработчик перехватывает
+# все команды админа, зарегистрированные ниже
+@dp.message(F.text, ~F.text.startswith("/"))
+@throttle("input")
 async def handle_text_messages(message: types.Message):
     # Проверяем, не ожидается ли фото
     user_id = message.from_user.id
-    if user_id in user_states and user_states[user_id].get("action") == "waiting_payment_photo":
-        await message.answer("📸 Пожалуйста, отправьте фото/скриншот оплаты")
-        return
+    state = await user_states.get(user_id)
     
-    if message.text.startswith('/'):
+    if state and state.get("action") == "waiting_payment_photo":
+        await message.answer("📸 Пожалуйста, отправьте фото/скриншот оплаты")
         return
     
     text = message.text.strip()
     
-    if user_id not in user_states:
+    if state is None:
         await message.answer("Используйте меню", reply_markup=main_menu_kb())
         return
     
-    state = user_states[user_id]
     action = state.get("action")
     
     if action == "waiting_stars_recipient":
@@ -551,6 +2451,7 @@ async def handle_text_messages(message: types.Message):
         
         state["recipient"] = recipient
         state["action"] = "waiting_stars_amount"
+        await user_states.set(user_id, state)
         
         await message.answer(
             f"✅ Получатель: @{recipient}\n\n"
@@ -565,36 +2466,25 @@ async def handle_text_messages(message: types.Message):
                 await message.answer("❌ Количество звезд должно быть от 50 до 1,000,000")
                 return
             
-            amount_rub = stars * STAR_RATE
+            prices = pricing.snapshot()
+            amount_rub = to_money(stars * prices.star_rate)
             recipient = state.get("recipient", "")
             
             state["stars_amount"] = stars
-            state["amount_rub"] = amount_rub
+            state["amount_rub"] = str(amount_rub)
+            await user_states.set(user_id, state)
             
             # Создаем заказ
-            order_id = db.add_order(
-                user_id, "stars", recipient, 
-                json.dumps({"stars": stars}), 
-                amount_rub, "card"
+            order_id = await db.add_order(
+                user_id, "stars", recipient, None,
+                amount_rub, "card", usd_rate=prices.usd_rate, stars=stars
             )
             
-            # Создаем клавиатуру оплаты
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="💳 Перевод на карту", callback_data=f"card_pay_{order_id}")],
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="buy_stars")]
-            ])
-            
-            # Добавляем CryptoBot если есть токен
-            if cryptobot:
-                keyboard.inline_keyboard.insert(0, [
-                    InlineKeyboardButton(text="💎 CryptoBot", callback_data=f"crypto_pay_{order_id}")
-                ])
-            
             await message.answer(
                 f"✅ {stars} звезд для @{recipient}\n"
                 f"💰 Сумма: {amount_rub:.2f} RUB\n\n"
                 "Выберите способ оплаты:",
-                reply_markup=keyboard
+                reply_markup=payment_method_kb(order_id, "buy_stars")
             )
             
         except ValueError:
@@ -611,92 +2501,92 @@ async def handle_text_messages(message: types.Message):
         amount_rub = state.get("amount_rub")
         
         if period and amount_rub:
+            amount_rub = to_money(amount_rub)
             state["recipient"] = recipient
+            await user_states.set(user_id, state)
             
             # Создаем заказ
-            order_id = db.add_order(
-                user_id, "premium", recipient,
-                json.dumps({"period": period}),
-                amount_rub, "card"
+            prices = pricing.snapshot()
+            order_id = await db.add_order(
+                user_id, "premium", recipient, None,
+                amount_rub, "card", usd_rate=prices.usd_rate, period=period
             )
             
-            # Создаем клавиатуру оплаты
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="💳 Перевод на карту", callback_data=f"card_pay_{order_id}")],
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="buy_premium")]
-            ])
-            
-            # Добавляем CryptoBot если есть токен
-            if cryptobot:
-                keyboard.inline_keyboard.insert(0, [
-                    InlineKeyboardButton(text="💎 CryptoBot", callback_data=f"crypto_pay_{order_id}")
-                ])
-            
             await message.answer(
-                f"✅ {PREMIUM_PRICES[period]['name']} для @{recipient}\n"
+                f"✅ {prices.premium_prices[period]['name']} для @{recipient}\n"
                 f"💰 Сумма: {amount_rub:.2f} RUB\n\n"
                 "Выберите способ оплаты:",
-                reply_markup=keyboard
+                reply_markup=payment_method_kb(order_id, "buy_premium")
             )
     
     elif action == "waiting_exchange_amount":
         try:
-            amount_rub = float(text)
-            if amount_rub < 100:
-                await message.answer("❌ Минимальная сумма: 100 RUB")
+            amount_rub = to_money(text.strip())
+            if amount_rub < EXCHANGE_MIN_RUB:
+                await message.answer(f"❌ Минимальная сумма: {EXCHANGE_MIN_RUB} RUB")
+                return
+            if amount_rub > EXCHANGE_MAX_RUB:
+                await message.answer(f"❌ Максимальная сумма: {EXCHANGE_MAX_RUB:,} RUB")
                 return
             
-            amount_usd = amount_rub / USD_RATE
+            # Курс фиксируется в заказе на момент оформления
+            usd_rate = pricing.snapshot().usd_rate
+            amount_usd = to_money(amount_rub / usd_rate)
             
             # Создаем заказ
-            order_id = db.add_order(
-                user_id, "exchange", "",
-                json.dumps({
-                    "amount_rub": amount_rub, 
-                    "amount_usd": amount_usd,
-                    "exchange_rate": USD_RATE
-                }),
-                amount_rub, "card"  # Только карта!
+            order_id = await db.add_order(
+                user_id, "exchange", "", None,
+                amount_rub, "card",  # Только карта!
+                usd_rate=usd_rate, amount_usd=amount_usd
             )
             
-            # ✅ ДЛЯ ОБМЕНА ВАЛЮТ ТОЛЬКО КАРТА!
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="💳 Оплатить картой", callback_data=f"card_pay_{order_id}")],
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="exchange")]
-            ])
-            
             await message.answer(
                 f"✅ **Обмен валют**\n"
-                f"📊 Курс: 1 USD = {USD_RATE} RUB\n"
+                f"📊 Курс: 1 USD = {usd_rate:.2f} RUB\n"
                 f"💸 Вы получаете: {amount_usd:.2f} USD\n"
                 f"💰 К оплате: {amount_rub:.2f} RUB\n\n"
                 "💳 **Оплата только картой!**\n"
                 "После оплаты пришлите скриншот перевода.",
-                reply_markup=keyboard
+                reply_markup=exchange_payment_kb(order_id)
             )
             
-        except ValueError:
+        except (ValueError, InvalidOperation):
             await message.answer("❌ Пожалуйста, введите число")
 
 # ========== ОПЛАТА КАРТОЙ ==========
-@dp.callback_query(F.data.startswith("card_pay_"))
-async def card_payment_handler(callback: types.CallbackQuery):
-    order_id = int(callback.data.replace("card_pay_", ""))
-    order = db.get_order(order_id)
+ORDER_STATUS_NAMES = {
+    "pending": "ожидает выбора оплаты",
+    "waiting_payment": "ожидает оплаты картой",
+    "waiting_crypto": "ожидает оплаты в CryptoBot",
+    "waiting_confirmation": "на проверке",
+    "completed": "выполнен",
+    "cancelled": "отменен",
+    "expired": "истек"
+}
+
+def order_status_text(order_id, status):
+    return f"Заказ #{order_id} {ORDER_STATUS_NAMES.get(status, status)}"
+
+@callbacks.route(CardPayCallback)
+@throttle("payment")
+async def card_payment_handler(callback: types.CallbackQuery, callback_data: CardPayCallback):
+    order_id = callback_data.order_id
+    order = await db.get_order(order_id)
     
     if not order:
         await callback.answer("❌ Заказ не найден")
         return
     
-    user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id = order
-    
-    # Обновляем статус
-    db.update_order_status(order_id, "waiting_payment")
+    # Обновляем статус (поздний тап по старой кнопке не откатит заказ)
+    changed, status = await db.update_order_status(order_id, "waiting_payment", payment_method="card")
+    if not changed:
+        await callback.answer(f"❌ {order_status_text(order_id, status)}", show_alert=True)
+        return
     
     caption = (
         f"💳 **Оплата картой**\n\n"
         f"🆔 Заказ: #{order_id}\n"
-        f"💰 Сумма: {amount_rub:.2f} RUB\n\n"
+        f"💰 Сумма: {order.amount_rub:.2f} RUB\n\n"
         f"**Реквизиты для перевода:**\n"
         f"`{CARD_NUMBER}`\n\n"
         "**Инструкция:**\n"
@@ -716,39 +2606,50 @@ async def card_payment_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 # ========== ОПЛАТА CRYPTOBOT ==========
-@dp.callback_query(F.data.startswith("crypto_pay_"))
-async def crypto_payment_handler(callback: types.CallbackQuery):
+@callbacks.route(CryptoPayCallback)
+@throttle("payment")
+async def crypto_payment_handler(callback: types.CallbackQuery, callback_data: CryptoPayCallback):
     if not cryptobot:
         await callback.answer("❌ CryptoBot временно недоступен")
         return
     
-    order_id = int(callback.data.replace("crypto_pay_", ""))
-    order = db.get_order(order_id)
+    order_id = callback_data.order_id
+    order = await db.get_order(order_id)
     
     if not order:
         await callback.answer("❌ Заказ не найден")
         return
     
-    user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id = order
+    if order.status not in ORDER_TRANSITIONS["waiting_crypto"]:
+        await callback.answer(f"❌ {order_status_text(order_id, order.status)}", show_alert=True)
+        return
     
-    # Создаем счет в CryptoBot
+    # Создаем счет в CryptoBot по текущему курсу
+    usd_rate = pricing.snapshot().usd_rate
     result = await cryptobot.create_invoice(
-        amount=amount_rub,
-        description=f"Заказ #{order_id} | {order_type}"
+        amount=order.amount_rub,
+        description=f"Заказ #{order_id} | {order.order_type}",
+        usd_rate=usd_rate
     )
     
     if result["success"]:
-        # Сохраняем invoice_id
-        db.update_invoice_id(order_id, result["invoice_id"])
-        db.update_order_status(order_id, "waiting_crypto")
+        # Статус, invoice_id и курс счета - одним условным переходом. Если
+        # заказ успел уйти в другой статус, неоплаченный счет просто истечет
+        changed, status = await db.update_order_status(
+            order_id, "waiting_crypto", invoice_id=str(result["invoice_id"]), usd_rate=usd_rate,
+            payment_method="crypto"
+        )
+        if not changed:
+            await callback.answer(f"❌ {order_status_text(order_id, status)}", show_alert=True)
+            return
         
-        # Рассчитываем USDT сумму
-        amount_usdt = amount_rub / 85.0
+        # Сумма счета в USDT
+        amount_usdt = Decimal(result["amount"])
         
         caption = (
             f"💎 **Оплата через CryptoBot**\n\n"
             f"🆔 Заказ: #{order_id}\n"
-            f"💰 Сумма: {amount_rub:.2f} RUB\n"
+            f"💰 Сумма: {order.amount_rub:.2f} RUB\n"
             f"💱 К оплате: {amount_usdt:.2f} USDT\n\n"
             "**Для оплаты:**\n"
             "1. Нажмите кнопку ниже\n"
@@ -759,7 +2660,7 @@ async def crypto_payment_handler(callback: types.CallbackQuery):
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="💎 Оплатить в CryptoBot", url=result["pay_url"])],
-            [InlineKeyboardButton(text="✅ Проверить оплату", callback_data=f"check_crypto_{order_id}")],
+            [InlineKeyboardButton(text="✅ Проверить оплату", callback_data=CheckCryptoCallback(order_id=order_id).pack())],
             [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
         ])
         
@@ -774,93 +2675,74 @@ async def crypto_payment_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 # Обработчик проверки CryptoBot оплаты
-@dp.callback_query(F.data.startswith("check_crypto_"))
-async def check_crypto_payment(callback: types.CallbackQuery):
-    order_id = int(callback.data.replace("check_crypto_", ""))
+@callbacks.route(CheckCryptoCallback)
+@throttle("payment")
+async def check_crypto_payment(callback: types.CallbackQuery, callback_data: CheckCryptoCallback):
+    order_id = callback_data.order_id
+    order = await db.get_order(order_id)
     
-    # Временно просто меняем статус
-    db.update_order_status(order_id, "completed")
+    if not order:
+        await callback.answer("❌ Заказ не найден")
+        return
     
-    order = db.get_order(order_id)
-    if order:
-        user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id = order
+    # Статус обновляет фоновая проверка счетов, здесь только читаем его
+    if order.status == "completed":
+        await callback.answer(
+            "✅ Оплата получена! Товар будет доставлен в течение 15 минут.",
+            show_alert=True
+        )
         
-        # Уведомляем админа о выполненном CryptoBot заказе
-        for admin_id in ADMIN_IDS:
-            try:
-                admin_message = (
-                    f"💎 **CryptoBot оплата получена**\n\n"
-                    f"🆔 Заказ: #{order_id}\n"
-                    f"💰 Сумма: {amount_rub:.2f} RUB\n"
-                    f"📦 Тип: {order_type}\n"
-                )
-                
-                if order_type != "exchange":
-                    admin_message += f"👤 Получатель: {recipient}\n"
-                
-                admin_message += f"\n✅ Статус: оплачено через CryptoBot"
-                
-                await bot.send_message(admin_id, admin_message)
-            except:
-                pass
-    
-    await callback.answer(
-        "✅ Оплата проверена! Товар будет доставлен в течение 15 минут.",
-        show_alert=True
-    )
-    
-    # Возвращаем в главное меню
-    await main_menu_handler(callback)
+        # Возвращаем в главное меню
+        await main_menu_handler(callback)
+    elif order.status == "expired":
+        await callback.answer(
+            "⌛ Срок действия счета истек. Оформите заказ заново.",
+            show_alert=True
+        )
+    else:
+        if invoice_poller:
+            invoice_poller.wakeup()
+        await callback.answer(
+            "⏳ Оплата пока не поступила. Проверка идет автоматически, "
+            "попробуйте через несколько секунд.",
+            show_alert=True
+        )
 
 # ========== ПОДТВЕРЖДЕНИЕ ОПЛАТЫ КАРТОЙ ==========
-@dp.callback_query(F.data.startswith("confirm_paid_"))
-async def confirm_card_payment(callback: types.CallbackQuery):
-    order_id = int(callback.data.replace("confirm_paid_", ""))
-    order = db.get_order(order_id)
+@callbacks.route(ConfirmPaidCallback)
+@throttle("payment")
+async def confirm_card_payment(callback: types.CallbackQuery, callback_data: ConfirmPaidCallback):
+    order_id = callback_data.order_id
+    order = await db.get_order(order_id)
     
     if not order:
         await callback.answer("❌ Заказ не найден")
         return
     
-    user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id = order
+    if order.status not in ORDER_TRANSITIONS["waiting_confirmation"]:
+        await callback.answer(f"❌ {order_status_text(order_id, order.status)}", show_alert=True)
+        return
+    
+    amount_rub = order.amount_rub
     
     # Добавляем ожидание фото
-    user_states[callback.from_user.id] = {
+    await user_states.set(callback.from_user.id, {
         "action": "waiting_payment_photo",
         "order_id": order_id
-    }
+    })
     
     # Для обмена валют показываем особое сообщение
-    if order_type == "exchange":
-        try:
-            details_dict = json.loads(details) if details else {}
-            amount_usd = details_dict.get("amount_usd", amount_rub / USD_RATE)
-            
-            await callback.message.edit_text(
-                f"💱 **Обмен валют**\n\n"
-                f"🆔 Заказ: #{order_id}\n"
-                f"💸 Вы получаете: {amount_usd:.2f} USD\n"
-                f"💰 К оплате: {amount_rub:.2f} RUB\n\n"
-                "📸 **Пришлите фото/скриншот оплаты**\n\n"
-                "Пожалуйста, отправьте скриншот перевода.\n"
-                "После проверки админом USD будут отправлены вам.",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="🔙 Отмена", callback_data=f"cancel_photo_{order_id}")]
-                ])
-            )
-            
-        except:
-            await callback.message.edit_text(
-                f"💱 **Обмен валют**\n\n"
-                f"🆔 Заказ: #{order_id}\n"
-                f"💰 Сумма: {amount_rub:.2f} RUB\n\n"
-                "📸 **Пришлите фото/скриншот оплаты**\n\n"
-                "Пожалуйста, отправьте скриншот перевода.\n"
-                "После проверки админом USD будут отправлены вам.",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="🔙 Отмена", callback_data=f"cancel_photo_{order_id}")]
-                ])
-            )
+    if order.order_type == "exchange":
+        await callback.message.edit_text(
+            f"💱 **Обмен валют**\n\n"
+            f"🆔 Заказ: #{order_id}\n"
+            f"💸 Вы получаете: {order.amount_usd:.2f} USD\n"
+            f"💰 К оплате: {amount_rub:.2f} RUB\n\n"
+            "📸 **Пришлите фото/скриншот оплаты**\n\n"
+            "Пожалуйста, отправьте скриншот перевода.\n"
+            "После проверки админом USD будут отправлены вам.",
+            reply_markup=cancel_photo_kb(order_id)
+        )
     else:
         # Для звезд и премиума обычное сообщение
         await callback.message.edit_text(
@@ -869,26 +2751,35 @@ async def confirm_card_payment(callback: types.CallbackQuery):
             f"💰 Сумма: {amount_rub:.2f} RUB\n\n"
             "Пожалуйста, отправьте скриншот перевода или фото чека.\n"
             "После отправки фото заказ будет передан админу на проверку.",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Отмена", callback_data=f"cancel_photo_{order_id}")]
-            ])
+            reply_markup=cancel_photo_kb(order_id)
         )
     
     await callback.answer()
 
 # Обработчик отмены отправки фото
-@dp.callback_query(F.data.startswith("cancel_photo_"))
-async def cancel_photo_handler(callback: types.CallbackQuery):
-    order_id = int(callback.data.replace("cancel_photo_", ""))
+@callbacks.route(CancelPhotoCallback)
+@throttle("payment")
+async def cancel_photo_handler(callback: types.CallbackQuery, callback_data: CancelPhotoCallback):
+    order_id = callback_data.order_id
     
     # Удаляем состояние
-    if callback.from_user.id in user_states:
-        del user_states[callback.from_user.id]
+    await user_states.delete(callback.from_user.id)
     
     # Возвращаем к оплате картой
-    await card_payment_handler(callback)
+    await card_payment_handler(callback, CardPayCallback(order_id=order_id))
 
 # ========== АДМИН ПАНЕЛЬ ==========
+def stats_text(stats):
+    """Строки статистики для админки. Черновики - неоплаченные заказы,
+    на проверке - заказы с фото оплаты (список «Ожидают проверки»)"""
+    return (
+        f"👥 Пользователей: {stats['total_users']}\n"
+        f"✅ Выполнено заказов: {stats['completed_orders']}\n"
+        f"💰 Выручка: {stats['total_revenue']:.2f} RUB\n"
+        f"⏳ Ожидают проверки: {stats['review_orders']}\n"
+        f"📝 Черновики (не оплачены): {stats['pending_orders']}"
+    )
+
 @dp.message(Command("admin"))
 @dp.message(F.text == "/admin")
 @dp.message(F.text.startswith("/admin"))
@@ -904,15 +2795,12 @@ async def admin_panel(message: types.Message):
         return
     
     # Получаем статистику
-    stats = db.get_statistics()
+    stats = await db.get_statistics()
     
     caption = (
         f"🛠️ **Админ панель**\n\n"
         f"📊 **Статистика:**\n"
-        f"👥 Пользователей: {stats['total_users']}\n"
-        f"✅ Выполнено заказов: {stats['completed_orders']}\n"
-        f"💰 Выручка: {stats['total_revenue']:.2f} RUB\n"
-        f"⏳ Ожидают проверки: {stats['pending_orders']}\n\n"
+        f"{stats_text(stats)}\n\n"
         "Выберите действие:"
     )
     
@@ -927,55 +2815,174 @@ async def get_my_id(message: types.Message):
                         f"Добавьте этот ID в переменную ADMIN_IDS", 
                         parse_mode="Markdown")
 
-@dp.callback_query(F.data == "admin_stats")
+@callbacks.route("admin_stats")
+@throttle("admin")
 async def admin_stats_handler(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    stats = db.get_statistics()
+    stats = await db.get_statistics()
     
     caption = (
         f"📊 **Статистика магазина**\n\n"
-        f"👥 Пользователей: {stats['total_users']}\n"
-        f"✅ Выполнено заказов: {stats['completed_orders']}\n"
-        f"💰 Выручка: {stats['total_revenue']:.2f} RUB\n"
-        f"⏳ Ожидают проверки: {stats['pending_orders']}"
+        f"{stats_text(stats)}"
     )
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_stats")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-    ])
-    
     await callback.message.edit_text(
         text=caption,
-        reply_markup=keyboard,
+        reply_markup=admin_stats_kb(),
         parse_mode="Markdown"
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_pending")
-async def admin_pending_handler(callback: types.CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
-        await callback.answer("❌ Доступ запрещен")
-        return
-    
-    orders = db.get_pending_orders()
+ADMIN_PAGE_SIZE = 10
+# Получатель вводится пользователем: в списке - не длиннее этого
+RECIPIENT_PREVIEW = 32
+# Служебные символы parse_mode="Markdown"
+MARKDOWN_ESCAPE = str.maketrans({char: "\\" + char for char in "_*`["})
+
+def md_escape(text):
+    """Экранировать текст для parse_mode="Markdown" (иначе 'can't parse entities')"""
+    return str(text).translate(MARKDOWN_ESCAPE)
+
+def shorten(text, limit=RECIPIENT_PREVIEW):
+    text = str(text or "")
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+ADMIN_ORDER_VIEWS = {
+    "waiting_confirmation": "⏳ **Заказы, ожидающие проверки:**",
+    "pending": "📝 **Черновики (не оплачены):**",
+    "completed": "✅ **Выполненные заказы:**"
+}
+ADMIN_TYPE_FILTERS = list(get_args(AdminOrderType))
+ADMIN_METHOD_FILTERS = list(get_args(AdminPaymentMethod))
+# Списки, в которых заказы можно отмечать, и доступные в них массовые
+# действия. Черновики не оплачены - их можно только отменить
+ADMIN_BULK_VIEWS = {
+    "waiting_confirmation": ("complete", "cancel"),
+    "pending": ("cancel",)
+}
+ADMIN_BULK_BUTTONS = {
+    "complete": "✅ Выполнить",
+    "cancel": "❌ Отменить"
+}
+ADMIN_REFRESH_TEXT = "🔄 Обновить"
+ADMIN_SELECT_PREFIX = f"{AdminSelectCallback.__prefix__}:"
+ADMIN_TOGGLE_PREFIX = f"{ADMIN_SELECT_PREFIX}toggle:"
+
+def admin_orders_data(status, order_type="all", method="all", direction="n", cursor=0):
+    return AdminOrdersCallback(
+        status=status, order_type=order_type, method=method, direction=direction, cursor=cursor
+    ).pack()
+
+def next_filter(values, current):
+    return values[(values.index(current) + 1) % len(values)]
+
+def order_select_rows(page_ids, selected, actions):
+    """Кнопки-отметки заказов страницы и массовые действия actions над отмеченными"""
+    toggles = [
+        InlineKeyboardButton(
+            text=f"{'☑️' if order_id in selected else '⬜️'} #{order_id}",
+            callback_data=AdminSelectCallback(action="toggle", order_id=order_id).pack()
+        )
+        for order_id in page_ids
+    ]
+    rows = [toggles[i:i + 2] for i in range(0, len(toggles), 2)]
+    rows.append([
+        InlineKeyboardButton(text="☑️ Вся страница", callback_data=AdminSelectCallback(action="all").pack()),
+        InlineKeyboardButton(text="⬜️ Снять", callback_data=AdminSelectCallback(action="none").pack())
+    ])
+    rows.append([
+        InlineKeyboardButton(
+            text=f"{ADMIN_BULK_BUTTONS[action]} ({len(selected)})",
+            callback_data=AdminSelectCallback(action=action).pack()
+        )
+        for action in actions
+    ])
+    return rows
+
+def parse_order_selection(markup):
+    """(id заказов страницы, отмеченные id) по кнопкам сообщения.
+
+    Отметки живут только в клавиатуре, поэтому на сервере для них нет
+    состояния и они переживают перезапуск бота.
+    """
+    page_ids, selected = [], set()
+    for row in markup.inline_keyboard:
+        for button in row:
+            if (button.callback_data or "").startswith(ADMIN_TOGGLE_PREFIX):
+                order_id = AdminSelectCallback.unpack(button.callback_data).order_id
+                page_ids.append(order_id)
+                if button.text.startswith("☑️"):
+                    selected.add(order_id)
+    return page_ids, selected
+
+def with_selection(markup, page_ids, selected, actions):
+    """Та же клавиатура с новыми отметками"""
+    rows = [
+        row for row in markup.inline_keyboard
+        if not any((button.callback_data or "").startswith(ADMIN_SELECT_PREFIX) for button in row)
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=order_select_rows(page_ids, selected, actions) + rows)
+
+def orders_page_view(markup):
+    """Параметры открытой страницы списка - из кнопки обновления"""
+    for row in markup.inline_keyboard:
+        for button in row:
+            if button.text == ADMIN_REFRESH_TEXT:
+                return AdminOrdersCallback.unpack(button.callback_data)
+    return None
+
+async def show_orders_page(callback, status, order_type="all", method="all", direction="n", cursor=0):
+    rows, has_prev, has_next = await db.get_orders_page(
+        status,
+        limit=ADMIN_PAGE_SIZE,
+        cursor=cursor or None,
+        direction="next" if direction == "n" else "prev",
+        order_type=None if order_type == "all" else order_type,
+        payment_method=None if method == "all" else method
+    )
     
-    if not orders:
-        text = "⏳ Нет заказов, ожидающих проверки"
-    else:
-        text = "⏳ **Заказы, ожидающие проверки:**\n\n"
-        for order in orders:
-            order_id, user_id, order_type, recipient, amount_rub, payment_method, created_at = order
-            text += f"🆔 #{order_id} | {order_type} | {amount_rub:.2f} RUB\n"
-            text += f"👤 {recipient} | 💳 {payment_method}\n"
-            text += f"📅 {created_at}\n"
-            text += f"🔍 /check_{order_id}\n\n"
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_pending")],
+    text = f"{ADMIN_ORDER_VIEWS[status]}\n"
+    text += f"📦 Тип: {order_type} | 💳 Метод: {method}\n\n"
+    
+    if not rows:
+        text += "Нет заказов"
+    for order_id, user_id, row_type, recipient, amount_rub, payment_method, created_at in rows:
+        text += f"🆔 #{order_id} | {row_type} | {amount_rub:.2f} RUB\n"
+        text += f"👤 {md_escape(shorten(recipient))} | 💳 {payment_method}\n"
+        text += f"📅 {created_at}\n"
+        text += f"🔍 /check\\_{order_id}\n\n"
+    
+    nav = []
+    if rows and has_prev:
+        nav.append(InlineKeyboardButton(
+            text="⬅️", callback_data=admin_orders_data(status, order_type, method, "p", rows[0][0])
+        ))
+    if rows and has_next:
+        nav.append(InlineKeyboardButton(
+            text="➡️", callback_data=admin_orders_data(status, order_type, method, "n", rows[-1][0])
+        ))
+    
+    rows_kb = [nav] if nav else []
+    if rows and status in ADMIN_BULK_VIEWS:
+        rows_kb = order_select_rows([row[0] for row in rows], set(), ADMIN_BULK_VIEWS[status]) + rows_kb
+    keyboard = InlineKeyboardMarkup(inline_keyboard=rows_kb + [
+        [
+            InlineKeyboardButton(
+                text=f"📦 {order_type}",
+                callback_data=admin_orders_data(status, next_filter(ADMIN_TYPE_FILTERS, order_type), method)
+            ),
+            InlineKeyboardButton(
+                text=f"💳 {method}",
+                callback_data=admin_orders_data(status, order_type, next_filter(ADMIN_METHOD_FILTERS, method))
+            )
+        ],
+        [InlineKeyboardButton(
+            text=ADMIN_REFRESH_TEXT,
+            callback_data=admin_orders_data(status, order_type, method, direction, cursor)
+        )],
         [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
     ])
     
@@ -986,42 +2993,102 @@ async def admin_pending_handler(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_completed")
-async def admin_completed_handler(callback: types.CallbackQuery):
+@callbacks.route("admin_pending")
+@throttle("admin")
+async def admin_pending_handler(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    # Временно просто сообщение
-    text = "✅ **Выполненные заказы**\n\nЗдесь будут отображаться выполненные заказы"
+    await show_orders_page(callback, "waiting_confirmation")
+
+@callbacks.route("admin_drafts")
+@throttle("admin")
+async def admin_drafts_handler(callback: types.CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("❌ Доступ запрещен")
+        return
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_completed")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-    ])
+    await show_orders_page(callback, "pending")
+
+@callbacks.route("admin_completed")
+@throttle("admin")
+async def admin_completed_handler(callback: types.CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("❌ Доступ запрещен")
+        return
     
-    await callback.message.edit_text(
-        text=text,
-        reply_markup=keyboard,
-        parse_mode="Markdown"
+    await show_orders_page(callback, "completed")
+
+@callbacks.route(AdminOrdersCallback)
+@throttle("admin")
+async def admin_orders_handler(callback: types.CallbackQuery, callback_data: AdminOrdersCallback):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("❌ Доступ запрещен")
+        return
+    
+    await show_orders_page(
+        callback,
+        callback_data.status,
+        callback_data.order_type,
+        callback_data.method,
+        callback_data.direction,
+        callback_data.cursor
     )
+
+@callbacks.route(AdminSelectCallback)
+async def admin_select_handler(callback: types.CallbackQuery, callback_data: AdminSelectCallback):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("❌ Доступ запрещен")
+        return
+    
+    markup = callback.message.reply_markup
+    page_ids, selected = parse_order_selection(markup)
+    view = orders_page_view(markup)
+    actions = ADMIN_BULK_VIEWS.get(view.status, ()) if view else ()
+    action = callback_data.action
+    
+    if action in ADMIN_BULK_ACTIONS:
+        if action not in actions:
+            await callback.answer("❌ Недоступно в этом списке", show_alert=True)
+            return
+        if not selected:
+            await callback.answer("Отметьте заказы")
+            return
+        
+        status = ADMIN_BULK_ACTIONS[action]
+        results = await apply_bulk_status(sorted(selected), status)
+        await callback.message.answer(bulk_summary(status, results))
+        
+        await show_orders_page(callback, view.status, view.order_type, view.method, view.direction, view.cursor)
+        return
+    
+    if action == "toggle":
+        new_selected = selected ^ {callback_data.order_id}
+    elif action == "all":
+        new_selected = set(page_ids)
+    else:
+        new_selected = set()
+    
+    # Telegram отклоняет редактирование без изменений
+    if new_selected != selected:
+        await callback.message.edit_reply_markup(
+            reply_markup=with_selection(markup, page_ids, new_selected, actions)
+        )
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_back")
+@callbacks.route("admin_back")
 async def admin_back_handler(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    stats = db.get_statistics()
+    stats = await db.get_statistics()
     
     caption = (
         f"🛠️ **Админ панель**\n\n"
         f"📊 **Статистика:**\n"
-        f"👥 Пользователей: {stats['total_users']}\n"
-        f"✅ Выполнено заказов: {stats['completed_orders']}\n"
-        f"💰 Выручка: {stats['total_revenue']:.2f} RUB\n"
-        f"⏳ Ожидают проверки: {stats['pending_orders']}\n\n"
+        f"{stats_text(stats)}\n\n"
         "Выберите действие:"
     )
     
@@ -1033,6 +3100,18 @@ async def admin_back_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 # ========== КОМАНДЫ АДМИНА ==========
+async def change_order_status(order_id, status):
+    """Перевести заказ в status, в той же транзакции поставив в outbox
+    уведомление покупателю. Результат как у Database.update_order_status"""
+    order = await db.get_order(order_id)
+    if order is None:
+        return False, None
+    
+    changed, current = await db.update_order_status(order_id, status, outbox=buyer_status_outbox(order, status))
+    if changed:
+        outbox_sender.wakeup()
+    return changed, current
+
 @dp.message(F.text.startswith("/check_"))
 async def check_order_command(message: types.Message):
     if message.from_user.id not in ADMIN_IDS:
@@ -1040,46 +3119,43 @@ async def check_order_command(message: types.Message):
     
     try:
         order_id = int(message.text.split("_")[1])
-        order = db.get_order(order_id)
+        order = await db.get_order(order_id)
         
         if not order:
             await message.answer(f"❌ Заказ #{order_id} не найден")
             return
         
-        user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id = order
-        
-        # Пытаемся получить фото из details
-        try:
-            if details:
-                details_dict = json.loads(details)
-                if "payment_photo" in details_dict:
-                    photo_file_id = details_dict["payment_photo"]
-                    # Отправляем фото админу
-                    await bot.send_photo(
-                        message.chat.id,
-                        photo=photo_file_id,
-                        caption=f"📸 Фото оплаты заказа #{order_id}"
-                    )
-        except:
-            pass
+        if order.payment_photo:
+            # Отправляем фото админу
+            await bot.send_photo(
+                message.chat.id,
+                photo=order.payment_photo,
+                caption=f"📸 Фото оплаты заказа #{order_id}"
+            )
         
         text = (
             f"🔍 **Заказ #{order_id}**\n\n"
-            f"👤 User ID: {user_id}\n"
-            f"📦 Тип: {order_type}\n"
+            f"👤 User ID: {order.user_id}\n"
+            f"📦 Тип: {order.order_type}\n"
         )
         
-        if order_type != "exchange":
-            text += f"👤 Получатель: {recipient}\n"
+        if order.order_type != "exchange":
+            text += f"👤 Получатель: {md_escape(shorten(order.recipient, 256))}\n"
+        if order.stars:
+            text += f"⭐️ Звезд: {order.stars}\n"
+        if order.period:
+            text += f"👑 Период: {order.period}\n"
+        if order.amount_usd is not None:
+            text += f"💸 К выдаче: {order.amount_usd:.2f} USD\n"
         
         text += (
-            f"💰 Сумма: {amount_rub:.2f} RUB\n"
-            f"💳 Метод: {payment_method}\n"
-            f"📊 Статус: {status}\n\n"
+            f"💰 Сумма: {order.amount_rub:.2f} RUB\n"
+            f"💳 Метод: {order.payment_method}\n"
+            f"📊 Статус: {order.status}\n\n"
             "**Действия:**\n"
-            f"✅ Подтвердить: /confirm_{order_id}\n"
-            f"✅ Выполнить: /complete_{order_id}\n"
-            f"❌ Отменить: /cancel_{order_id}"
+            f"✅ Подтвердить: /confirm\\_{order_id}\n"
+            f"✅ Выполнить: /complete\\_{order_id}\n"
+            f"❌ Отменить: /cancel\\_{order_id}"
         )
         
         await message.answer(text, parse_mode="Markdown")
@@ -1094,12 +3170,14 @@ async def confirm_order_command(message: types.Message):
     
     try:
         order_id = int(message.text.split("_")[1])
-        success = db.update_order_status(order_id, "completed")
+        changed, status = await change_order_status(order_id, "completed")
         
-        if success:
+        if changed:
             await message.answer(f"✅ Заказ #{order_id} подтвержден")
-        else:
+        elif status is None:
             await message.answer(f"❌ Заказ #{order_id} не найден")
+        else:
+            await message.answer(f"❌ Заказ #{order_id} в статусе {status}, переход в completed запрещен")
     
     except (ValueError, IndexError):
         await message.answer("❌ Формат: /confirm_123")
@@ -1111,12 +3189,14 @@ async def complete_order_command(message: types.Message):
     
     try:
         order_id = int(message.text.split("_")[1])
-        success = db.update_order_status(order_id, "completed")
+        changed, status = await change_order_status(order_id, "completed")
         
-        if success:
+        if changed:
             await message.answer(f"✅ Заказ #{order_id} выполнен")
-        else:
+        elif status is None:
             await message.answer(f"❌ Заказ #{order_id} не найден")
+        else:
+            await message.answer(f"❌ Заказ #{order_id} в статусе {status}, переход в completed запрещен")
     
     except (ValueError, IndexError):
         await message.answer("❌ Формат: /complete_123")
@@ -1128,16 +3208,410 @@ async def cancel_order_command(message: types.Message):
     
     try:
         order_id = int(message.text.split("_")[1])
-        success = db.update_order_status(order_id, "cancelled")
+        changed, status = await change_order_status(order_id, "cancelled")
         
-        if success:
+        if changed:
             await message.answer(f"❌ Заказ #{order_id} отменен")
-        else:
+        elif status is None:
             await message.answer(f"❌ Заказ #{order_id} не найден")
+        else:
+            await message.answer(f"❌ Заказ #{order_id} в статусе {status}, переход в cancelled запрещен")
     
     except (ValueError, IndexError):
         await message.answer("❌ Формат: /cancel_123")
 
+# Массовые команды: /complete 101-180 185 (одиночные - /complete_101)
+BULK_MAX_ORDERS = int(os.environ.get("BULK_MAX_ORDERS", "500"))
+ADMIN_BULK_ACTIONS = {
+    "confirm": "completed",
+    "complete": "completed",
+    "cancel": "cancelled"
+}
+BULK_STATUS_TITLES = {
+    "completed": "✅ Выполнено",
+    "cancelled": "❌ Отменено"
+}
+# Лимит длины сообщения Telegram
+MESSAGE_LIMIT = 4096
+
+def parse_order_ids(text, limit=BULK_MAX_ORDERS):
+    """'101-180 185, 190' -> [101, ..., 180, 185, 190]: по возрастанию, без
+    повторов. ValueError при ошибке формата или больше limit заказов"""
+    order_ids = set()
+    for token in text.replace(",", " ").split():
+        first, _, last = token.partition("-")
+        first = int(first)
+        last = int(last) if last else first
+        if first <= 0 or last < first or last - first >= limit:
+            raise ValueError(token)
+        order_ids.update(range(first, last + 1))
+        if len(order_ids) > limit:
+            raise ValueError(text)
+    
+    if not order_ids:
+        raise ValueError(text)
+    return sorted(order_ids)
+
+def format_id_ranges(order_ids):
+    """[1, 2, 3, 5] -> '#1-3, #5'"""
+    parts = []
+    start = prev = None
+    for order_id in sorted(order_ids) + [None]:
+        if prev is not None and order_id == prev + 1:
+            prev = order_id
+            continue
+        if start is not None:
+            parts.append(f"#{start}" if start == prev else f"#{start}-{prev}")
+        start = prev = order_id
+    return ", ".join(parts)
+
+def bulk_summary(status, results):
+    """Итог массовой смены статуса по каждому id: обработанные и
+    пропущенные с причиной (текущий статус или 'не найден')"""
+    done = [order_id for order_id, changed, _ in results if changed]
+    skipped = {}
+    for order_id, changed, current in results:
+        if not changed:
+            skipped.setdefault(current, []).append(order_id)
+    
+    text = f"{BULK_STATUS_TITLES[status]}: {len(done)} из {len(results)}\n"
+    if done:
+        text += f"{format_id_ranges(done)}\n"
+    for current, order_ids in skipped.items():
+        reason = "не найдены" if current is None else ORDER_STATUS_NAMES.get(current, current)
+        text += f"\n⚠️ Пропущены ({reason}): {format_id_ranges(order_ids)}"
+    
+    if len(text) > MESSAGE_LIMIT:
+        text = text[:MESSAGE_LIMIT - 1] + "…"
+    return text
+
+async def apply_bulk_status(order_ids, status):
+    """Перевести заказы в status одной транзакцией, в той же транзакции
+    поставив в outbox уведомления покупателям реально измененных заказов"""
+    orders = await db.get_orders(order_ids)
+    outbox = {order_id: buyer_status_outbox(order, status) for order_id, order in orders.items()}
+    
+    results = await db.bulk_update_status(order_ids, status, outbox=outbox)
+    if any(changed for _, changed, _ in results):
+        outbox_sender.wakeup()
+    return results
+
+@dp.message(Command(*ADMIN_BULK_ACTIONS))
+@throttle("admin")
+async def bulk_status_command(message: types.Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    try:
+        order_ids = parse_order_ids(command.args or "")
+    except ValueError:
+        await message.answer(
+            f"❌ Формат: /{command.command} 101-180 185\n"
+            f"Не больше {BULK_MAX_ORDERS} заказов за раз"
+        )
+        return
+    
+    status = ADMIN_BULK_ACTIONS[command.command]
+    results = await apply_bulk_status(order_ids, status)
+    await message.answer(bulk_summary(status, results))
+
+@dp.message(Command("stats_check"))
+async def stats_check_command(message: types.Message):
+    """Сверить счетчики статистики с данными и исправить расхождения"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    drift = await db.check_statistics(repair=True)
+    
+    if not drift:
+        await message.answer("✅ Статистика согласована")
+        return
+    
+    text = "⚠️ Найдены расхождения (исправлены):\n\n"
+    for name, (stored, actual) in drift.items():
+        text += f"• {name}: {stored} → {actual}\n"
+    
+    await message.answer(text)
+
+# ========== ПРОВЕРКА ОПЛАТЫ CRYPTOBOT ==========
+CRYPTO_POLL_MIN_INTERVAL = float(os.environ.get("CRYPTO_POLL_MIN_INTERVAL", "3"))
+CRYPTO_POLL_MAX_INTERVAL = float(os.environ.get("CRYPTO_POLL_MAX_INTERVAL", "60"))
+
+# Статус счета CryptoBot -> статус заказа (active оставляет waiting_crypto)
+INVOICE_STATUS_MAP = {
+    "paid": "completed",
+    "expired": "expired"
+}
+
+def crypto_paid_outbox(order):
+    """Уведомления админам об оплаченном через CryptoBot заказе"""
+    admin_message = (
+        f"💎 **CryptoBot оплата получена**\n\n"
+        f"🆔 Заказ: #{order.id}\n"
+        f"💰 Сумма: {order.amount_rub:.2f} RUB\n"
+        f"📦 Тип: {order.order_type}\n"
+    )
+    
+    if order.order_type != "exchange":
+        admin_message += f"👤 Получатель: {order.recipient}\n"
+    
+    admin_message += f"\n✅ Статус: оплачено через CryptoBot"
+    
+    return admin_outbox(("send_message", {"text": admin_message}))
+
+def lost_payment_outbox(order):
+    """Уведомления админам: счет оплачен, но заказ уже не ждал оплаты.
+    Ключ схлопывает неотправленные дубли от вебхука и поллера"""
+    admin_message = (
+        f"⚠️ **CryptoBot оплата без заказа**\n\n"
+        f"🆔 Заказ: #{order.id}\n"
+        f"👤 ID покупателя: {order.user_id}\n"
+        f"💰 Сумма: {order.amount_rub:.2f} RUB\n\n"
+        "Счет оплачен, но заказ к этому моменту уже не ожидал оплаты "
+        "(отменен или истек). Проверьте заказ и верните деньги или выполните его.\n"
+        f"Для проверки: /check_{order.id}"
+    )
+    calls = (("send_message", {"text": admin_message}),)
+    return [(admin_id, calls, f"lost_payment:{order.id}:{admin_id}") for admin_id in ADMIN_IDS]
+
+async def apply_invoice_updates(database, updates):
+    """Применить статусы счетов, записав в outbox уведомления админам о
+    новых оплатах и покупателям об оплате или истечении счета.
+
+    Повторное применение того же статуса ничего не меняет, поэтому
+    дубли от вебхука и поллера безопасны. Оплата заказа, который уже
+    отменен или истек, не меняет его статус: об этом пишется предупреждение
+    в лог и уведомление админам.
+    Возвращает список реально обновленных id.
+    """
+    orders = await database.get_orders([order_id for order_id, _ in updates])
+    outbox = {}
+    lost_outbox = {}
+    for order_id, status in updates:
+        order = orders.get(order_id)
+        if order is None:
+            continue
+        messages = buyer_status_outbox(order, status)
+        if status == "completed":
+            messages = crypto_paid_outbox(order) + messages
+            lost_outbox[order_id] = lost_payment_outbox(order)
+        if messages:
+            outbox[order_id] = messages
+    
+    results = await database.apply_invoice_statuses(updates, outbox=outbox, lost_outbox=lost_outbox)
+    lost = [
+        (order_id, current) for (order_id, changed, current), (_, status) in zip(results, updates)
+        if not changed and status == "completed" and current not in (None, "completed")
+    ]
+    for order_id, current in lost:
+        logger.warning(f"Счет CryptoBot оплачен, но {order_status_text(order_id, current)}")
+    if outbox or lost:
+        outbox_sender.wakeup()
+    return [order_id for order_id, changed, _ in results if changed]
+
+class InvoicePoller:
+    """Фоновая проверка счетов CryptoBot.
+
+    Все заказы в waiting_crypto проверяются одним запросом getInvoices
+    за интервал. Интервал адаптивный: минимальный, пока есть ожидающие
+    счета и что-то меняется, и растет до максимального, когда ждать нечего.
+    """
+
+    def __init__(self, api, database, min_interval=CRYPTO_POLL_MIN_INTERVAL,
+                 max_interval=CRYPTO_POLL_MAX_INTERVAL, batch_size=100):
+        self.api = api
+        self.db = database
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.batch_size = batch_size
+        self.interval = min_interval
+        self._wakeup = asyncio.Event()
+        self._task = None
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    def wakeup(self):
+        """Сбросить интервал до минимального (например, пользователь ждет оплату)"""
+        self._wakeup.set()
+    
+    async def poll_once(self):
+        """Один проход. Возвращает (ожидающих заказов, обновленных заказов)"""
+        waiting = await self.db.get_crypto_waiting_orders()
+        if not waiting:
+            return 0, []
+        
+        orders_by_invoice = {str(invoice_id): order_id for order_id, invoice_id in waiting}
+        invoice_ids = list(orders_by_invoice)
+        updates = []
+        
+        for i in range(0, len(invoice_ids), self.batch_size):
+            invoices = await self.api.get_invoices(invoice_ids=invoice_ids[i:i + self.batch_size])
+            for invoice in invoices:
+                status = INVOICE_STATUS_MAP.get(invoice.get("status"))
+                order_id = orders_by_invoice.get(str(invoice.get("invoice_id")))
+                if status and order_id:
+                    updates.append((order_id, status))
+        
+        changed = await apply_invoice_updates(self.db, updates) if updates else []
+        return len(waiting), changed
+    
+    async def _run(self):
+        while True:
+            try:
+                waiting, changed = await self.poll_once()
+                if changed:
+                    self.interval = self.min_interval
+                elif waiting:
+                    self.interval = min(self.interval * 1.5, self.max_interval)
+                else:
+                    self.interval = self.max_interval
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Ошибка проверки счетов CryptoBot: {e}")
+                self.interval = min(self.interval * 2, self.max_interval)
+            
+            if await wait_event(self._wakeup, self.interval):
+                # Разбудили: не чаще одного запроса в min_interval
+                self._wakeup.clear()
+                self.interval = self.min_interval
+                await asyncio.sleep(self.min_interval)
+
+invoice_poller = InvoicePoller(cryptobot, db) if cryptobot else None
+
+# ========== ВЕБХУК CRYPTOBOT ==========
+WEB_HOST = os.environ.get("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.environ.get("WEB_PORT", "8080"))
+CRYPTOBOT_WEBHOOK_PATH = os.environ.get("CRYPTOBOT_WEBHOOK_PATH", "")
+
+def verify_cryptobot_signature(token, body, signature):
+    """Проверить подпись crypto-pay-api-signature.
+
+    Подпись - HMAC-SHA256 тела запроса, ключ - SHA256 от токена приложения.
+    """
+    if not signature:
+        return False
+    secret = hashlib.sha256(token.encode()).digest()
+    expected = hmac.new(secret, body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+async def cryptobot_webhook_handler(request):
+    body = await request.read()
+    
+    if not verify_cryptobot_signature(CRYPTOBOT_TOKEN, body, request.headers.get("crypto-pay-api-signature", "")):
+        return web.Response(status=401)
+    
+    try:
+        update = json.loads(body)
+    except ValueError:
+        return web.Response(status=400)
+    
+    if update.get("update_type") == "invoice_paid":
+        invoice = update.get("payload") or {}
+        order_id = await db.get_order_id_by_invoice(invoice.get("invoice_id"))
+        status = INVOICE_STATUS_MAP.get(invoice.get("status", "paid"))
+        
+        if order_id and status:
+            await apply_invoice_updates(db, [(order_id, status)])
+    
+    # Всегда 200 на валидный запрос, иначе CryptoBot будет повторять доставку
+    return web.json_response({"ok": True})
+
+# ========== ВЕБХУК TELEGRAM ==========
+# polling (по умолчанию) или webhook
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+TELEGRAM_WEBHOOK_URL = os.environ.get("TELEGRAM_WEBHOOK_URL", "").rstrip("/")
+TELEGRAM_WEBHOOK_PATH = os.environ.get("TELEGRAM_WEBHOOK_PATH", "/telegram")
+TELEGRAM_WEBHOOK_SECRET = os.environ.get("TELEGRAM_WEBHOOK_SECRET", "")
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "50"))
+SHUTDOWN_DRAIN_TIMEOUT = float(os.environ.get("SHUTDOWN_DRAIN_TIMEOUT", "30"))
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """Ограничивает число одновременно обрабатываемых апдейтов.
+
+    Считает апдейты в обработке (включая ждущие семафор), чтобы при
+    остановке дождаться их завершения через drain().
+    """
+
+    def __init__(self, limit):
+        self._semaphore = asyncio.Semaphore(limit)
+        self._in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+    
+    @property
+    def in_flight(self):
+        return self._in_flight
+    
+    async def __call__(self, handler, event, data):
+        self._in_flight += 1
+        self._idle.clear()
+        try:
+            async with self._semaphore:
+                return await handler(event, data)
+        finally:
+            self._in_flight -= 1
+            if not self._in_flight:
+                self._idle.set()
+    
+    async def drain(self, timeout):
+        """Дождаться завершения обработчиков. False, если не успели за timeout"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+update_limiter = ConcurrencyLimitMiddleware(UPDATE_CONCURRENCY)
+dp.update.outer_middleware(update_limiter)
+
+async def wait_for_shutdown():
+    """Ждать SIGINT/SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    await stop.wait()
+
+def build_web_app():
+    """HTTP приложение для вебхуков. None, если ни один вебхук не включен"""
+    app = web.Application()
+    
+    if CRYPTOBOT_WEBHOOK_PATH and CRYPTOBOT_TOKEN:
+        app.router.add_post(CRYPTOBOT_WEBHOOK_PATH, cryptobot_webhook_handler)
+    
+    if BOT_MODE == "webhook":
+        SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=TELEGRAM_WEBHOOK_SECRET or None,
+            handle_in_background=True
+        ).register(app, path=TELEGRAM_WEBHOOK_PATH)
+    
+    if not app.router.routes():
+        return None
+    return app
+
+def build_metrics_app():
+    """Отдельное приложение для /metrics, чтобы не выставлять его наружу вместе с вебхуками"""
+    app = web.Application()
+    app.router.add_get(METRICS_PATH, metrics_handler)
+    return app
+
 # ========== ЗАПУСК БОТА ==========
 async def main():
     print("=" * 50)
@@ -1153,15 +3627,83 @@ async def main():
     print(f"💎 CryptoBot: {'✅ Настроен' if CRYPTOBOT_TOKEN else '❌ Нет токена'}")
     print(f"💳 Карта: {CARD_NUMBER}")
     print(f"⭐️ Курс звезд: 1 звезда = {STAR_RATE} RUB")
-    print(f"💱 Курс обмена: 1 USD = {USD_RATE} RUB")
+    print(f"💱 Курс обмена: {RATE_SOURCE}, по умолчанию 1 USD = {USD_RATE} RUB")
+    print(f"📡 Режим: {BOT_MODE}")
     print("=" * 50)
     
+    if BOT_MODE == "webhook" and not TELEGRAM_WEBHOOK_URL:
+        print("❌ ОШИБКА: для BOT_MODE=webhook нужен TELEGRAM_WEBHOOK_URL!")
+        exit(1)
+    
+    # Статические клавиатуры строим заранее, до первого апдейта
+    for build_kb in (main_menu_kb, back_to_main_kb, admin_menu_kb, admin_stats_kb, premium_periods_kb, info_kb):
+        build_kb()
+    
+    await pricing.start()
+    print(f"💱 Текущий курс: 1 USD = {pricing.snapshot().usd_rate:.2f} RUB")
+    
+    if invoice_poller:
+        invoice_poller.start()
+    
+    state_evictor = asyncio.create_task(evict_states_loop(user_states))
+    throttle_evictor = asyncio.create_task(evict_throttle_loop(throttler))
+    draft_sweeper = asyncio.create_task(expire_drafts_loop(db))
+    notifier.start()
+    outbox_sender.start()
+    
+    web_runner = None
+    web_site = None
+    web_app = build_web_app()
+    if web_app:
+        web_runner = web.AppRunner(web_app)
+        await web_runner.setup()
+        web_site = web.TCPSite(web_runner, WEB_HOST, WEB_PORT)
+        await web_site.start()
+        print(f"🌐 HTTP сервер: {WEB_HOST}:{WEB_PORT}")
+    
+    metrics_runner = None
+    if METRICS_PORT:
+        metrics_runner = web.AppRunner(build_metrics_app(), access_log=None)
+        await metrics_runner.setup()
+        await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT).start()
+        print(f"📈 Метрики: http://{METRICS_HOST}:{METRICS_PORT}{METRICS_PATH}")
+    
     try:
-        await dp.start_polling(bot)
+        if BOT_MODE == "webhook":
+            await bot.set_webhook(
+                f"{TELEGRAM_WEBHOOK_URL}{TELEGRAM_WEBHOOK_PATH}",
+                secret_token=TELEGRAM_WEBHOOK_SECRET or None,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+            await wait_for_shutdown()
+        else:
+            # Снимаем вебхук, если бот раньше работал в режиме webhook
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     except Exception as e:
         print(f"❌ Ошибка: {e}")
     finally:
+        # Перестаем принимать запросы и даем текущим обработчикам завершиться
+        if web_site:
+            await web_site.stop()
+        if not await update_limiter.drain(SHUTDOWN_DRAIN_TIMEOUT):
+            print(f"⚠️ Не завершено обработчиков: {update_limiter.in_flight}")
+        if web_runner:
+            await web_runner.cleanup()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        state_evictor.cancel()
+        throttle_evictor.cancel()
+        draft_sweeper.cancel()
+        await outbox_sender.stop()
+        await notifier.stop()
+        if invoice_poller:
+            await invoice_poller.stop()
+        await pricing.stop()
+        if cryptobot:
+            await cryptobot.close()
         await bot.session.close()
+        await db.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
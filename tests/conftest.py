@@ -0,0 +1,66 @@
+import os
+import sys
+import tempfile
+
+# newdig читает конфигурацию при импорте и открывает digistore.db в текущем
+# каталоге, поэтому окружение и каталог готовим до импорта в тестах
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("CRYPTOBOT_TOKEN", "test-cryptobot-token")
+os.environ.setdefault("CRYPTOBOT_WEBHOOK_PATH", "/cryptobot")
+os.chdir(tempfile.mkdtemp(prefix="newdig-tests-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import newdig
+
+ADMIN_ID = 777
+
+
+class FakeMessage:
+    """Сообщение с кнопками: запоминает правки и ответы бота"""
+
+    def __init__(self, reply_markup=None, text=None, user_id=ADMIN_ID):
+        self.reply_markup = reply_markup
+        self.text = text
+        self.from_user = SimpleNamespace(id=user_id)
+        self.edits = []
+        self.answers = []
+
+    async def edit_text(self, text, reply_markup=None, parse_mode=None):
+        self.edits.append((text, parse_mode))
+        self.reply_markup = reply_markup
+
+    async def edit_reply_markup(self, reply_markup=None):
+        self.reply_markup = reply_markup
+
+    async def answer(self, text, **kwargs):
+        self.answers.append(text)
+
+
+class FakeCallback:
+    def __init__(self, message=None, user_id=ADMIN_ID):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.message = message or FakeMessage()
+        self.answers = []
+
+    async def answer(self, text=None, show_alert=False):
+        self.answers.append(text)
+
+
+@pytest.fixture
+def database(tmp_path):
+    return newdig.Database(str(tmp_path / "test.db"))
+
+
+@pytest.fixture
+def adb(database, monkeypatch):
+    """AsyncDatabase вместо глобальной newdig.db, ADMIN_ID - единственный админ"""
+    adb = newdig.AsyncDatabase(database)
+    monkeypatch.setattr(newdig, "db", adb)
+    monkeypatch.setattr(newdig, "ADMIN_IDS", [ADMIN_ID])
+    yield adb
+    asyncio.run(adb.close())
@@ -0,0 +1,121 @@
+"""Список заказов в админке: фильтры, разметка, массовые действия"""
+import asyncio
+import re
+
+import newdig
+from conftest import FakeCallback, FakeMessage
+
+
+def add_order(adb, user_id, recipient="buyer", order_type="stars"):
+    return adb.db.add_order(user_id, order_type, recipient, None, newdig.Decimal("150"), "card", stars=100)
+
+
+def page_text(status, **filters):
+    callback = FakeCallback()
+    asyncio.run(newdig.show_orders_page(callback, status, **filters))
+    text, parse_mode = callback.message.edits[-1]
+    assert parse_mode == "Markdown"
+    return text, callback.message.reply_markup
+
+
+def test_crypto_filter_matches_orders_paid_with_crypto(adb):
+    card = add_order(adb, 1)
+    crypto = add_order(adb, 2)
+    adb.db.update_order_status(card, "waiting_payment", payment_method="card")
+    adb.db.update_order_status(crypto, "waiting_crypto", invoice_id="55", payment_method="crypto")
+
+    assert adb.db.get_order(crypto).payment_method == "crypto"
+    rows, _, _ = adb.db.get_orders_page("waiting_crypto", payment_method="crypto")
+    assert [row[0] for row in rows] == [crypto]
+    rows, _, _ = adb.db.get_orders_page("waiting_payment", payment_method="crypto")
+    assert rows == []
+
+
+def test_page_escapes_and_shortens_recipients(adb):
+    add_order(adb, 1, recipient="under_score*bold`code[link")
+    add_order(adb, 2, recipient="x" * 4000)
+
+    text, _ = page_text("pending")
+
+    # Служебные символы Markdown пользователя и команды /check_N экранированы
+    assert re.search(r"(?<!\\)[_`\[]", text) is None
+    assert "under\\_score\\*bold\\`code\\[link" in text
+    assert "x" * newdig.RECIPIENT_PREVIEW not in text
+    assert len(text) < newdig.MESSAGE_LIMIT
+
+
+def bulk_actions(markup):
+    return {
+        newdig.AdminSelectCallback.unpack(button.callback_data).action
+        for row in markup.inline_keyboard for button in row
+        if (button.callback_data or "").startswith(newdig.ADMIN_SELECT_PREFIX)
+    } & set(newdig.ADMIN_BULK_ACTIONS)
+
+
+def press(markup, action):
+    """Отметить всю страницу и нажать action. Возвращает callback"""
+    callback = FakeCallback(FakeMessage(markup))
+    asyncio.run(newdig.admin_select_handler(callback, newdig.AdminSelectCallback(action="all")))
+    asyncio.run(newdig.admin_select_handler(callback, newdig.AdminSelectCallback(action=action)))
+    return callback
+
+
+def test_bulk_complete_skips_unverified_orders(adb):
+    draft = add_order(adb, 1)
+    card = add_order(adb, 2)
+    crypto = add_order(adb, 3)
+    photo = add_order(adb, 4)
+    adb.db.update_order_status(card, "waiting_payment", payment_method="card")
+    adb.db.update_order_status(crypto, "waiting_crypto", invoice_id="9", payment_method="crypto")
+    adb.db.submit_payment_photo(photo, "photo")
+
+    results = adb.db.bulk_update_status([draft, card, crypto, photo], "completed")
+
+    assert [(order_id, changed) for order_id, changed, _ in results] == [
+        (draft, False), (card, False), (crypto, False), (photo, True)
+    ]
+    assert adb.db.get_order(draft).status == "pending"
+
+
+def test_bulk_actions_per_view(adb):
+    adb.db.submit_payment_photo(add_order(adb, 1), "photo")
+    add_order(adb, 2)
+
+    _, review = page_text("waiting_confirmation")
+    _, drafts = page_text("pending")
+
+    assert bulk_actions(review) == {"complete", "cancel"}
+    assert bulk_actions(drafts) == {"cancel"}
+
+
+def test_drafts_can_only_be_cancelled(adb):
+    draft = add_order(adb, 1)
+    _, markup = page_text("pending")
+
+    callback = press(markup, "complete")
+    assert adb.db.get_order(draft).status == "pending"
+    assert callback.answers[-1] == "❌ Недоступно в этом списке"
+
+    press(markup, "cancel")
+    assert adb.db.get_order(draft).status == "cancelled"
+
+
+def test_bulk_complete_from_review_list(adb):
+    order_id = add_order(adb, 1)
+    adb.db.submit_payment_photo(order_id, "photo")
+    _, markup = page_text("waiting_confirmation")
+
+    callback = press(markup, "complete")
+
+    assert adb.db.get_order(order_id).status == "completed"
+    assert callback.message.answers[-1].startswith("✅ Выполнено: 1 из 1")
+
+
+def test_stats_count_review_orders_separately_from_drafts(adb):
+    add_order(adb, 1)
+    adb.db.submit_payment_photo(add_order(adb, 2), "photo")
+
+    text = newdig.stats_text(adb.db.get_statistics())
+
+    assert "⏳ Ожидают проверки: 1" in text
+    assert "📝 Черновики (не оплачены): 1" in text
@@ -0,0 +1,39 @@
+"""Остановка фоновых задач: отмена не должна теряться"""
+import asyncio
+
+import newdig
+
+
+class IdleDatabase:
+    """Заказов в ожидании нет, outbox пуст"""
+
+    async def get_crypto_waiting_orders(self):
+        return []
+
+    async def claim_outbox(self, now, limit, lease, **options):
+        return []
+
+
+async def stop_after_wakeup(task_owner):
+    """wakeup() и stop() в одном шаге цикла - как при SIGTERM сразу после
+    нажатия 'проверить оплату' или новой записи в outbox"""
+    task_owner.start()
+    await asyncio.sleep(0.05)
+    task_owner.wakeup()
+    stopping = asyncio.ensure_future(task_owner.stop())
+    done, _ = await asyncio.wait({stopping}, timeout=1)
+    assert done, "фоновая задача не остановилась"
+
+
+def test_invoice_poller_stops_with_pending_wakeup():
+    for _ in range(10):
+        poller = newdig.InvoicePoller(api=None, database=IdleDatabase(), min_interval=0.01, max_interval=5)
+        asyncio.run(stop_after_wakeup(poller))
+        assert poller._task is None
+
+
+def test_outbox_sender_stops_with_pending_wakeup():
+    for _ in range(10):
+        sender = newdig.OutboxSender(IdleDatabase(), notifier=None, interval=5)
+        asyncio.run(stop_after_wakeup(sender))
+        assert sender._task is None
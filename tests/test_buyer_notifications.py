@@ -0,0 +1,53 @@
+"""Уведомления покупателю о статусе заказа зависят от способа оплаты"""
+import asyncio
+import json
+
+import pytest
+
+import newdig
+from conftest import FakeCallback
+
+BUYER_ID = 42
+
+
+class FakeCryptoBot:
+    async def create_invoice(self, amount, description="", usd_rate=None):
+        return {"success": True, "invoice_id": 501, "pay_url": "https://pay", "amount": "1.77", "asset": "USDT"}
+
+
+@pytest.fixture(autouse=True)
+def fake_cryptobot(monkeypatch):
+    monkeypatch.setattr(newdig, "cryptobot", FakeCryptoBot())
+
+
+def buyer_texts(adb):
+    rows = adb.db.conn.execute("SELECT calls FROM outbox WHERE chat_id = ?", (BUYER_ID,)).fetchall()
+    return [params["text"] for (calls,) in rows for _, params in json.loads(calls)]
+
+
+def new_order(adb):
+    return adb.db.add_order(BUYER_ID, "stars", "bob", None, newdig.Decimal("150"), "card", stars=100)
+
+
+def test_paid_crypto_order_gets_crypto_text(adb):
+    order_id = new_order(adb)
+
+    async def scenario():
+        # Способ оплаты записывает сам обработчик выбора CryptoBot
+        await newdig.crypto_payment_handler(FakeCallback(user_id=BUYER_ID), newdig.CryptoPayCallback(order_id=order_id))
+        await newdig.apply_invoice_updates(adb, [(order_id, "completed")])
+
+    asyncio.run(scenario())
+
+    assert adb.db.get_order(order_id).payment_method == "crypto"
+    assert buyer_texts(adb) == [newdig.BUYER_CRYPTO_MESSAGES["completed"].format(order_id=order_id)]
+
+
+def test_card_order_gets_status_text(adb):
+    order_id = new_order(adb)
+    adb.db.update_order_status(order_id, "waiting_payment", payment_method="card")
+    adb.db.submit_payment_photo(order_id, "photo")
+
+    asyncio.run(newdig.apply_bulk_status([order_id], "completed"))
+
+    assert buyer_texts(adb) == [newdig.BUYER_STATUS_MESSAGES["completed"].format(order_id=order_id)]
@@ -0,0 +1,160 @@
+"""CryptoBotAPI против локального фейкового сервера: повторы, таймауты, пул"""
+import asyncio
+import contextlib
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import newdig
+
+
+def ok(result):
+    async def respond(request):
+        return web.json_response({"ok": True, "result": result})
+    return respond
+
+
+def api_error(name):
+    async def respond(request):
+        return web.json_response({"ok": False, "error": {"code": 400, "name": name}})
+    return respond
+
+
+def http_status(status):
+    async def respond(request):
+        return web.Response(status=status)
+    return respond
+
+
+def slow(seconds):
+    async def respond(request):
+        await asyncio.sleep(seconds)
+        return web.json_response({"ok": True, "result": {}})
+    return respond
+
+
+class FakeCryptoBot:
+    """Отвечает по списку responses по очереди, последний ответ повторяется"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+        self.peers = set()
+
+    async def handle(self, request):
+        self.requests.append((
+            request.match_info["method"],
+            await request.json(),
+            request.headers.get("Crypto-Pay-API-Token")
+        ))
+        self.peers.add(request.transport.get_extra_info("peername"))
+        respond = self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+        return await respond(request)
+
+
+@contextlib.asynccontextmanager
+async def fake_cryptobot(*responses, **client_options):
+    fake = FakeCryptoBot(responses)
+    app = web.Application()
+    app.router.add_post("/api/{method}", fake.handle)
+    server = TestServer(app)
+    await server.start_server()
+
+    options = {"retries": 2, "backoff": 0.01, "read_timeout": 1}
+    options.update(client_options)
+    api = newdig.CryptoBotAPI("secret-token", base_url=str(server.make_url("/api")), **options)
+    try:
+        yield api, fake
+    finally:
+        await api.close()
+        await server.close()
+
+
+def test_retries_server_errors_then_succeeds():
+    async def scenario():
+        async with fake_cryptobot(http_status(503), http_status(429), ok({"app_id": 1})) as (api, fake):
+            assert await api.get_me() == {"app_id": 1}
+            assert [method for method, _, _ in fake.requests] == ["getMe"] * 3
+            assert {token for _, _, token in fake.requests} == {"secret-token"}
+
+    asyncio.run(scenario())
+
+
+def test_gives_up_after_retries():
+    async def scenario():
+        async with fake_cryptobot(http_status(500)) as (api, fake):
+            with pytest.raises(newdig.CryptoBotError, match="HTTP 500"):
+                await api.get_me()
+            assert len(fake.requests) == api.retries + 1
+
+    asyncio.run(scenario())
+
+
+def test_api_error_is_not_retried():
+    async def scenario():
+        async with fake_cryptobot(api_error("UNAUTHORIZED")) as (api, fake):
+            with pytest.raises(newdig.CryptoBotError, match="UNAUTHORIZED"):
+                await api.get_me()
+            assert len(fake.requests) == 1
+
+    asyncio.run(scenario())
+
+
+def test_read_timeout_is_retried_for_idempotent_methods():
+    async def scenario():
+        async with fake_cryptobot(slow(0.5), ok({"items": [{"invoice_id": 7}]}), read_timeout=0.1) as (api, fake):
+            assert await api.get_invoices(invoice_ids=[7, 8]) == [{"invoice_id": 7}]
+            assert len(fake.requests) == 2
+            assert fake.requests[-1][1] == {"invoice_ids": "7,8"}
+
+    asyncio.run(scenario())
+
+
+def test_create_invoice_is_not_retried_on_timeout():
+    """Счет мог создаться до таймаута - повтор создал бы дубль"""
+    async def scenario():
+        async with fake_cryptobot(slow(0.5), read_timeout=0.1) as (api, fake):
+            result = await api.create_invoice(850, "Заказ #1", usd_rate=newdig.Decimal("85"))
+            assert result["success"] is False
+            assert len(fake.requests) == 1
+            assert fake.requests[0][1]["amount"] == "10.00"
+
+    asyncio.run(scenario())
+
+
+def test_create_invoice_is_not_retried_on_server_error():
+    """502 от прокси не значит, что счет не создан"""
+    invoice = {"invoice_id": 1, "pay_url": "https://pay", "amount": "10.00", "asset": "USDT"}
+
+    async def scenario():
+        async with fake_cryptobot(http_status(502), ok(invoice)) as (api, fake):
+            result = await api.create_invoice(850, "Заказ #1", usd_rate=newdig.Decimal("85"))
+            assert result["success"] is False
+            assert len(fake.requests) == 1
+
+    asyncio.run(scenario())
+
+
+def test_create_invoice_is_retried_when_rate_limited():
+    invoice = {"invoice_id": 1, "pay_url": "https://pay", "amount": "10.00", "asset": "USDT"}
+
+    async def scenario():
+        async with fake_cryptobot(http_status(429), ok(invoice)) as (api, fake):
+            assert (await api.create_invoice(850, usd_rate=newdig.Decimal("85")))["invoice_id"] == 1
+            assert len(fake.requests) == 2
+
+    asyncio.run(scenario())
+
+
+def test_connections_are_reused():
+    async def scenario():
+        invoice = {"invoice_id": 1, "pay_url": "https://pay", "amount": "1.00", "asset": "USDT"}
+        async with fake_cryptobot(ok(invoice)) as (api, fake):
+            session = api._get_session()
+            for _ in range(5):
+                assert (await api.create_invoice(85))["success"]
+            assert api._get_session() is session
+            assert len(fake.peers) == 1
+
+    asyncio.run(scenario())
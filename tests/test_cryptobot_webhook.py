@@ -0,0 +1,103 @@
+"""Вебхук CryptoBot: проверка подписи и идемпотентность повторной доставки"""
+import asyncio
+import hashlib
+import hmac
+import itertools
+import json
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import newdig
+
+invoice_ids = itertools.count(1000)
+
+
+def sign(body, token=newdig.CRYPTOBOT_TOKEN):
+    secret = hashlib.sha256(token.encode()).digest()
+    return hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+def invoice_paid(invoice_id):
+    return json.dumps({
+        "update_id": invoice_id,
+        "update_type": "invoice_paid",
+        "payload": {"invoice_id": invoice_id, "status": "paid", "amount": "1.77", "asset": "USDT"}
+    }).encode()
+
+
+async def crypto_order():
+    """Заказ, ожидающий оплаты счета. Возвращает (order_id, invoice_id)"""
+    invoice_id = next(invoice_ids)
+    order_id = await newdig.db.add_order(
+        invoice_id, "stars", "@buyer", None, newdig.Decimal("150"), "card", stars=100
+    )
+    await newdig.db.update_order_status(order_id, "waiting_crypto", invoice_id=str(invoice_id))
+    return order_id, invoice_id
+
+
+async def post(client, body, signature):
+    response = await client.post(
+        newdig.CRYPTOBOT_WEBHOOK_PATH, data=body, headers={"crypto-pay-api-signature": signature}
+    )
+    return response.status
+
+
+def run_with_client(scenario):
+    async def main():
+        client = TestClient(TestServer(newdig.build_web_app()))
+        await client.start_server()
+        try:
+            await scenario(client)
+        finally:
+            await client.close()
+
+    asyncio.run(main())
+
+
+def test_rejects_bad_signature():
+    async def scenario(client):
+        order_id, invoice_id = await crypto_order()
+        body = invoice_paid(invoice_id)
+
+        assert await post(client, body, "") == 401
+        assert await post(client, body, sign(body, token="other-token")) == 401
+        assert await post(client, body + b" ", sign(body)) == 401
+        assert (await newdig.db.get_order(order_id)).status == "waiting_crypto"
+
+    run_with_client(scenario)
+
+
+def test_rejects_signed_garbage():
+    async def scenario(client):
+        body = b"not json"
+        assert await post(client, body, sign(body)) == 400
+
+    run_with_client(scenario)
+
+
+def test_duplicate_delivery_is_idempotent():
+    async def scenario(client):
+        order_id, invoice_id = await crypto_order()
+        body = invoice_paid(invoice_id)
+        completed_before = (await newdig.db.get_statistics())["completed_orders"]
+
+        assert await post(client, body, sign(body)) == 200
+        assert await post(client, body, sign(body)) == 200
+
+        assert (await newdig.db.get_order(order_id)).status == "completed"
+        assert (await newdig.db.get_statistics())["completed_orders"] == completed_before + 1
+        outbox = newdig.db.db.conn.execute(
+            "SELECT COUNT(*) FROM outbox WHERE dedupe_key = ?", (f"order:{order_id}",)
+        ).fetchone()[0]
+        assert outbox == 1
+
+    run_with_client(scenario)
+
+
+def test_unknown_invoice_is_acknowledged():
+    """200, иначе CryptoBot будет повторять доставку бесконечно"""
+    async def scenario(client):
+        body = invoice_paid(999999)
+        assert await post(client, body, sign(body)) == 200
+
+    run_with_client(scenario)
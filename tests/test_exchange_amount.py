@@ -0,0 +1,47 @@
+"""Ввод суммы обмена: границы проверяются до записи заказа"""
+import asyncio
+
+import pytest
+
+import newdig
+from conftest import FakeMessage
+
+BUYER_ID = 42
+
+
+def enter_amount(text):
+    message = FakeMessage(text=text, user_id=BUYER_ID)
+
+    async def scenario():
+        await newdig.user_states.set(BUYER_ID, {"action": "waiting_exchange_amount"})
+        await newdig.handle_text_messages(message)
+
+    asyncio.run(scenario())
+    return message.answers
+
+
+def orders(adb):
+    return adb.db.conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+
+
+@pytest.mark.parametrize("text", ["1e17", "100000000000000000", "1000000.01"])
+def test_too_large_amount_is_rejected(adb, text):
+    assert enter_amount(text) == ["❌ Максимальная сумма: 1,000,000 RUB"]
+    assert orders(adb) == 0
+
+
+@pytest.mark.parametrize("text, answer", [
+    ("99.99", "❌ Минимальная сумма: 100 RUB"),
+    ("сто", "❌ Пожалуйста, введите число"),
+    ("nan", "❌ Пожалуйста, введите число")
+])
+def test_invalid_amount_is_rejected(adb, text, answer):
+    assert enter_amount(text) == [answer]
+    assert orders(adb) == 0
+
+
+def test_max_amount_creates_order(adb):
+    answers = enter_amount("1000000")
+
+    assert orders(adb) == 1
+    assert "К оплате: 1000000.00 RUB" in answers[0]
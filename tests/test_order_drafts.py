@@ -0,0 +1,39 @@
+"""Черновики заказов: один черновик на набор параметров"""
+import newdig
+
+
+def stars_draft(database, recipient="bob", stars=100, amount="150"):
+    return database.add_order(
+        1, "stars", recipient, None, newdig.Decimal(amount), "card", usd_rate=newdig.Decimal("85"), stars=stars
+    )
+
+
+def test_same_parameters_reuse_the_draft(database):
+    assert stars_draft(database) == stars_draft(database)
+
+    premium = database.add_order(1, "premium", "bob", None, newdig.Decimal("1000"), "card", period="3m")
+    assert database.add_order(1, "premium", "bob", None, newdig.Decimal("1000"), "card", period="3m") == premium
+
+    exchange = database.add_order(1, "exchange", "", None, newdig.Decimal("850"), "card", amount_usd=newdig.Decimal("10"))
+    assert database.add_order(1, "exchange", "", None, newdig.Decimal("850"), "card", amount_usd=newdig.Decimal("10")) == exchange
+
+
+def test_other_parameters_keep_the_old_draft_intact(database):
+    """Кнопки оплаты старого сообщения оплачивают то, что в нем написано"""
+    old = stars_draft(database)
+
+    assert stars_draft(database, stars=200, amount="300") != old
+    assert stars_draft(database, recipient="alice") != old
+
+    order = database.get_order(old)
+    assert (order.status, order.recipient, order.stars, order.amount_rub) == (
+        "pending", "bob", 100, newdig.Decimal("150.00")
+    )
+
+
+def test_paid_draft_is_not_reused(database):
+    old = stars_draft(database)
+    database.update_order_status(old, "waiting_payment", payment_method="card")
+
+    assert stars_draft(database) != old
+    assert database.get_order(old).status == "waiting_payment"
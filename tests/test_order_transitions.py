@@ -0,0 +1,126 @@
+"""Переходы статусов заказа под конкурентной нагрузкой.
+
+Несколько соединений (как несколько процессов бота) одновременно дергают
+одни и те же заказы всеми путями смены статуса. Каждый переход пишет
+триггер в историю, и ни один не должен нарушить ORDER_TRANSITIONS.
+"""
+import asyncio
+import logging
+import random
+import threading
+
+import pytest
+
+import newdig
+from conftest import ADMIN_ID
+
+STATUSES = list(newdig.ORDER_TRANSITIONS)
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / "transitions.db")
+    database = newdig.Database(path)
+    database.conn.executescript("""
+        CREATE TABLE status_history (order_id INTEGER, old TEXT, new TEXT);
+        CREATE TRIGGER record_status AFTER UPDATE OF status ON orders BEGIN
+            INSERT INTO status_history VALUES (NEW.id, OLD.status, NEW.status);
+        END;
+    """)
+    database.conn.close()
+    return path
+
+
+def hammer(path, order_ids, seed, operations, errors):
+    database = newdig.Database(path)
+    rng = random.Random(seed)
+    try:
+        for _ in range(operations):
+            order_id = rng.choice(order_ids)
+            action = rng.randrange(4)
+            if action == 0:
+                database.update_order_status(order_id, rng.choice(STATUSES))
+            elif action == 1:
+                database.submit_payment_photo(order_id, f"photo{seed}")
+            elif action == 2:
+                database.apply_invoice_statuses([(order_id, rng.choice(("completed", "expired")))])
+            else:
+                database.bulk_update_status(rng.sample(order_ids, 3), rng.choice(("completed", "cancelled")))
+    except Exception as e:
+        errors.append(e)
+    finally:
+        database.conn.close()
+
+
+def test_concurrent_transitions_follow_the_state_machine(path):
+    database = newdig.Database(path)
+    order_ids = [
+        database.add_order(user_id, "stars", "@buyer", None, newdig.Decimal("150"), "card", stars=100)
+        for user_id in range(20)
+    ]
+
+    errors = []
+    threads = [
+        threading.Thread(target=hammer, args=(path, order_ids, seed, 300, errors))
+        for seed in range(6)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+    history = database.conn.execute("SELECT order_id, old, new FROM status_history").fetchall()
+    assert len(history) > len(order_ids)
+    illegal = [row for row in history if row[1] not in newdig.ORDER_TRANSITIONS[row[2]]]
+    assert illegal == []
+    # Итоговые статусы сходятся с последним переходом, а счетчики stats - с таблицей
+    for order_id in order_ids:
+        last = database.conn.execute(
+            "SELECT new FROM status_history WHERE order_id = ? ORDER BY rowid DESC LIMIT 1", (order_id,)
+        ).fetchone()
+        if last:
+            assert database.get_order(order_id).status == last[0]
+    assert database.check_statistics() == {}
+
+
+def test_payment_after_cancel_alerts_admins(path, monkeypatch, caplog):
+    monkeypatch.setattr(newdig, "ADMIN_IDS", [ADMIN_ID])
+    adb = newdig.AsyncDatabase(newdig.Database(path))
+
+    async def scenario():
+        order_id = await adb.add_order(1, "stars", "@buyer", None, newdig.Decimal("150"), "card", stars=100)
+        await adb.update_order_status(order_id, "waiting_crypto", invoice_id="7", payment_method="crypto")
+        await adb.update_order_status(order_id, "cancelled")
+
+        with caplog.at_level(logging.WARNING, logger="newdig"):
+            changed = await newdig.apply_invoice_updates(adb, [(order_id, "completed")])
+            # Повторная доставка (вебхук и поллер) не дублирует уведомление
+            await newdig.apply_invoice_updates(adb, [(order_id, "completed")])
+        return order_id, changed
+
+    try:
+        order_id, changed = asyncio.run(scenario())
+    finally:
+        asyncio.run(adb.close())
+
+    assert changed == []
+    assert adb.db.get_order(order_id).status == "cancelled"
+    assert any(f"#{order_id}" in record.getMessage() for record in caplog.records)
+    alerts = adb.db.conn.execute("SELECT chat_id, calls FROM outbox").fetchall()
+    assert [chat_id for chat_id, _ in alerts] == [ADMIN_ID]
+    assert f"/check_{order_id}" in alerts[0][1]
+
+
+def test_duplicate_payment_does_not_alert(path, monkeypatch):
+    monkeypatch.setattr(newdig, "ADMIN_IDS", [ADMIN_ID])
+    database = newdig.Database(path)
+    order_id = database.add_order(1, "stars", "@buyer", None, newdig.Decimal("150"), "card", stars=100)
+    database.update_order_status(order_id, "waiting_crypto", invoice_id="7", payment_method="crypto")
+
+    first = database.apply_invoice_statuses([(order_id, "completed")], lost_outbox={order_id: [(ADMIN_ID, (), None)]})
+    second = database.apply_invoice_statuses([(order_id, "completed")], lost_outbox={order_id: [(ADMIN_ID, (), None)]})
+
+    assert first == [(order_id, True, "completed")]
+    assert second == [(order_id, False, "completed")]
+    assert database.conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] == 0
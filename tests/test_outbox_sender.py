@@ -0,0 +1,71 @@
+"""Доставка outbox: медленный чат не задерживает остальных"""
+import asyncio
+import time
+
+import newdig
+
+HOT_CHAT = 1
+BUYERS = range(1000, 1280)
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        self.sent.append((chat_id, text, time.perf_counter()))
+
+
+def add_rows(database, messages):
+    cursor = database.conn.cursor()
+    database._add_outbox(cursor, messages)
+    database.commit()
+
+
+def text(chat_id, number=0):
+    return (chat_id, (("send_message", {"text": f"{chat_id}:{number}"}),), None)
+
+
+def test_hot_chat_does_not_block_bulk_completion(adb):
+    # 20 уведомлений одному чату записаны раньше массового выполнения
+    add_rows(adb.db, [text(HOT_CHAT, number) for number in range(20)])
+    add_rows(adb.db, [text(chat_id) for chat_id in BUYERS])
+
+    bot = FakeBot()
+    # Початовый лимит 20/с: горячий чат отправляется около секунды,
+    # остальные 280 при общем лимите 1000/с - за ~0.3 с
+    notifier = newdig.NotificationDispatcher(bot, workers=8, global_rate=1000, chat_rate=20, chat_burst=1)
+    sender = newdig.OutboxSender(adb, notifier, batch_size=50, interval=5)
+
+    async def scenario():
+        notifier.start()
+        sender.start()
+        try:
+            for _ in range(100):
+                await asyncio.sleep(0.05)
+                if len(bot.sent) == 300:
+                    break
+        finally:
+            await sender.stop()
+            await notifier.stop(timeout=1)
+
+    asyncio.run(scenario())
+
+    hot = [at for chat_id, _, at in bot.sent if chat_id == HOT_CHAT]
+    buyers = [at for chat_id, _, at in bot.sent if chat_id != HOT_CHAT]
+    assert len(hot) == 20 and len(buyers) == len(BUYERS)
+    # Все покупатели получили уведомление, пока горячий чат отправлен наполовину
+    assert max(buyers) < hot[10]
+    # Порядок внутри чата сохраняется, отправленные строки удалены
+    assert [message for chat_id, message, _ in bot.sent if chat_id == HOT_CHAT] == [
+        f"{HOT_CHAT}:{number}" for number in range(20)
+    ]
+    assert adb.db.conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] == 0
+
+
+def test_claim_limits_rows_per_chat_and_skips_busy_chats(database):
+    add_rows(database, [text(HOT_CHAT, number) for number in range(10)] + [text(2), text(3)])
+
+    rows = database.claim_outbox(time.time(), 50, 60, chat_limit=3, skip_chats={3})
+
+    assert [chat_id for _, chat_id, _, _ in rows] == [HOT_CHAT] * 3 + [2]
@@ -0,0 +1,73 @@
+"""Горячие запросы к orders идут по индексам, а не полным сканом.
+
+Запросы не копируются в тест: SQL перехватывается trace callback-ом при
+вызове методов Database и прогоняется через EXPLAIN QUERY PLAN.
+"""
+import pytest
+
+import newdig
+
+
+@pytest.fixture
+def database(database):
+    """Пустая база из conftest с заказами всех типов"""
+    for user_id in range(200):
+        order_id = database.add_order(
+            user_id, ("stars", "premium", "exchange")[user_id % 3], "@buyer", None,
+            newdig.Decimal("150"), "card", stars=100
+        )
+        if user_id % 2:
+            database.update_order_status(order_id, "waiting_crypto", invoice_id=str(order_id))
+    return database
+
+
+def query_plans(database, call):
+    """[(sql, план одной строкой), ...] для SELECT-ов, выполненных call()"""
+    statements = []
+    database.conn.set_trace_callback(statements.append)
+    try:
+        call()
+    finally:
+        database.conn.set_trace_callback(None)
+
+    plans = []
+    for sql in statements:
+        if sql.lstrip().upper().startswith("SELECT"):
+            rows = database.conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+            plans.append((sql, " | ".join(row[-1] for row in rows)))
+    assert plans, "запрос не выполнился"
+    return plans
+
+
+def assert_uses_index(plans, index):
+    for sql, plan in plans:
+        assert index in plan, f"{sql}\n-> {plan}"
+        assert "SCAN orders" not in plan, f"{sql}\n-> {plan}"
+
+
+@pytest.mark.parametrize("kwargs", [
+    {},
+    {"order_type": "stars"},
+    {"payment_method": "card"},
+    {"cursor": 150},
+    {"cursor": 150, "direction": "prev"},
+])
+def test_orders_page_uses_status_created_index(database, kwargs):
+    plans = query_plans(database, lambda: database.get_orders_page("pending", limit=10, **kwargs))
+    assert_uses_index(plans[:1], "idx_orders_status_created")
+
+
+def test_crypto_waiting_orders_use_status_created_index(database):
+    plans = query_plans(database, database.get_crypto_waiting_orders)
+    assert_uses_index(plans, "idx_orders_status_created")
+
+
+def test_lookup_by_invoice_uses_invoice_index(database):
+    plans = query_plans(database, lambda: database.get_order_id_by_invoice("3"))
+    assert_uses_index(plans, "idx_orders_invoice")
+
+
+def test_review_count_uses_status_created_index(database):
+    plans = [plan for plan in query_plans(database, database.get_statistics) if "FROM orders" in plan[0]]
+    assert len(plans) == 1
+    assert_uses_index(plans, "idx_orders_status_created")
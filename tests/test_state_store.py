@@ -0,0 +1,29 @@
+"""Хранилища состояний ведут себя одинаково"""
+import asyncio
+
+import pytest
+
+import newdig
+
+TTL = 0.5
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request):
+    if request.param == "memory":
+        return newdig.MemoryStateStore(ttl=TTL)
+    return newdig.SQLiteStateStore(request.getfixturevalue("adb"), ttl=TTL)
+
+
+def test_ttl_slides_on_read(store):
+    async def scenario():
+        await store.set(1, {"action": "waiting_recipient"})
+        await asyncio.sleep(TTL * 0.6)
+        assert await store.get(1) == {"action": "waiting_recipient"}
+        # Исходный срок прошел, но чтение его продлило
+        await asyncio.sleep(TTL * 0.6)
+        assert await store.get(1) == {"action": "waiting_recipient"}
+        await asyncio.sleep(TTL * 1.2)
+        return await store.get(1)
+
+    assert asyncio.run(scenario()) is None